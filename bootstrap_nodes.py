@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Подготовка новых серверов после deploy_master.py: по inventory.json параллельно
+(не больше --parallel SSH-сессий сразу) выполняет на каждом хосте start.sh.
+
+Скрипт отправляется через stdin ssh и обёрнут маркером в $HOME/.vless-bootstrap:
+имя маркера — хэш скрипта и обёртки, так что повторный запуск пропускает уже
+подготовленные хосты, а изменённый скрипт выполняется заново. После скрипта
+обёртка задаёт хосту его имя из инвентаря через change_hostname.py. Вывод каждого хоста печатается
+по мере поступления с префиксом [имя] и пишется в bootstrap-logs/<имя>.log;
+в конце печатается сводка: результат и длительность по каждому хосту.
+
+    python3 bootstrap_nodes.py [--inventory inventory.json] [--hosts a,b] [--parallel 10]
+
+С --bundle bundles/vless-node-<версия>.tar.gz вместо start.sh на хост загружается
+бандл node_bundle.py (если его там ещё нет) и устанавливается из локального файла.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import asyncio
+import hashlib
+import argparse
+from pathlib import Path
+from typing import Optional
+
+# -------------------------------------------------------------------
+#  Константы и пути
+# -------------------------------------------------------------------
+BASE_DIR = Path(__file__).parent.resolve()
+INVENTORY_FILE = BASE_DIR / "inventory.json"
+BOOTSTRAP_SCRIPT = BASE_DIR / "start.sh"
+BOOTSTRAP_LOG_DIR = BASE_DIR / "bootstrap-logs"
+
+# Команда ssh; для локальной заглушки: SSH_BIN=tools/fake_ssh.py
+SSH_BIN = os.getenv("SSH_BIN", "ssh")
+SSH_USER = os.getenv("SSH_USER", "root")
+SSH_OPTIONS = [
+    "-o", "BatchMode=yes",
+    "-o", "StrictHostKeyChecking=accept-new",
+    "-o", "ConnectTimeout=15",
+    "-o", "ServerAliveInterval=30",
+]
+
+BOOTSTRAP_PARALLEL = int(os.getenv("BOOTSTRAP_PARALLEL", "10"))
+BOOTSTRAP_TIMEOUT = float(os.getenv("BOOTSTRAP_TIMEOUT", "1800"))   # секунд на один хост
+
+# Строка, которой обёртка сообщает, что хост уже подготовлен этим же скриптом
+SKIPPED_SENTINEL = "VLESS-BOOTSTRAP-SKIPPED"
+
+BOOTSTRAP_WRAPPER = """set -e
+marker="$HOME/.vless-bootstrap/{digest}"
+if [ -f "$marker" ]; then
+    echo "{sentinel} {digest}"
+    exit 0
+fi
+cd "$HOME"
+export SERVER_NAME={name}
+cat > start.sh <<'__VLESS_BOOTSTRAP_EOF__'
+{script}
+__VLESS_BOOTSTRAP_EOF__
+chmod +x start.sh
+# change_hostname.py от прошлого (возможно, оборванного) запуска не используем: ниже
+# запускается только тот, что положил этот start.sh
+rm -f change_hostname.py
+bash ./start.sh
+# start.sh берёт SERVER_NAME из общего .env (одно имя на все хосты), поэтому имя хоста задаём после него
+if [ -f change_hostname.py ]; then
+    python3 change_hostname.py {name} 127.0.1.1
+else
+    echo "change_hostname.py не найден: имя хоста не изменено" >&2
+fi
+mkdir -p "$HOME/.vless-bootstrap"
+touch "$marker"
+"""
+
+# Установка из бандла node_bundle.py вместо start.sh: архив уже загружен в $HOME/.vless-bundles
+BUNDLE_REMOTE_DIR = ".vless-bundles"
+BUNDLE_INSTALL_SCRIPT = """bundle="$HOME/{remote_dir}/{bundle}"
+tar -xzf "$bundle" -O scripts/node_bundle.py > "$HOME/{remote_dir}/node_bundle.py"
+python3 "$HOME/{remote_dir}/node_bundle.py" install "$bundle" --dest "$HOME" --hostname "$SERVER_NAME"
+"""
+
+
+def script_digest(script: str) -> str:
+    """Хэш скрипта вместе с обёрткой: исправление обёртки тоже выполняется заново."""
+    return hashlib.sha256((BOOTSTRAP_WRAPPER + script).encode()).hexdigest()[:16]
+
+
+def render_bootstrap(script: str, name: str) -> str:
+    """Скрипт для хоста: пропускается, если маркер этого же скрипта уже есть."""
+    return BOOTSTRAP_WRAPPER.format(
+        digest=script_digest(script), sentinel=SKIPPED_SENTINEL,
+        name=shlex.quote(name), script=script.rstrip("\n"),
+    )
+
+
+def load_hosts(path: Path, only: Optional[set[str]] = None) -> list[dict]:
+    """Готовые серверы из inventory.json (deploy_master.py), опционально только из only."""
+    inventory = json.loads(path.read_text())
+    hosts = [srv for srv in inventory.get("servers", []) if srv.get("ip")]
+    if only:
+        unknown = only - {srv["name"] for srv in hosts}
+        if unknown:
+            sys.exit(f"В инвентаре нет готовых серверов: {', '.join(sorted(unknown))}")
+        hosts = [srv for srv in hosts if srv["name"] in only]
+    return hosts
+
+
+def ssh_command(ip: str, *command: str) -> list[str]:
+    return [SSH_BIN, *SSH_OPTIONS, f"{SSH_USER}@{ip}", *command]
+
+
+async def upload_bundle(ip: str, bundle: Path) -> Optional[str]:
+    """
+    Загружает бандл в $HOME/.vless-bundles, если его там ещё нет.
+    Возвращает текст ошибки или None.
+    """
+    remote = f"{BUNDLE_REMOTE_DIR}/{bundle.name}"
+    check = await asyncio.create_subprocess_exec(
+        *ssh_command(ip, "test", "-f", remote),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    code = await check.wait()
+    if code == 0:
+        return None
+    if code == 255:
+        return "ошибка SSH-подключения"
+    with open(bundle, "rb") as f:
+        proc = await asyncio.create_subprocess_exec(
+            *ssh_command(ip, f"mkdir -p {BUNDLE_REMOTE_DIR} && cat > {remote}.tmp && mv {remote}.tmp {remote}"),
+            stdin=f, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        return f"не удалось загрузить бандл: {stderr.decode().strip()}"
+    return None
+
+
+async def bootstrap_host(host: dict, script: str, semaphore: asyncio.Semaphore,
+                         log_dir: Path, timeout: float, bundle: Optional[Path] = None) -> dict:
+    """
+    Выполняет скрипт на одном хосте, транслируя его вывод построчно.
+    С bundle сначала загружает архив бандла (если его ещё нет на хосте).
+    Возвращает {name, ip, result: ok|skipped|failed, duration, exit_code, error}.
+    """
+    name, ip = host["name"], host["ip"]
+    result = {"name": name, "ip": ip, "result": "failed", "duration": 0.0, "exit_code": None, "error": None}
+    async with semaphore:
+        started = time.monotonic()
+        skipped = False
+        if bundle is not None:
+            result["error"] = await upload_bundle(ip, bundle)
+            if result["error"]:
+                result["duration"] = round(time.monotonic() - started, 2)
+                return result
+        with open(log_dir / f"{name}.log", "w") as log:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *ssh_command(ip, "sh", "-s"),
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                )
+            except OSError as e:
+                result["error"] = f"не удалось запустить {SSH_BIN}: {e}"
+                return result
+
+            proc.stdin.write(render_bootstrap(script, name).encode())
+            proc.stdin.close()
+
+            async def stream():
+                nonlocal skipped
+                async for raw in proc.stdout:
+                    line = raw.decode(errors="replace").rstrip("\n")
+                    skipped = skipped or line.startswith(SKIPPED_SENTINEL)
+                    log.write(line + "\n")
+                    print(f"[{name}] {line}", flush=True)
+
+            try:
+                await asyncio.wait_for(stream(), timeout)
+                result["exit_code"] = await proc.wait()
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                result["error"] = f"таймаут {timeout:.0f} с"
+
+        result["duration"] = round(time.monotonic() - started, 2)
+    if result["exit_code"] == 0:
+        result["result"] = "skipped" if skipped else "ok"
+    elif result["exit_code"] == 255 and result["error"] is None:
+        result["error"] = "ошибка SSH-подключения"
+    elif result["error"] is None:
+        result["error"] = f"код возврата {result['exit_code']}"
+    return result
+
+
+def print_summary(results: list[dict]):
+    rows = [["NAME", "IP", "RESULT", "DURATION", "ERROR"]]
+    rows += [[r["name"], r["ip"], r["result"], f"{r['duration']:.1f}s", r["error"] or ""] for r in results]
+    widths = [max(map(len, col)) for col in zip(*rows)]
+    for row in rows:
+        print("  ".join(val.ljust(width) for val, width in zip(row, widths)).rstrip())
+
+
+async def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Параллельный запуск start.sh на серверах из инвентаря")
+    parser.add_argument("--inventory", type=Path, default=INVENTORY_FILE)
+    parser.add_argument("--hosts", help="имена серверов через запятую (по умолчанию все готовые)")
+    parser.add_argument("--script", type=Path, default=BOOTSTRAP_SCRIPT)
+    parser.add_argument("--bundle", type=Path,
+                        help="установить бандл node_bundle.py вместо выполнения start.sh")
+    parser.add_argument("--parallel", type=int, default=BOOTSTRAP_PARALLEL,
+                        help="максимум одновременных SSH-сессий")
+    parser.add_argument("--timeout", type=float, default=BOOTSTRAP_TIMEOUT,
+                        help="секунд на один хост")
+    parser.add_argument("--log-dir", type=Path, default=BOOTSTRAP_LOG_DIR)
+    parser.add_argument("--report", type=Path, help="записать сводку в JSON")
+    args = parser.parse_args(argv)
+
+    only = {h.strip() for h in args.hosts.split(",") if h.strip()} if args.hosts else None
+    hosts = load_hosts(args.inventory, only)
+    if not hosts:
+        print("В инвентаре нет готовых серверов")
+        return 0
+    if args.bundle:
+        script = BUNDLE_INSTALL_SCRIPT.format(remote_dir=BUNDLE_REMOTE_DIR, bundle=args.bundle.name)
+    else:
+        script = args.script.read_text()
+    args.log_dir.mkdir(parents=True, exist_ok=True)
+
+    semaphore = asyncio.Semaphore(max(args.parallel, 1))
+    results = await asyncio.gather(*(
+        bootstrap_host(host, script, semaphore, args.log_dir, args.timeout, args.bundle) for host in hosts
+    ))
+
+    print()
+    print_summary(results)
+    if args.report:
+        args.report.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+    return 1 if any(r["result"] == "failed" for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
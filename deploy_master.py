@@ -1,162 +1,583 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
 
 import os
+import re
+import sys
+import json
+import time
+import random
 import asyncio
+import argparse
+from pathlib import Path
 from typing import Optional
 from objects.models import Server  # Импортируем твою Pydantic-модель
-
-
-async def run_server(server_name: str) -> Optional[str]:
-    # """
-    # Асинхронно запускает создание сервера с заданным именем.
-
-    # Аргументы:
-    #     server_name (str): Имя сервера, который нужно создать.
-
-    # Возвращает:
-    #     Optional[str]: ID созданного сервера, если запуск успешен, иначе None.
-
-    # Логика работы:
-    # 1. Получает шаблон команды запуска сервера из переменной окружения `RUN_SERVER_CMD`.
-    #    Если переменная не установлена — выводит сообщение и завершает работу.
-    # 2. Формирует команду запуска, подставляя имя сервера в шаблон.
-    # 3. Асинхронно запускает сформированную команду с помощью `asyncio.create_subprocess_shell`.
-    # 4. Ждёт завершения процесса и считывает stdout и stderr.
-    # 5. Если команда завершилась с ошибкой — выводит stderr и возвращает None.
-    # 6. Извлекает ID сервера из последней строки вывода stdout.
-    # 7. Выводит ID созданного сервера и возвращает его.
-
-    # Примечание: предполагается, что последняя строка вывода содержит ID сервера в первом столбце.
-    # """
-    # run_server_cmd = os.getenv('RUN_SERVER_CMD')
-    # if not run_server_cmd:
-    #     print("Переменная окружения RUN_SERVER_CMD не установлена.")
-    #     return None
-
-   
-
-
-    RUN_SERVER_CMD = f'twc server create \
-            --name master-{server_name} \
-            --type standard \
-            --preset-id 3340 \
-            --project-id 1497193 \
-            --software-id 25 \
-            --image 79 \
-            --availability-zone ams-1 \
-            --region nl-1 \
-            --ssh-key 302545'
-                
-    
-
-    cmd = RUN_SERVER_CMD.format(server_name=server_name)
-    proc = await asyncio.create_subprocess_shell(
-        cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-    stdout, stderr = await proc.communicate()
-
+from vless_manager import TRACER  # спаны вызовов twc и записи файлов — тот же трассировщик
+
+# -------------------------------------------------------------------
+#  Константы и пути
+# -------------------------------------------------------------------
+BASE_DIR = Path(__file__).parent.resolve()
+# Прогресс развёртывания: по нему прерванный запуск продолжается без дублей
+FLEET_STATE_FILE = BASE_DIR / "fleet_state.json"
+# Машиночитаемый результат вместо дописывания строк в ips.txt
+INVENTORY_FILE = BASE_DIR / "inventory.json"
+
+TWC_BIN = os.getenv("TWC_BIN", "twc")
+SERVER_NAME_PREFIX = "master-"
+
+# Параметры `twc server create`, общие для всех серверов флота
+SERVER_CREATE_ARGS = [
+    "--type", "standard",
+    "--preset-id", "3340",
+    "--project-id", "1497193",
+    "--software-id", "25",
+    "--image", "79",
+    "--availability-zone", "ams-1",
+    "--region", "nl-1",
+    "--ssh-key", "302545",
+]
+
+# Сколько `twc server create` может выполняться одновременно
+CREATE_CONCURRENCY = int(os.getenv("FLEET_CREATE_CONCURRENCY", "4"))
+CREATE_RETRIES = int(os.getenv("FLEET_CREATE_RETRIES", "5"))
+BACKOFF_BASE = float(os.getenv("FLEET_BACKOFF_BASE", "2"))
+BACKOFF_MAX = float(os.getenv("FLEET_BACKOFF_MAX", "60"))
+
+# Общий опрос статусов: сначала часто, затем экспоненциально реже, с джиттером
+POLL_INITIAL_INTERVAL = float(os.getenv("FLEET_POLL_INITIAL", "2"))
+POLL_MAX_INTERVAL = float(os.getenv("FLEET_POLL_MAX", "30"))
+POLL_BACKOFF = 1.5
+POLL_JITTER = 0.2
+POLL_TIMEOUT = float(os.getenv("FLEET_POLL_TIMEOUT", "1800"))   # секунд на весь флот
+LIST_LIMIT = int(os.getenv("FLEET_LIST_LIMIT", "500"))
+# Формат вывода, который запрашивается у twc: raw (JSON), json, yaml или default (таблица)
+TWC_OUTPUT_FORMAT = os.getenv("FLEET_TWC_OUTPUT", "raw")
+
+# Трассировка вызовов twc и файлов состояния: --trace [файл] или FLEET_TRACE=1 (или путь к файлу)
+TRACE_ENV = os.getenv("FLEET_TRACE", "")
+TRACE_FILE = BASE_DIR / "fleet_trace.jsonl"
+
+# Временные ошибки API, после которых имеет смысл повторить запрос. twc печатает
+# HTTP-статус: «Status code: 429» для ответов API с телом ошибки, а ответ без
+# известного ему статуса (503 и т. п.) роняет twc с трассировкой requests.HTTPError
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+TRANSIENT_ERROR_CODES = {"too_many_requests"}
+TWC_STATUS = re.compile(
+    r"^Status code: (\d{3})\s*$|^requests\.exceptions\.HTTPError: (\d{3}) |unexpected response: (\d{3}) ",
+    re.MULTILINE,
+)
+TWC_ERROR_CODE = re.compile(r"^Error code: (\S+)\s*$", re.MULTILINE)
+# Ответа API не было вовсе или это HTML-страница шлюза (502/504 от nginx)
+TWC_TRANSIENT_ERRORS = (
+    "Coul'd not connect to server",
+    "API returned malformed response",
+    "requests.exceptions.ConnectionError",
+    "requests.exceptions.ConnectTimeout",
+    "requests.exceptions.ReadTimeout",
+)
+
+
+class TwcError(RuntimeError):
+    """Команда twc завершилась с ошибкой."""
+
+    def __init__(self, message: str, transient: bool = False):
+        super().__init__(message)
+        self.transient = transient
+
+
+def is_transient(message: str) -> bool:
+    status = TWC_STATUS.search(message)
+    if status:
+        return int(next(filter(None, status.groups()))) in TRANSIENT_STATUSES
+    code = TWC_ERROR_CODE.search(message)
+    if code:
+        return code.group(1) in TRANSIENT_ERROR_CODES
+    return any(marker in message for marker in TWC_TRANSIENT_ERRORS)
+
+
+class FleetState:
+    """
+    Прогресс развёртывания в JSON-файле: имя сервера -> {status, id, ip, ...}.
+    Файл перезаписывается атомарно после каждого изменения, поэтому после
+    прерывания известно, какие серверы уже заказаны и какие готовы.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = asyncio.Lock()
+        try:
+            self.servers = json.loads(path.read_text())
+        except FileNotFoundError:
+            self.servers = {}
+
+    def get(self, name: str) -> dict:
+        return self.servers.get(name, {})
+
+    async def update(self, name: str, **fields) -> dict:
+        async with self.lock:
+            entry = self.servers.setdefault(name, {})
+            entry.update(fields)
+            with TRACER.span("file", lambda: f"write {self.path.name}") as span:
+                text = json.dumps(self.servers, indent=2, ensure_ascii=False)
+                tmp = self.path.with_suffix(".tmp")
+                tmp.write_text(text)
+                os.replace(tmp, self.path)
+                span.set(out_bytes=len(text))
+            return entry
+
+
+async def run_twc(*args: str) -> str:
+    """Запускает twc с аргументами и возвращает stdout; при ошибке бросает TwcError."""
+    with TRACER.span("twc", lambda: " ".join(args[:2])) as span:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                TWC_BIN, *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            raise TwcError(f"не удалось запустить {TWC_BIN}: {e}")
+        stdout, stderr = await proc.communicate()
+        span.set(exit_code=proc.returncode, out_bytes=len(stdout), err_bytes=len(stderr))
     if proc.returncode != 0:
-        print("Ошибка при создании сервера:", stderr.decode())
-        return None
+        message = stderr.decode().strip() or stdout.decode().strip() or f"код возврата {proc.returncode}"
+        raise TwcError(message, transient=is_transient(message))
+    return stdout.decode()
 
-    output = stdout.decode()
-    server_id = output.strip().splitlines()[-1].split()[0]
-    print(f"Создан сервер с ID: {server_id}")
-    return server_id
 
+# -------------------------------------------------------------------
+#  Разбор вывода twc
+# -------------------------------------------------------------------
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+# Колонки таблицы `twc server list/get` и соответствующие поля ответа API
+TABLE_COLUMNS = {"ID": "id", "NAME": "name", "REGION": "location", "STATUS": "status", "IPV4": "ipv4"}
 
-async def get_server_info(server_id: str, interval: int = 10) -> Optional[Server]:
 
-    #     """
-    # Асинхронно развертывает сервер и отслеживает его статус.
+class TwcParseError(TwcError):
+    """Вывод twc не удалось разобрать; повтор того же запроса не поможет."""
 
-    # Аргументы:
-    #     server_id (str): ID сервера, который нужно развернуть.
-    #     interval (int): Интервал времени (в секундах) между проверками статуса (по умолчанию 10 секунд).
 
-    # Возвращает:
-    #     Optional[Server]: Объект Server, если сервер успешно развернут, иначе None.
-
-    # Логика работы:
-    # 1. Входит в бесконечный цикл, чтобы регулярно проверять статус сервера.
-    # 2. С помощью `asyncio.create_subprocess_exec` выполняет команду получения информации о сервере.
-    # 3. Если команда завершилась с ошибкой — выводит сообщение об ошибке и повторяет попытку через заданный интервал.
-    # 4. Если вывод команды некорректен или неполный — сообщает об этом и повторяет попытку позже.
-    # 5. Извлекает текущий статус сервера. Если статус `on`, то парсит данные и возвращает объект Server.
-    # 6. Если статус `installing`, ожидает и повторяет проверку через заданный интервал.
-    # 7. Если получен неожиданный статус — выводит предупреждение и повторяет попытку.
-    # 8. При возникновении исключения — выводит информацию об ошибке и повторяет попытку.
-
-    # Примечание: функция предполагает наличие класса `Server`.
-    # """
-    
-    while True:
+def parse_structured(text: str) -> dict:
+    """JSON (-o raw/json) или YAML (-o yaml); цветовая подсветка twc отбрасывается."""
+    text = ANSI_ESCAPE.sub("", text).strip()
+    if not text:
+        raise TwcParseError("twc вернул пустой вывод")
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as json_error:
         try:
-            proc = await asyncio.create_subprocess_exec(
-                'twc', 'server', 'get', str(server_id),
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await proc.communicate()
+            import yaml
+        except ImportError:
+            raise TwcParseError(f"вывод twc не JSON: {json_error}")
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise TwcParseError(f"вывод twc не JSON и не YAML: {e}")
+    if not isinstance(data, dict):
+        raise TwcParseError(f"ожидался объект, получено: {text[:80]!r}")
+    return data
+
+
+def parse_table(text: str) -> list[dict]:
+    """
+    Разбирает таблицу twc по позициям колонок заголовка, а не по пробелам:
+    twc выравнивает колонки ljust по ширине, поэтому значение колонки — это
+    срез строки от начала её заголовка до начала следующего. Так имена с
+    пробелами не сдвигают остальные поля. Строки приводятся к виду ответа API.
+    """
+    lines = [line for line in ANSI_ESCAPE.sub("", text).splitlines() if line.strip()]
+    if not lines:
+        raise TwcParseError("twc вернул пустую таблицу")
+    header = lines[0]
+    names = header.split()
+    if not {"ID", "STATUS"} <= set(names) or not set(names) <= set(TABLE_COLUMNS):
+        raise TwcParseError(f"неожиданный заголовок таблицы twc: {header!r}")
+    starts = [m.start() for m in re.finditer(r"\S+", header)]
+    bounds = list(zip(starts, starts[1:] + [None]))
+
+    servers = []
+    for line in lines[1:]:
+        row = {TABLE_COLUMNS[name]: line[start:end].strip() for name, (start, end) in zip(names, bounds)}
+        if not row["id"].isdigit():
+            raise TwcParseError(f"строка таблицы twc без числового ID: {line!r}")
+        ipv4 = row.pop("ipv4", None)
+        row["networks"] = [] if ipv4 in (None, "", "None") else [
+            {"type": "public", "ips": [{"type": "ipv4", "ip": ipv4, "is_main": True}]}
+        ]
+        servers.append(row)
+    return servers
+
+
+def _servers_from(data: dict, key: str):
+    try:
+        value = data[key]
+    except KeyError:
+        raise TwcParseError(f"в ответе twc нет поля {key!r}")
+    items = value if isinstance(value, list) else [value]
+    for srv in items:
+        if not isinstance(srv, dict) or "id" not in srv or "status" not in srv:
+            raise TwcParseError(f"сервер в ответе twc без id/status: {srv!r}")
+    return items
+
+
+def parse_server_list(text: str, output_format: str) -> dict[str, dict]:
+    """Вывод `twc server list` -> {ID: сервер в форме ответа API}."""
+    if output_format == "default":
+        servers = parse_table(text)
+    else:
+        servers = _servers_from(parse_structured(text), "servers")
+    return {str(srv["id"]): srv for srv in servers}
+
+
+def parse_server(text: str, output_format: str) -> dict:
+    """Вывод `twc server get` -> сервер в форме ответа API."""
+    if output_format == "default":
+        servers = parse_table(text)
+        if len(servers) != 1:
+            raise TwcParseError(f"ожидался один сервер, получено {len(servers)}")
+        return servers[0]
+    return _servers_from(parse_structured(text), "server")[0]
+
+
+def parse_created_id(text: str, output_format: str) -> str:
+    """ID из вывода `twc server create`: JSON-ответ или единственное число."""
+    if output_format != "default":
+        data = parse_structured(text).get("server")
+        if not isinstance(data, dict) or "id" not in data:
+            raise TwcParseError("в ответе twc server create нет server.id")
+        return str(data["id"])
+    value = ANSI_ESCAPE.sub("", text).strip()
+    if not value.isdigit():
+        raise TwcParseError(f"twc server create вернул не ID: {value[:80]!r}")
+    return value
+
+
+class TwcOutput:
+    """
+    Выбор формата вывода twc: структурированный (-o raw/json/yaml), пока CLI
+    его принимает, и таблица по умолчанию, если эта версия twc не знает --output.
+    """
+
+    def __init__(self, output_format: str = TWC_OUTPUT_FORMAT):
+        self.format = output_format
+
+    async def run(self, *args: str) -> tuple[str, str]:
+        """Возвращает (stdout, формат, в котором он получен)."""
+        if self.format == "default":
+            return await run_twc(*args), "default"
+        try:
+            return await run_twc(*args, "--output", self.format), self.format
+        except TwcError as e:
+            if "no such option" not in str(e).lower():
+                raise
+            print(f"twc не поддерживает --output, разбираем таблицы ({e})")
+            self.format = "default"
+            return await run_twc(*args), "default"
 
-            if proc.returncode != 0:
-                print(f"Ошибка выполнения команды: {stderr.decode().strip()}")
-                await asyncio.sleep(interval)
-                continue
 
-            output = stdout.decode().strip()
-            lines = output.splitlines()
+TWC_OUTPUT = TwcOutput()
 
-            if len(lines) < 2:
-                print("Не удалось получить данные о сервере. Повтор через 10 секунд.")
-                await asyncio.sleep(interval)
-                continue
 
-            status = lines[1].split()[3].lower()
-            print(f"Текущий статус: {status}")
+async def list_servers() -> dict[str, dict]:
+    """Один вызов `twc server list`: все серверы аккаунта по ID."""
+    output, output_format = await TWC_OUTPUT.run("server", "list", "--limit", str(LIST_LIMIT))
+    return parse_server_list(output, output_format)
 
-            if status == 'on':
-                headers = lines[0].split()
-                values = lines[1].split()
-                server_info = dict(zip(headers, values))
-                print('Сервер готов!')
-                print(server_info)
-                return Server(
-                    id=int(server_info['ID']),
-                    name=server_info['NAME'],
-                    ip=None if server_info['IPV4'] == 'None' else server_info['IPV4'],
-                    region=server_info['REGION'],
-                    status=server_info['STATUS']
-                )
 
-            elif status == 'installing':
-                await asyncio.sleep(interval)
-            else:
-                print(f"Неожиданный статус: {status}. Повтор через 10 секунд.")
-                await asyncio.sleep(interval)
+async def get_server(server_id: str) -> dict:
+    output, output_format = await TWC_OUTPUT.run("server", "get", str(server_id))
+    return parse_server(output, output_format)
 
-        except Exception as e:
-            print(f"Ошибка: {e}")
-            await asyncio.sleep(interval)
 
+async def find_server_id(full_name: str) -> Optional[str]:
+    """
+    Ищет уже существующий сервер с таким именем. Нужен для запуска после
+    прерывания, когда `server create` был отправлен, но его ID не успели сохранить.
+    """
+    for server_id, server in (await list_servers()).items():
+        if server.get("name") == full_name:
+            return server_id
+    return None
 
-async def create_and_monitor_server(i):
-    server_name = str(i)
+
+async def run_server(server_name: str) -> str:
+    """
+    Асинхронно запускает создание сервера с заданным именем и возвращает его ID.
+    При ошибке бросает TwcError; transient=True означает, что запрос можно повторить.
+    """
+    output, output_format = await TWC_OUTPUT.run(
+        "server", "create", "--name", f"{SERVER_NAME_PREFIX}{server_name}", *SERVER_CREATE_ARGS
+    )
+    server_id = parse_created_id(output, output_format)
+    print(f"Создан сервер {server_name} с ID: {server_id}")
+    return server_id
 
 
-    server_id = await run_server(server_name)
-    server = await get_server_info(server_id)
+async def create_with_retry(server_name: str, semaphore: asyncio.Semaphore, retries: int) -> str:
+    """
+    Создаёт сервер, удерживая слот семафора только на время самого вызова twc.
+    Временные ошибки повторяются с экспоненциальной задержкой и джиттером,
+    остальные пробрасываются сразу. Перед повтором сервер ищется по имени:
+    запрос мог дойти до API, а ошибка — прийти на ответ, и тогда повторный
+    create сделал бы дубликат.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            async with semaphore:
+                if attempt > 1:
+                    server_id = await find_server_id(f"{SERVER_NAME_PREFIX}{server_name}")
+                    if server_id:
+                        print(f"{server_name}: сервер уже создан прошлой попыткой, ID: {server_id}")
+                        return server_id
+                return await run_server(server_name)
+        except TwcError as e:
+            if not e.transient or attempt > retries:
+                raise
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+            delay *= random.uniform(0.5, 1.0)
+            print(f"{server_name}: временная ошибка ({e}), повтор {attempt}/{retries} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+
+def server_from_api(srv: dict) -> Server:
+    """Server из ответа API; IP — основной публичный IPv4."""
+    main_ipv4 = None
+    for network in srv.get("networks", []):
+        if network.get("type") == "public":
+            for addr in network.get("ips", []):
+                if addr.get("type") == "ipv4" and addr.get("is_main"):
+                    main_ipv4 = addr.get("ip")
+    return Server(
+        id=int(srv["id"]),
+        name=srv["name"],
+        ip=main_ipv4,
+        region=srv.get("location"),
+        status=srv["status"],
+    )
 
-        # Сохраняем IP в файл
-    async with asyncio.Lock():  # защищаем от одновременной записи
-        with open("ips.txt", "a") as f:
-            f.write(f"ssh root@{server.ip}\n")
 
+class PollTimeout(TimeoutError):
+    """Сервер не перешёл в статус `on` до общего таймаута опроса."""
+
+
+class StatusPoller:
+    """
+    Общий опросчик статусов: на каждом такте один `twc server list` на все
+    ожидаемые серверы вместо отдельного `twc server get` на каждый.
+
+    watch(id) возвращает future, который получает Server, когда сервер
+    переходит в `on`. Интервал начинается с initial и растёт в factor раз
+    за такт до max_interval (с джиттером); новый сервер сбрасывает его к
+    начальному. Если за timeout секунд с начала опроса сервер не готов,
+    его future завершается PollTimeout; при любой другой ошибке опроса все
+    ожидающие future получают её, и опросчик останавливается.
+    """
+
+    def __init__(self, initial: float = POLL_INITIAL_INTERVAL, max_interval: float = POLL_MAX_INTERVAL,
+                 factor: float = POLL_BACKOFF, jitter: float = POLL_JITTER, timeout: float = POLL_TIMEOUT):
+        self.initial = initial
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.timeout = timeout
+        self.pending: dict[str, asyncio.Future] = {}
+        self.statuses: dict[str, str] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.deadline = 0.0
+        self.ticks = 0
+        self.calls = 0
+
+    def watch(self, server_id) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        server_id = str(server_id)
+        future = self.pending.get(server_id)
+        if future is None:
+            future = self.pending[server_id] = loop.create_future()
+        self.ticks = 0
+        if self.task is None or self.task.done():
+            self.deadline = loop.time() + self.timeout
+            self.task = asyncio.create_task(self._run())
+        return future
+
+    def next_interval(self) -> float:
+        interval = min(self.max_interval, self.initial * self.factor ** self.ticks)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.pending:
+            remaining = self.deadline - loop.time()
+            if remaining <= 0:
+                for server_id in list(self.pending):
+                    self.fail(server_id, PollTimeout(
+                        f"сервер {server_id} не перешёл в on за {self.timeout:.0f} с"
+                    ))
+                return
+            await asyncio.sleep(min(self.next_interval(), remaining))
+            self.ticks += 1
+            try:
+                await self.poll_once()
+            except TwcError as e:
+                if e.transient:
+                    print(f"Временная ошибка опроса статусов: {e}")
+                    continue
+                # Неразбираемый вывод или отказ API не исправятся сами — не крутимся до таймаута
+                for server_id in list(self.pending):
+                    self.fail(server_id, e)
+                return
+            except Exception as e:
+                # Сбой самого опроса: без этого задача умерла бы молча, а ожидающие повисли бы навсегда
+                print(f"Опрос статусов остановлен из-за ошибки: {e!r}")
+                for server_id in list(self.pending):
+                    self.fail(server_id, e)
+                return
+
+    def fail(self, server_id: str, error: Exception):
+        future = self.pending.pop(server_id)
+        if not future.done():
+            future.set_exception(error)
+
+    async def poll_once(self):
+        for server_id in [i for i, f in self.pending.items() if f.done()]:
+            del self.pending[server_id]
+        if not self.pending:
+            return
+        servers = await list_servers()
+        self.calls += 1
+        missing = [i for i in self.pending if i not in servers]
+        # Сервер может не попасть в первую страницу списка — его спрашиваем отдельно
+        for server_id in missing:
+            self.calls += 1
+            try:
+                servers[server_id] = await get_server(server_id)
+            except TwcError as e:
+                if e.transient or isinstance(e, TwcParseError):
+                    raise
+                self.fail(server_id, e)   # например, 404: сервер удалён
+
+        for server_id, future in list(self.pending.items()):
+            srv = servers[server_id]
+            status = str(srv.get("status", "")).lower()
+            if self.statuses.get(server_id) != status:
+                print(f"Сервер {server_id}: статус {status}")
+                self.statuses[server_id] = status
+            if status == "on":
+                server = server_from_api(srv)   # до удаления из pending: ошибка разбора должна дойти до future
+                del self.pending[server_id]
+                if not future.done():
+                    future.set_result(server)
+
+
+async def get_server_info(server_id: str, poller: StatusPoller) -> Server:
+    """
+    Ждёт, пока сервер перейдёт в статус `on`, и возвращает его как Server.
+    Сам опрос выполняет общий StatusPoller; при истечении его таймаута
+    бросается PollTimeout, при неразбираемом выводе twc — TwcParseError.
+    """
+    return await poller.watch(server_id)
+
+
+async def create_and_monitor_server(server_name: str, state: FleetState, semaphore: asyncio.Semaphore,
+                                    poller: StatusPoller, retries: int) -> dict:
+    """
+    Доводит один сервер до состояния `ready` и возвращает его запись из state.
+    Уже готовые серверы пропускаются, заказанные ранее — только дожидаются.
+    """
+    entry = state.get(server_name)
+    if entry.get("status") == "ready":
+        return entry
+
+    server_id = entry.get("id")
+    try:
+        if not server_id and entry:
+            # Прошлая попытка оборвалась между запросом и ответом: сервер мог быть создан
+            server_id = await find_server_id(f"{SERVER_NAME_PREFIX}{server_name}")
+        if not server_id:
+            await state.update(server_name, status="creating", error=None)
+            server_id = await create_with_retry(server_name, semaphore, retries)
+        await state.update(server_name, status="created", id=server_id, error=None)
+    except TwcError as e:
+        print(f"{server_name}: не удалось создать сервер: {e}")
+        return await state.update(server_name, status="failed", error=str(e))
+
+    try:
+        server = await get_server_info(server_id, poller)
+    except (PollTimeout, TwcError) as e:
+        return await state.update(server_name, status="failed", error=str(e))
+    if not server.ip:
+        return await state.update(server_name, status="failed", error="сервер не получил IPv4")
+    return await state.update(
+        server_name, status="ready", id=str(server.id), ip=server.ip,
+        region=server.region, error=None,
+    )
 
-async def main():
-    tasks = [create_and_monitor_server(i) for i in range(1, 4)]
-    await asyncio.gather(*tasks)
 
-# Запуск
-asyncio.run(main())
\ No newline at end of file
+def write_inventory(path: Path, names: list[str], state: FleetState):
+    """Пишет inventory.json: готовые серверы с IP и список неудавшихся."""
+    servers, failed = [], []
+    for name in names:
+        entry = state.get(name)
+        record = {"name": name, **entry}
+        (servers if entry.get("status") == "ready" else failed).append(record)
+    with TRACER.span("file", lambda: f"write {path.name}") as span:
+        text = json.dumps({"servers": servers, "failed": failed}, indent=2, ensure_ascii=False)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(text)
+        os.replace(tmp, path)
+        span.set(out_bytes=len(text))
+    return servers, failed
+
+
+def parse_names(args) -> list[str]:
+    if args.names:
+        names = [n.strip() for n in args.names.split(",") if n.strip()]
+    else:
+        names = [str(i) for i in range(1, args.count + 1)]
+    if len(set(names)) != len(names):
+        sys.exit("Имена серверов не должны повторяться")
+    return names
+
+
+async def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Развёртывание флота мастер-серверов через twc")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--count", type=int, default=3,
+                        help="сколько серверов создать (имена 1..N)")
+    target.add_argument("--names", help="имена серверов через запятую")
+    parser.add_argument("--concurrency", type=int, default=CREATE_CONCURRENCY,
+                        help="максимум одновременных `twc server create`")
+    parser.add_argument("--retries", type=int, default=CREATE_RETRIES,
+                        help="повторов при временных ошибках API")
+    parser.add_argument("--poll-timeout", type=float, default=POLL_TIMEOUT,
+                        help="сколько секунд ждать статуса on для всего флота")
+    parser.add_argument("--state", type=Path, default=FLEET_STATE_FILE)
+    parser.add_argument("--inventory", type=Path, default=INVENTORY_FILE)
+    parser.add_argument("--trace", nargs="?", type=Path, const=TRACE_FILE,
+                        help="писать спаны вызовов twc в JSONL (по умолчанию %(const)s) и печатать сводку")
+    args = parser.parse_args(argv)
+
+    trace = args.trace
+    if trace is None and TRACE_ENV not in ("", "0"):
+        trace = TRACE_FILE if TRACE_ENV == "1" else Path(TRACE_ENV)
+    if trace:
+        TRACER.enable(trace, "deploy")
+
+    names = parse_names(args)
+    state = FleetState(args.state)
+    semaphore = asyncio.Semaphore(max(args.concurrency, 1))
+    poller = StatusPoller(timeout=args.poll_timeout)
+    await asyncio.gather(*(
+        create_and_monitor_server(name, state, semaphore, poller, args.retries) for name in names
+    ))
+
+    servers, failed = write_inventory(args.inventory, names, state)
+    print(f"Готово: {len(servers)}, с ошибкой: {len(failed)}, запросов статуса: {poller.calls}. "
+          f"Инвентарь: {args.inventory}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Версионированный бандл для быстрой подготовки ноды без сети на критическом пути.
+
+Сборка (на машине оператора, нужен docker с доступом к образу):
+    python3 node_bundle.py build [--out bundles] [--no-image] [--requirement PKG ...]
+
+В бандл (bundles/vless-node-<версия>.tar.gz) входят скрипты, wheelhouse с
+зависимостями и `docker save` образа Xray; версия — хэш содержимого. Рядом
+пишется manifest.json с хэшами каждой группы файлов.
+
+Установка (на ноде, из локального файла):
+    python3 node_bundle.py install <бандл.tar.gz> [--dest DIR] [--hostname NAME]
+
+Каждый шаг (scripts, wheels, image, hostname) пропускается, если его хэш
+совпадает с записанным в DIR/.vless-bundle.json после прошлой установки.
+В конце печатается время каждой фазы.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+# -------------------------------------------------------------------
+#  Константы и пути
+# -------------------------------------------------------------------
+BASE_DIR = Path(__file__).parent.resolve()
+BUNDLE_DIR = BASE_DIR / "bundles"
+BUNDLE_PREFIX = "vless-node-"
+
+# Файлы, которые копируются на ноду: путь в репозитории -> имя в бандле
+BUNDLE_SCRIPTS = {
+    "vless_manager.py": "vless_manager.py",
+    "start.py/change_hostname.py": "change_hostname.py",
+    "node_bundle.py": "node_bundle.py",
+}
+# Python-зависимости скриптов на ноде (ставятся из wheelhouse без обращения к PyPI);
+# сейчас скрипты обходятся стандартной библиотекой
+BUNDLE_REQUIREMENTS: list[str] = []
+
+XRAY_IMAGE = os.getenv("XRAY_IMAGE", "teddysun/xray")
+DOCKER_BIN = os.getenv("DOCKER_BIN", "docker")
+
+# Что уже установлено на ноде: {"version": ..., "steps": {шаг: хэш}}
+INSTALL_STATE_NAME = ".vless-bundle.json"
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def group_hash(files: dict[str, str]) -> str:
+    """Хэш группы файлов по их путям и хэшам; пустая группа — пустая строка."""
+    if not files:
+        return ""
+    digest = hashlib.sha256()
+    for name in sorted(files):
+        digest.update(f"{name}\0{files[name]}\n".encode())
+    return digest.hexdigest()
+
+
+def run(cmd: list[str], **kwargs) -> subprocess.CompletedProcess:
+    result = subprocess.run(cmd, capture_output=True, text=True, **kwargs)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)}: {result.stderr.strip() or result.stdout.strip()}")
+    return result
+
+
+class PhaseTimer:
+    """Время и результат каждой фазы: [(фаза, done|skipped, секунды)]."""
+
+    def __init__(self):
+        self.phases: list[tuple[str, str, float]] = []
+
+    def record(self, phase: str, started: float, skipped: bool = False):
+        self.phases.append((phase, "skipped" if skipped else "done", time.monotonic() - started))
+
+    def print(self):
+        rows = [["PHASE", "RESULT", "SECONDS"]]
+        rows += [[name, result, f"{seconds:.2f}"] for name, result, seconds in self.phases]
+        rows.append(["total", "", f"{sum(s for _, _, s in self.phases):.2f}"])
+        widths = [max(map(len, col)) for col in zip(*rows)]
+        for row in rows:
+            print("  ".join(val.ljust(width) for val, width in zip(row, widths)).rstrip())
+
+
+# -------------------------------------------------------------------
+#  Сборка
+# -------------------------------------------------------------------
+def build_bundle(out_dir: Path, requirements: list[str], with_image: bool = True) -> Path:
+    """Собирает бандл и возвращает путь к архиву."""
+    timer = PhaseTimer()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        groups: dict[str, dict[str, str]] = {"scripts": {}, "wheels": {}, "image": {}}
+
+        started = time.monotonic()
+        (root / "scripts").mkdir()
+        for source, name in BUNDLE_SCRIPTS.items():
+            shutil.copy2(BASE_DIR / source, root / "scripts" / name)
+            groups["scripts"][f"scripts/{name}"] = file_sha256(root / "scripts" / name)
+        timer.record("scripts", started)
+
+        started = time.monotonic()
+        wheelhouse = root / "wheelhouse"
+        wheelhouse.mkdir()
+        if requirements:
+            (wheelhouse / "requirements.txt").write_text("\n".join(requirements) + "\n")
+            run([sys.executable, "-m", "pip", "download", "--quiet", "--only-binary=:all:",
+                 "-d", str(wheelhouse), "-r", str(wheelhouse / "requirements.txt")])
+            for path in wheelhouse.iterdir():
+                groups["wheels"][f"wheelhouse/{path.name}"] = file_sha256(path)
+        timer.record("wheels", started, skipped=not requirements)
+
+        started = time.monotonic()
+        if with_image:
+            (root / "images").mkdir()
+            run([DOCKER_BIN, "pull", XRAY_IMAGE])
+            run([DOCKER_BIN, "save", "-o", str(root / "images" / "xray.tar"), XRAY_IMAGE])
+            groups["image"]["images/xray.tar"] = file_sha256(root / "images" / "xray.tar")
+        timer.record("image", started, skipped=not with_image)
+
+        started = time.monotonic()
+        hashes = {group: group_hash(files) for group, files in groups.items()}
+        version = group_hash({g: h for g, h in hashes.items() if h})[:12]
+        manifest = {
+            "version": version,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "image": XRAY_IMAGE if with_image else None,
+            "hashes": hashes,
+            "files": {name: sha for files in groups.values() for name, sha in files.items()},
+        }
+        (root / "manifest.json").write_text(json.dumps(manifest, indent=2))
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        bundle = out_dir / f"{BUNDLE_PREFIX}{version}.tar.gz"
+        tmp_bundle = bundle.with_name(bundle.name + ".tmp")
+        with tarfile.open(tmp_bundle, "w:gz") as tar:
+            for path in sorted(root.iterdir()):
+                tar.add(path, arcname=path.name)
+        os.replace(tmp_bundle, bundle)
+        timer.record("archive", started)
+
+    timer.print()
+    print(bundle)
+    return bundle
+
+
+# -------------------------------------------------------------------
+#  Установка на ноде
+# -------------------------------------------------------------------
+def load_install_state(dest: Path) -> dict:
+    try:
+        return json.loads((dest / INSTALL_STATE_NAME).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"version": None, "steps": {}}
+
+
+def save_install_state(dest: Path, state: dict):
+    tmp = dest / (INSTALL_STATE_NAME + ".tmp")
+    tmp.write_text(json.dumps(state, indent=2))
+    os.replace(tmp, dest / INSTALL_STATE_NAME)
+
+
+def install_bundle(bundle: Path, dest: Path, hostname: Optional[str] = None) -> dict:
+    """
+    Устанавливает бандл в dest. Шаги с тем же хэшем, что и в прошлый раз,
+    пропускаются; состояние сохраняется после каждого шага, поэтому
+    прерванная установка продолжается с невыполненного.
+    """
+    timer = PhaseTimer()
+    dest.mkdir(parents=True, exist_ok=True)
+    state = load_install_state(dest)
+    steps = state.setdefault("steps", {})
+
+    def done(step: str, value: str):
+        steps[step] = value
+        save_install_state(dest, state)
+
+    with tempfile.TemporaryDirectory(dir=dest) as tmp:
+        root = Path(tmp)
+        started = time.monotonic()
+        with tarfile.open(bundle) as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(root, filter="data")
+            else:
+                tar.extractall(root)
+        manifest = json.loads((root / "manifest.json").read_text())
+        for name, sha in manifest["files"].items():
+            if file_sha256(root / name) != sha:
+                raise RuntimeError(f"бандл повреждён: не совпал хэш {name}")
+        timer.record("extract", started)
+        hashes = manifest["hashes"]
+
+        started = time.monotonic()
+        skip = steps.get("scripts") == hashes["scripts"]
+        if not skip:
+            for path in (root / "scripts").iterdir():
+                target = dest / path.name
+                shutil.copy2(path, target.with_name(target.name + ".tmp"))
+                os.replace(target.with_name(target.name + ".tmp"), target)
+            done("scripts", hashes["scripts"])
+        timer.record("scripts", started, skipped=skip)
+
+        started = time.monotonic()
+        skip = not hashes["wheels"] or steps.get("wheels") == hashes["wheels"]
+        if not skip:
+            wheelhouse = root / "wheelhouse"
+            run([sys.executable, "-m", "pip", "install", "--quiet", "--no-index",
+                 "--find-links", str(wheelhouse), "-r", str(wheelhouse / "requirements.txt")])
+            done("wheels", hashes["wheels"])
+        timer.record("wheels", started, skipped=skip)
+
+        started = time.monotonic()
+        skip = not hashes["image"] or steps.get("image") == hashes["image"]
+        if not skip:
+            run([DOCKER_BIN, "load", "-i", str(root / "images" / "xray.tar")])
+            done("image", hashes["image"])
+        timer.record("image", started, skipped=skip)
+
+    started = time.monotonic()
+    skip = not hostname or steps.get("hostname") == hostname
+    if not skip:
+        run([sys.executable, str(dest / "change_hostname.py"), hostname])
+        done("hostname", hostname)
+    timer.record("hostname", started, skipped=skip)
+
+    state["version"] = manifest["version"]
+    save_install_state(dest, state)
+    print(f"Бандл {manifest['version']} установлен в {dest}")
+    timer.print()
+    return state
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Сборка и установка бандла ноды")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="собрать бандл")
+    build.add_argument("--out", type=Path, default=BUNDLE_DIR)
+    build.add_argument("--no-image", action="store_true", help="не включать образ Xray")
+    build.add_argument("--requirement", action="append",
+                       help="зависимость для wheelhouse (по умолчанию: %s)" % (", ".join(BUNDLE_REQUIREMENTS) or "нет"))
+
+    install = sub.add_parser("install", help="установить бандл на этой ноде")
+    install.add_argument("bundle", type=Path)
+    install.add_argument("--dest", type=Path, default=Path.home())
+    install.add_argument("--hostname", help="имя хоста (через change_hostname.py)")
+
+    args = parser.parse_args(argv)
+    try:
+        if args.command == "build":
+            requirements = BUNDLE_REQUIREMENTS if args.requirement is None else args.requirement
+            build_bundle(args.out, [r for r in requirements if r], with_image=not args.no_image)
+        else:
+            install_bundle(args.bundle, args.dest, args.hostname)
+    except (RuntimeError, OSError, tarfile.TarError) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
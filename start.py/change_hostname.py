@@ -1,50 +1,137 @@
-import asyncio
-import aiofiles
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Смена имени хоста: /etc/hostname, /etc/hosts и имя в ядре/systemd.
+
+    python3 change_hostname.py <новое_имя_хоста> [ip-адрес] [--root DIR]
+
+Файлы пишутся атомарно (временный файл в том же каталоге + rename) и только
+если их содержимое меняется. Параллельные запуски на одном корне
+сериализуются блокировкой, поэтому скрипт можно вызывать из оркестратора
+без внешней синхронизации. С --root (или CHANGE_HOSTNAME_ROOT) правятся
+файлы внутри другого корня, а системные команды не запускаются.
+"""
+
 import os
 import sys
+import fcntl
+import shutil
+import socket
+import tempfile
+import subprocess
+from pathlib import Path
+from contextlib import contextmanager
+
+DEFAULT_IP = "127.0.1.1"
+ROOT = Path(os.getenv("CHANGE_HOSTNAME_ROOT", "/"))
 
-async def set_hostname(new_hostname, ip_address="127.0.1.1"):
-    # Установить новое имя хоста
-    await asyncio.create_subprocess_shell(f"hostnamectl set-hostname {new_hostname}")
 
-    # Записать новое имя хоста в /etc/hostname
-    async with aiofiles.open("/etc/hostname", "w") as f:
-        await f.write(new_hostname + "\n")
+@contextmanager
+def hostname_lock(root: Path):
+    lock_path = root / "run" / "lock" / "change_hostname.lock"
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
 
-    # Прочитать текущий /etc/hosts
-    async with aiofiles.open("/etc/hosts", "r") as f:
-        lines = await f.readlines()
 
-    # Подготовить новые строки
+def write_atomic(path: Path, content: str) -> bool:
+    """Записывает файл через временный файл и rename; False, если менять нечего."""
+    try:
+        if path.read_text() == content:
+            return False
+        mode = path.stat().st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o644
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+def render_hosts(lines: list[str], new_hostname: str, ip_address: str) -> str:
+    """Новый /etc/hosts: старые записи этого имени и 127.0.1.1 заменяются одной строкой."""
     new_lines = []
     for line in lines:
-        if "127.0.0.1" in line and "localhost" in line:
+        fields = line.split("#", 1)[0].split()
+        if "127.0.0.1" in fields and "localhost" in fields:
             new_lines.append("127.0.0.1\tlocalhost\n")
-        elif new_hostname in line or "127.0.1.1" in line:
+        elif fields and (fields[0] == DEFAULT_IP or new_hostname in fields[1:]):
             continue  # Удалим старые упоминания
         else:
-            new_lines.append(line)
+            new_lines.append(line if line.endswith("\n") else line + "\n")
     new_lines.append(f"{ip_address}\t{new_hostname}\n")
+    return "".join(new_lines)
+
 
-    # Перезаписать /etc/hosts
-    async with aiofiles.open("/etc/hosts", "w") as f:
-        await f.writelines(new_lines)
+def run(cmd: list[str]):
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)}: {result.stderr.strip() or result.stdout.strip()}")
+
+
+def apply_hostname(new_hostname: str):
+    """Применяет имя к работающей системе: через hostnamed, если он есть, иначе через hostname."""
+    if socket.gethostname() == new_hostname:
+        return
+    if shutil.which("hostnamectl"):
+        run(["hostnamectl", "set-hostname", new_hostname])
+    else:
+        run(["hostname", "-F", "/etc/hostname"])
+
+
+def set_hostname(new_hostname: str, ip_address: str = DEFAULT_IP, root: Path = ROOT) -> bool:
+    """
+    Устанавливает имя хоста внутри root. Системные команды выполняются только
+    для корня "/". Возвращает True, если хотя бы один файл изменился.
+    """
+    etc = root / "etc"
+    with hostname_lock(root):
+        changed = write_atomic(etc / "hostname", new_hostname + "\n")
+        try:
+            lines = (etc / "hosts").read_text().splitlines(keepends=True)
+        except FileNotFoundError:
+            lines = []
+        changed |= write_atomic(etc / "hosts", render_hosts(lines, new_hostname, ip_address))
+        if root.resolve() == Path("/"):
+            apply_hostname(new_hostname)
+    return changed
 
-    # Применить изменения
-    await asyncio.create_subprocess_shell("hostname -F /etc/hostname")
-    await asyncio.create_subprocess_shell("systemctl restart systemd-hostnamed")
 
 # Запуск из командной строки
 if __name__ == "__main__":
-    if os.geteuid() != 0:
+    args = sys.argv[1:]
+    root = ROOT
+    if "--root" in args:
+        i = args.index("--root")
+        if i + 1 >= len(args):
+            print("Опция --root требует каталог")
+            sys.exit(1)
+        root = Path(args[i + 1])
+        del args[i:i + 2]
+
+    if root.resolve() == Path("/") and os.geteuid() != 0:
         print("Этот скрипт нужно запускать с правами root.")
         sys.exit(1)
 
-    if len(sys.argv) < 2:
-        print("Использование: python3 script.py <новое_имя_хоста> [ip-адрес]")
+    if not args:
+        print("Использование: python3 change_hostname.py <новое_имя_хоста> [ip-адрес] [--root DIR]")
         sys.exit(1)
 
-    hostname = sys.argv[1]
-    ip = sys.argv[2] if len(sys.argv) > 2 else "127.0.1.1"
+    hostname = args[0]
+    ip = args[1] if len(args) > 1 else DEFAULT_IP
 
-    asyncio.run(set_hostname(hostname, ip))
+    try:
+        set_hostname(hostname, ip, root)
+    except (OSError, RuntimeError) as e:
+        print(f"Ошибка: {e}")
+        sys.exit(1)
@@ -1,13 +1,19 @@
 #!/bin/sh
+set -e
+# Каждый файл скачивается во временный и переименовывается: повторный запуск
+# перезаписывает его, а не создаёт file.1, и оборванная загрузка не оставляет половину файла
+REPO_URL=https://raw.githubusercontent.com/dhsxvrozq/test_deploy/refs/heads/master
+download() {
+    wget -q -O "$1.tmp" "$REPO_URL/$2"
+    mv -f "$1.tmp" "$1"
+}
 apt update && apt upgrade -y
-wget https://raw.githubusercontent.com/dhsxvrozq/test_deploy/refs/heads/master/start.py/change_hostname.py
+download change_hostname.py start.py/change_hostname.py
 chmod +x change_hostname.py
-wget https://raw.githubusercontent.com/dhsxvrozq/test_deploy/refs/heads/master/.env
+download .env .env
 chmod 777 .env
-source .env
+. ./.env
 export $(cat .env | xargs)
-apt install -y python3-pip 
-pip install aiofiles
 python3 change_hostname.py "$SERVER_NAME" 127.0.1.1
-wget https://raw.githubusercontent.com/dhsxvrozq/test_deploy/refs/heads/master/vless_manager.py
-chmod +x vless_manager.py
\ No newline at end of file
+download vless_manager.py vless_manager.py
+chmod +x vless_manager.py
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Общие фикстуры: vless_manager.py с состоянием во временном каталоге и
+заглушками из tools/ (fake_dockerd, fake_xray_api) вместо настоящих Docker и Xray.
+"""
+
+import sys
+import types
+from pathlib import Path
+from dataclasses import dataclass
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+TOOLS_DIR = REPO_DIR / "tools"
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(TOOLS_DIR))
+
+try:
+    import objects.models  # noqa: F401
+except ImportError:
+    # deploy_master.py берёт модель Server из проекта (objects.models), которого в этом
+    # репозитории нет; для тестов хватает модели с теми же полями
+    @dataclass
+    class Server:
+        id: int
+        name: str
+        ip: str | None
+        region: str | None
+        status: str
+
+    _models = types.ModuleType("objects.models")
+    _models.Server = Server
+    _objects = types.ModuleType("objects")
+    _objects.models = _models
+    sys.modules.update({"objects": _objects, "objects.models": _models})
+
+import vless_manager  # noqa: E402
+from fake_dockerd import FakeDockerDaemon  # noqa: E402
+
+NODES = ["node-1", "node-2", "node-3"]
+
+
+@pytest.fixture
+def dockerd(tmp_path):
+    """Заглушка Docker Engine API на Unix-сокете во временном каталоге."""
+    daemon = FakeDockerDaemon(str(tmp_path / "docker.sock"), nodes=",".join(NODES)).start()
+    yield daemon
+    daemon.stop()
+
+
+@pytest.fixture
+def vm(tmp_path, dockerd, monkeypatch):
+    """
+    vless_manager, переключённый на временный каталог и бэкенд api поверх dockerd.
+    Отложенная фоновая очистка не запускается.
+    """
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{dockerd.socket_path}")
+    patches = {
+        "PORTS": vless_manager.PortAllocator(tmp_path / "ports.bitmap"),
+        "STORE": vless_manager.StateStore(tmp_path / "state.db"),
+        "DOCKER": vless_manager.DockerEngineAPI(socket_path=dockerd.socket_path),
+        "USED_PORTS_FILE": tmp_path / "used_ports.txt",
+        "SHARDS_FILE": tmp_path / "shards.json",
+        "SHARD_CONFIGS_DIR": tmp_path / "shards",
+        "SINGLE_STATE_FILE": tmp_path / "single.json",
+        "SINGLE_CONFIG_FILE": tmp_path / "config.json",
+        "SINGLE_USERS_FILE": tmp_path / "users.json",
+        "NODE_STATS_FILE": tmp_path / "node_stats.json",
+        "CLEANUP_STAMP_FILE": tmp_path / "cleanup.stamp",
+        "CLEANUP_LOG_FILE": tmp_path / "cleanup.log",
+    }
+    for name, value in patches.items():
+        monkeypatch.setattr(vless_manager, name, value)
+    monkeypatch.setattr(vless_manager, "schedule_cleanup", lambda: False)
+    return vless_manager
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""add-many: пакетное создание, повторный запуск и уже существующие пользователи."""
+
+import json
+
+import pytest
+
+
+def run(vm, capsys, entries, **kwargs) -> tuple[int, dict[str, dict]]:
+    failed = vm.add_many(entries, **kwargs)
+    records = {r["username"]: r for r in map(json.loads, capsys.readouterr().out.splitlines())}
+    return failed, records
+
+
+def test_batch_gets_unique_ports(vm, dockerd, capsys):
+    failed, records = run(vm, capsys, [("alice", None), ("bob", "node-2"), ("alice", None), ("carol", None)])
+    assert failed == 1 and records["alice"]["link"]   # повтор в списке — ошибка, первый alice создан
+    ports = sorted(record["port"] for name, record in records.items() if "link" in record)
+    assert ports == vm.PORTS.used() and len(set(ports)) == 3
+    assert vm.actual_user_state()["bob"]["node"] == "node-2"
+
+
+def test_existing_user_keeps_port_and_link(vm, dockerd, capsys):
+    _, first = run(vm, capsys, [("carol", None)])
+    mutations = dockerd.state.mutations
+
+    failed, again = run(vm, capsys, [("carol", None), ("dave", None)])
+    assert failed == 0
+    assert again["carol"]["link"] == first["carol"]["link"]
+    assert again["carol"]["port"] == first["carol"]["port"]
+    assert vm.PORTS.used() == sorted([first["carol"]["port"], again["dave"]["port"]])
+    # carol не изменилась — все записи в Docker только ради dave
+    assert "vless-carol" in dockerd.state.services
+    dave_mutations = dockerd.state.mutations - mutations
+    run(vm, capsys, [("carol", None)])
+    assert dockerd.state.mutations - mutations == dave_mutations
+
+    # Явная нода переносит существующий сервис, порт тот же
+    _, moved = run(vm, capsys, [("carol", "node-3")])
+    assert moved["carol"]["port"] == first["carol"]["port"]
+    assert vm.actual_user_state()["carol"]["node"] == "node-3"
+
+
+def test_existing_user_failure_keeps_port(vm, dockerd, capsys, monkeypatch):
+    _, first = run(vm, capsys, [("carol", "node-1")])
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("Swarm недоступен")
+
+    monkeypatch.setattr(vm, "create_service", broken)
+    failed, records = run(vm, capsys, [("carol", "node-2")])
+    assert failed == 1 and "Swarm недоступен" in records["carol"]["error"]
+    assert vm.PORTS.used() == [first["carol"]["port"]]
+    assert vm.STORE.get_user("carol")["port"] == first["carol"]["port"]
+
+
+@pytest.mark.parametrize("mode", ["shared", "single"])
+def test_client_of_shared_service_is_not_duplicated(vm, dockerd, capsys, mode):
+    if mode == "shared":
+        vm.add_shared_users([("erin", "node-1")])
+    else:
+        vm.add_single_users(["erin"])
+    used, mutations = vm.PORTS.used(), dockerd.state.mutations
+
+    failed, records = run(vm, capsys, [("erin", None)])
+    assert failed == 1 and "уже есть" in records["erin"]["error"]
+    assert vm.PORTS.used() == used and dockerd.state.mutations == mutations
+    assert "vless-erin" not in dockerd.state.services
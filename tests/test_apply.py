@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+DESIRED = {
+    "nodes": {"node-1": ["alice"], "node-2": [{"name": "bob"}]},
+    "users": ["carol", {"name": "dave", "mode": "shared"}],
+}
+
+
+@pytest.fixture
+def desired_file(tmp_path):
+    path = tmp_path / "users.json"
+    path.write_text(json.dumps(DESIRED))
+    return path
+
+
+def test_rerun_with_same_file_makes_no_changes(vm, dockerd, desired_file, capsys):
+    assert vm.apply_desired_state(str(desired_file), workers=4) == 0
+    assert vm.actual_user_state() == {
+        "alice": {"mode": "service", "node": "node-1"},
+        "bob": {"mode": "service", "node": "node-2"},
+        "carol": {"mode": "service", "node": vm.actual_user_state()["carol"]["node"]},
+        "dave": {"mode": "shared", "node": None},
+    }
+    capsys.readouterr()
+
+    mutations = dockerd.state.mutations
+    assert vm.apply_desired_state(str(desired_file), workers=4) == 0
+    assert dockerd.state.mutations == mutations
+    assert "Изменений нет" in capsys.readouterr().out
+
+
+def test_failure_rolls_back_and_skips_deletes(vm, dockerd, desired_file, monkeypatch, capsys):
+    vm.provision_user("erin", vm.get_next_port(), vm.generate_x25519_keys(), "node-3")   # не в файле — delete
+    ports_before = vm.PORTS.used()
+    create_service = vm.create_service
+
+    def failing_create_service(username, *args, **kwargs):
+        if username == "bob":
+            raise RuntimeError("node-2 недоступна")
+        return create_service(username, *args, **kwargs)
+
+    monkeypatch.setattr(vm, "create_service", failing_create_service)
+    assert vm.apply_desired_state(str(desired_file), workers=4) == 1
+
+    records = {r["username"]: r for r in map(json.loads, capsys.readouterr().out.splitlines())}
+    assert "node-2 недоступна" in records["bob"]["error"]
+    assert records["alice"]["rolled_back"] and records["carol"]["rolled_back"] and records["dave"]["rolled_back"]
+    assert records["erin"]["skipped"]
+
+    assert vm.actual_user_state() == {"erin": {"mode": "service", "node": "node-3"}}
+    assert [u["username"] for u in vm.STORE.list_users()] == ["erin"]
+    assert vm.PORTS.used() == ports_before
+    assert set(dockerd.state.configs) == {c for s in vm.list_vless_services().values() for c in s["configs"]}
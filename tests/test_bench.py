@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""tools/bench_control_plane.py: сравнение с --baseline и код возврата при регрессии."""
+
+import sys
+import json
+import subprocess
+
+import pytest
+
+import bench_control_plane as bench
+from conftest import TOOLS_DIR
+
+
+def operation(p50_ms: float) -> dict:
+    return {"count": 10, "total_s": 0.01, "ops_per_s": 1000.0, "mean_ms": p50_ms,
+            "p50_ms": p50_ms, "p95_ms": p50_ms, "p99_ms": p50_ms, "max_ms": p50_ms}
+
+
+@pytest.fixture
+def measured(tmp_path, monkeypatch):
+    """Подменяет прогон масштаба заданными p50; результаты пишутся во временный каталог."""
+    timings = {}
+    monkeypatch.setattr(bench, "RESULTS_DIR", tmp_path / "bench-results")
+    monkeypatch.setattr(bench, "run_scale", lambda users, latency, backend: {
+        "users": users, "docker_requests": 0,
+        "operations": {op: operation(p50) for op, p50 in timings.items()},
+    })
+    return timings
+
+
+def baseline(tmp_path, operations: dict[str, float], **fields) -> str:
+    report = {"backend": "api", "latency_ms": 0.0, **fields,
+              "scales": {"10": {"operations": {op: operation(p50) for op, p50 in operations.items()}}}}
+    path = tmp_path / "baseline.json"
+    path.write_text(json.dumps(report))
+    return str(path)
+
+
+def test_regression_fails_run(measured, tmp_path, capsys):
+    measured.update(provision_user=2.0, migrate_user=1.0, user_link=0.001)
+    old = baseline(tmp_path, {"provision_user": 1.0, "migrate_user": 1.0, "user_link": 0.0001})
+    assert bench.main(["--scales", "10", "--baseline", old]) == 1
+    out = capsys.readouterr().out
+    assert "10/provision_user" in out
+    assert "10/migrate_user" not in out
+    assert "10/user_link" not in out   # в 10 раз медленнее, но разница — шум
+    # Без --out результат ложится в RESULTS_DIR (он в .gitignore)
+    assert len(list((tmp_path / "bench-results").glob("control-plane-*.json"))) == 1
+
+
+def test_threshold_and_unknown_operations(measured, tmp_path, capsys):
+    measured.update(provision_user=2.0, new_operation=5.0)
+    old = baseline(tmp_path, {"provision_user": 1.0, "dropped_operation": 1.0})
+    assert bench.main(["--scales", "10", "--out", str(tmp_path / "r.json"),
+                       "--baseline", old, "--threshold", "2.5"]) == 0
+    assert "регрессия" not in capsys.readouterr().out
+
+
+def test_incomparable_runs_are_reported(measured, tmp_path, capsys):
+    measured.update(provision_user=1.0)
+    old = baseline(tmp_path, {"provision_user": 1.0}, backend="cli")
+    assert bench.main(["--scales", "10", "--out", str(tmp_path / "r.json"), "--baseline", old]) == 0
+    assert "несравнимы: backend" in capsys.readouterr().out
+
+
+def test_real_run_against_itself(tmp_path):
+    script = str(TOOLS_DIR / "bench_control_plane.py")
+    first = tmp_path / "first.json"
+    subprocess.run([sys.executable, script, "--scales", "3", "--out", str(first)],
+                   check=True, capture_output=True, timeout=60)
+    operations = json.loads(first.read_text())["scales"]["3"]["operations"]
+    assert {"provision_user", "migrate_user", "discard_user"} <= set(operations)
+    done = subprocess.run([sys.executable, script, "--scales", "3", "--out", str(tmp_path / "second.json"),
+                           "--baseline", str(first), "--threshold", "1000"],
+                          capture_output=True, text=True, timeout=60)
+    assert done.returncode == 0, done.stdout + done.stderr
+    assert "provision_user" in done.stdout
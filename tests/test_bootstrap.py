@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+bootstrap_nodes.py через tools/fake_ssh.py: каждый хост — отдельный HOME,
+change_hostname.py пишет etc/hostname внутри него (CHANGE_HOSTNAME_ROOT).
+"""
+
+import os
+import json
+import shutil
+import asyncio
+
+import pytest
+
+import bootstrap_nodes
+from conftest import REPO_DIR, TOOLS_DIR
+
+# start.sh без сети: .env и change_hostname.py берутся так же, как их скачивает настоящий скрипт
+OFFLINE_START = f"""#!/bin/bash
+cp {REPO_DIR / "start.py" / "change_hostname.py"} change_hostname.py
+echo 'SERVER_NAME="master1"' > .env
+source .env
+export $(cat .env | xargs)
+python3 change_hostname.py "$SERVER_NAME" 127.0.1.1
+"""
+
+HOSTS = {"node-a": "10.0.0.1", "node-b": "10.0.0.2", "node-c": "10.0.0.3"}
+
+
+@pytest.fixture
+def fleet(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_SSH_ROOT", str(tmp_path / "hosts"))
+    monkeypatch.setenv("CHANGE_HOSTNAME_ROOT", "fsroot")   # относительно HOME хоста
+    monkeypatch.setattr(bootstrap_nodes, "SSH_BIN", str(TOOLS_DIR / "fake_ssh.py"))
+    inventory = tmp_path / "inventory.json"
+    inventory.write_text(json.dumps({"servers": [{"name": n, "ip": ip} for n, ip in HOSTS.items()]}))
+    script = tmp_path / "start.sh"
+    script.write_text(OFFLINE_START)
+
+    def run(*extra: str) -> int:
+        return asyncio.run(bootstrap_nodes.main([
+            "--inventory", str(inventory), "--script", str(script),
+            "--log-dir", str(tmp_path / "logs"), *extra,
+        ]))
+
+    return run, tmp_path / "hosts"
+
+
+def test_each_node_gets_its_own_hostname(fleet):
+    run, hosts = fleet
+    assert run() == 0
+    for name, ip in HOSTS.items():
+        assert (hosts / ip / "fsroot" / "etc" / "hostname").read_text() == f"{name}\n"
+        assert f"127.0.1.1\t{name}\n" in (hosts / ip / "fsroot" / "etc" / "hosts").read_text()
+
+
+def test_rerun_is_skipped(fleet, capsys):
+    run, hosts = fleet
+    assert run() == 0
+    capsys.readouterr()
+    assert run() == 0
+    assert capsys.readouterr().out.count(bootstrap_nodes.SKIPPED_SENTINEL) == len(HOSTS)
+
+
+# wget и apt для настоящего start.sh: файлы «скачиваются» из каталога FAKE_REMOTE,
+# отсутствующий файл — оборванная загрузка (половина ответа и ненулевой код)
+FAKE_WGET = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -O) out="$2"; shift 2 ;;
+        -*) shift ;;
+        *) url="$1"; shift ;;
+    esac
+done
+src="$FAKE_REMOTE/${url#https://raw.githubusercontent.com/dhsxvrozq/test_deploy/refs/heads/master/}"
+if [ -z "$out" ]; then
+    # Как настоящий wget: без -O существующий файл не перезаписывается, пишется file.1
+    out=$(basename "$url")
+    [ -e "$out" ] && out="$out.1"
+fi
+if [ ! -f "$src" ]; then
+    echo partial > "$out"
+    exit 8
+fi
+cp "$src" "$out"
+"""
+
+
+@pytest.fixture
+def remote(fleet, tmp_path, monkeypatch):
+    """Настоящий start.sh; возвращает каталог, откуда «скачиваются» файлы."""
+    run, hosts = fleet
+    (tmp_path / "start.sh").write_text((REPO_DIR / "start.sh").read_text())
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "wget").write_text(FAKE_WGET)
+    (bin_dir / "apt").write_text("#!/bin/sh\nexit 0\n")
+    for tool in bin_dir.iterdir():
+        tool.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+
+    files = tmp_path / "remote"
+    (files / "start.py").mkdir(parents=True)
+    shutil.copy2(REPO_DIR / "start.py" / "change_hostname.py", files / "start.py" / "change_hostname.py")
+    (files / ".env").write_text('SERVER_NAME="master1"\n')
+    monkeypatch.setenv("FAKE_REMOTE", str(files))
+    return files
+
+
+def test_interrupted_start_sh_is_rerun_cleanly(fleet, remote):
+    run, hosts = fleet
+    # vless_manager.py недоступен: start.sh падает после смены имени, маркер не ставится
+    assert run() == 1
+    (remote / "vless_manager.py").write_text("print('ok')\n")
+    assert run() == 0
+
+    for name, ip in HOSTS.items():
+        home = hosts / ip
+        assert (home / "vless_manager.py").read_text() == "print('ok')\n"
+        assert not list(home.glob("*.1")) and not list(home.glob("*.tmp"))
+        assert (home / "fsroot" / "etc" / "hostname").read_text() == f"{name}\n"
+
+
+def test_stale_change_hostname_is_not_used(fleet, remote):
+    run, hosts = fleet
+    (remote / "vless_manager.py").write_text("")
+    stale = "open('stale-ran', 'w').close()\n"
+    for ip in HOSTS.values():
+        (hosts / ip).mkdir(parents=True)
+        (hosts / ip / "change_hostname.py").write_text(stale)
+
+    # Загрузка change_hostname.py оборвалась: хост не готов, старая копия не запускалась
+    (remote / "start.py" / "change_hostname.py").rename(remote / "change_hostname.py")
+    assert run() == 1
+    for ip in HOSTS.values():
+        assert not (hosts / ip / "stale-ran").exists()
+        assert not (hosts / ip / "fsroot" / "etc" / "hostname").exists()
+
+
+def test_script_without_change_hostname_skips_rename(fleet, tmp_path):
+    run, hosts = fleet
+    (tmp_path / "start.sh").write_text("#!/bin/sh\ntrue\n")
+    for ip in HOSTS.values():
+        (hosts / ip).mkdir(parents=True)
+        (hosts / ip / "change_hostname.py").write_text("open('stale-ran', 'w').close()\n")
+
+    assert run() == 0
+    for name, ip in HOSTS.items():
+        assert not (hosts / ip / "stale-ran").exists()
+        assert "change_hostname.py не найден" in (tmp_path / "logs" / f"{name}.log").read_text()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""start.py/change_hostname.py: атомарная правка файлов в --root, идемпотентность и параллельные запуски."""
+
+import sys
+import subprocess
+import importlib.util
+
+import pytest
+
+from conftest import REPO_DIR
+
+SCRIPT = REPO_DIR / "start.py" / "change_hostname.py"
+_spec = importlib.util.spec_from_file_location("change_hostname", SCRIPT)
+change_hostname = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(change_hostname)
+
+HOSTS = """127.0.0.1 localhost
+127.0.1.1\tmaster1
+10.0.0.9\tdb   # база
+::1 ip6-localhost
+"""
+
+
+def test_files_are_rewritten_in_root(tmp_path):
+    etc = tmp_path / "etc"
+    etc.mkdir()
+    (etc / "hosts").write_text(HOSTS)
+    (etc / "hosts").chmod(0o640)
+
+    assert change_hostname.set_hostname("edge-1", root=tmp_path)
+    assert (etc / "hostname").read_text() == "edge-1\n"
+    assert (etc / "hosts").read_text() == (
+        "127.0.0.1\tlocalhost\n10.0.0.9\tdb   # база\n::1 ip6-localhost\n127.0.1.1\tedge-1\n")
+    assert (etc / "hosts").stat().st_mode & 0o777 == 0o640
+    assert not [p for p in etc.iterdir() if p.name.startswith(".")]   # временные файлы не остались
+
+
+def test_second_run_changes_nothing(tmp_path):
+    assert change_hostname.set_hostname("edge-1", "10.1.1.1", root=tmp_path)
+    inodes = {name: (tmp_path / "etc" / name).stat().st_ino for name in ("hostname", "hosts")}
+    assert not change_hostname.set_hostname("edge-1", "10.1.1.1", root=tmp_path)
+    assert {name: (tmp_path / "etc" / name).stat().st_ino for name in inodes} == inodes
+
+    # Прежние строки с этим именем заменяются одной новой
+    assert change_hostname.set_hostname("edge-1", root=tmp_path)
+    hosts = (tmp_path / "etc" / "hosts").read_text().splitlines()
+    assert [line for line in hosts if "edge-1" in line] == ["127.0.1.1\tedge-1"]
+
+
+def test_parallel_runs_leave_consistent_files(tmp_path):
+    procs = [subprocess.Popen([sys.executable, str(SCRIPT), f"node-{i % 2}", "--root", str(tmp_path)],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) for i in range(12)]
+    for proc in procs:
+        out, _ = proc.communicate(timeout=30)
+        assert proc.returncode == 0, out
+    name = (tmp_path / "etc" / "hostname").read_text().strip()
+    hosts = (tmp_path / "etc" / "hosts").read_text().splitlines()
+    assert name in ("node-0", "node-1")
+    assert [line for line in hosts if line.startswith("127.0.1.1")] == [f"127.0.1.1\t{name}"]
+
+
+def test_system_commands_are_checked(monkeypatch):
+    calls = []
+
+    def run(cmd):
+        calls.append(cmd)
+        raise RuntimeError(f"{' '.join(cmd)}: Access denied")
+
+    monkeypatch.setattr(change_hostname, "run", run)
+    monkeypatch.setattr(change_hostname.socket, "gethostname", lambda: "old")
+    monkeypatch.setattr(change_hostname.shutil, "which", lambda name: f"/usr/bin/{name}")
+    with pytest.raises(RuntimeError, match="Access denied"):
+        change_hostname.apply_hostname("edge-1")
+    assert calls == [["hostnamectl", "set-hostname", "edge-1"]]
+
+    # Без hostnamed имя применяется из /etc/hostname; если имя уже то же — ничего не запускается
+    monkeypatch.setattr(change_hostname.shutil, "which", lambda name: None)
+    with pytest.raises(RuntimeError):
+        change_hostname.apply_hostname("edge-1")
+    assert calls[-1] == ["hostname", "-F", "/etc/hostname"]
+    change_hostname.apply_hostname("old")
+    assert len(calls) == 2
+
+
+def test_cli_usage(tmp_path):
+    done = subprocess.run([sys.executable, str(SCRIPT), "--root", str(tmp_path)], capture_output=True, text=True)
+    assert done.returncode == 1 and "Использование" in done.stdout
+
+
+def test_no_third_party_dependencies():
+    assert "aiofiles" not in SCRIPT.read_text()
+    assert "pip" not in (REPO_DIR / "start.sh").read_text()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from conftest import TOOLS_DIR
+
+MANAGED = {"vless-managed": "1"}
+
+
+@pytest.fixture(params=["api", "cli"])
+def docker(vm, request, monkeypatch):
+    if request.param == "cli":
+        monkeypatch.setattr(vm, "DOCKER", vm.DockerCLI(binary=str(TOOLS_DIR / "fake_docker.py")))
+    return vm.DOCKER
+
+
+def test_config_created_times(vm, docker):
+    before = time.time()
+    docker.config_create("vless-config-alice-0", b"{}", MANAGED)
+    docker.config_create("foreign", b"{}", {})
+    created = docker.config_created("vless-managed=1")
+    assert list(created) == ["vless-config-alice-0"]
+    assert before - 1 <= created["vless-config-alice-0"] <= time.time() + 1
+
+
+def test_cleanup_keeps_fresh_unattached_configs(vm, docker, monkeypatch):
+    docker.config_create("vless-config-alice-0", b"{}", MANAGED)   # add ещё не подключил его к сервису
+    docker.config_create("vless-config-bob-0", b"{}", MANAGED)
+    docker.service_create("vless-bob", 10001, "vless-config-bob-0", labels=MANAGED)
+
+    assert vm.cleanup_managed_resources(force=True) == {"configs_removed": 0}
+    assert docker.config_exists("vless-config-alice-0")
+
+    monkeypatch.setattr(vm, "CLEANUP_CONFIG_GRACE", -5)   # grace истёк
+    assert vm.cleanup_managed_resources(force=True) == {"configs_removed": 1}
+    assert not docker.config_exists("vless-config-alice-0")
+    assert docker.config_exists("vless-config-bob-0")
+
+
+def test_docker_time():
+    from vless_manager import _docker_time
+    assert _docker_time("1970-01-01T00:00:10.500000001Z") == pytest.approx(10.5)
+    assert _docker_time("1970-01-01T03:00:00+03:00") == 0
+    assert _docker_time("2 hours ago") is None
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Configs с хэшем содержимого: повторный provision без изменений не пишет в Docker."""
+
+
+def provision(vm, username="alice", node="node-1", keys=None):
+    user = vm.STORE.get_user(username)
+    port = user["port"] if user else vm.get_next_port()
+    keys = keys or ((user["private_key"], user["public_key"]) if user else vm.generate_x25519_keys())
+    return vm.provision_user(username, port, keys, node, user)
+
+
+def test_unchanged_reprovision_makes_no_mutations(vm, dockerd):
+    first = provision(vm)
+    service = dict(dockerd.state.services["vless-alice"])
+    mutations = dockerd.state.mutations
+
+    assert provision(vm) == first
+    assert dockerd.state.mutations == mutations
+    assert dockerd.state.services["vless-alice"]["ContainerID"] == service["ContainerID"]
+
+
+def test_changed_config_rotates_without_recreating_service(vm, dockerd):
+    provision(vm)
+    service_id = dockerd.state.services["vless-alice"]["ID"]
+    old_configs = set(dockerd.state.configs)
+
+    provision(vm, keys=vm.generate_x25519_keys())
+    assert dockerd.state.services["vless-alice"]["ID"] == service_id   # update, а не пересоздание
+    (config,) = dockerd.state.configs
+    assert config not in old_configs and config.startswith("vless-config-alice-")
+
+    provision(vm, node="node-2")
+    assert dockerd.state.services["vless-alice"]["ID"] == service_id
+    assert set(dockerd.state.configs) == {config}
+    assert vm.actual_user_state()["alice"]["node"] == "node-2"
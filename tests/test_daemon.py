@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""ManagerDaemon: очередь заданий и HTTP-обработчик без Swarm (операции подменены)."""
+
+import sys
+import json
+import time
+import socket
+import asyncio
+import functools
+import threading
+
+import pytest
+
+import vless_manager
+
+
+@pytest.fixture
+def journal(monkeypatch):
+    """Подменяет add/remove записью начала и конца каждой операции."""
+    events = []
+    lock = threading.Lock()
+
+    def op(name):
+        def run(username, hot=False, seq=0, delay=0.02):
+            with lock:
+                events.append(("start", username, seq))
+            time.sleep(delay)
+            with lock:
+                events.append(("end", username, seq))
+            return {"username": username, "op": name, "seq": seq}
+        return run
+
+    monkeypatch.setitem(vless_manager.USER_OPS, "add", op("add"))
+    monkeypatch.setitem(vless_manager.USER_OPS, "remove", op("remove"))
+    return events
+
+
+async def run_daemon(daemon: vless_manager.ManagerDaemon, body) -> object:
+    daemon.queue = asyncio.Queue()
+    workers = [asyncio.create_task(daemon._worker()) for _ in range(daemon.workers)]
+    try:
+        return await body()
+    finally:
+        for task in workers:
+            task.cancel()
+        daemon.executor.shutdown()
+
+
+def test_same_user_jobs_run_in_submit_order(journal):
+    daemon = vless_manager.ManagerDaemon(workers=4)
+
+    async def body():
+        jobs = [("alice", 0.03), ("bob", 0.01), ("alice", 0.0), ("alice", 0.01), ("bob", 0.0)]
+        futures = [daemon.submit("add" if seq % 2 == 0 else "remove", user, {"seq": seq, "delay": delay})
+                   for seq, (user, delay) in enumerate(jobs)]
+        return await asyncio.gather(*futures)
+
+    replies = asyncio.run(run_daemon(daemon, body))
+    assert [status for status, _ in replies] == [200] * 5
+    assert [reply["result"]["seq"] for _, reply in replies] == [0, 1, 2, 3, 4]
+
+    for user, seqs in (("alice", [0, 2, 3]), ("bob", [1, 4])):
+        mine = [(kind, seq) for kind, name, seq in journal if name == user]
+        # Операции одного пользователя не пересекаются и идут в порядке поступления
+        assert mine == [(kind, seq) for seq in seqs for kind in ("start", "end")]
+    # Разные пользователи при этом выполняются параллельно
+    assert journal.index(("start", "bob", 1)) < journal.index(("end", "alice", 0))
+    assert daemon.waiting == {} and daemon.counters["done"] == 5
+
+
+async def request(daemon: vless_manager.ManagerDaemon, raw: bytes) -> tuple[int, dict]:
+    server = await asyncio.start_server(daemon.handle, "127.0.0.1", 0)
+    async with server:
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        writer.write(raw)
+        await writer.drain()
+        head, _, data = (await reader.read()).partition(b"\r\n\r\n")
+        writer.close()
+    return int(head.split(b" ")[1]), json.loads(data)
+
+
+def post(path: str, body: bytes) -> bytes:
+    return f"POST {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+
+
+@pytest.mark.parametrize("body", [b"[1, 2]", b'"alice"', b"null", b"{oops"])
+def test_non_object_body_is_rejected(journal, body):
+    daemon = vless_manager.ManagerDaemon(workers=1)
+    status, reply = asyncio.run(run_daemon(daemon, lambda: request(daemon, post("/add", body))))
+    assert status == 400 and "error" in reply
+    assert journal == []
+
+
+def test_unexpected_error_still_gets_response(journal, monkeypatch):
+    daemon = vless_manager.ManagerDaemon(workers=1)
+
+    async def broken(method, path, body):
+        raise KeyError("username")
+
+    monkeypatch.setattr(daemon, "dispatch", broken)
+    status, reply = asyncio.run(run_daemon(daemon, lambda: request(daemon, post("/add", b"{}"))))
+    assert status == 500 and "KeyError" in reply["error"]
+
+
+@pytest.fixture
+def listening_daemon(tmp_path, monkeypatch):
+    """Unix-сокет, на котором «запущен» демон; возвращает функцию чтения того, что ему прислали."""
+    path = tmp_path / "daemon.sock"
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(path))
+    server.listen()
+    server.settimeout(0.2)
+    monkeypatch.setattr(vless_manager, "DAEMON_ENABLED", True)
+    monkeypatch.setattr(vless_manager, "daemon_call", functools.partial(vless_manager.daemon_call, address=str(path)))
+
+    def accepted() -> bytes:
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            return b""
+        with conn:
+            conn.settimeout(0.2)
+            try:
+                return conn.recv(65536)
+            except socket.timeout:
+                return b""
+
+    yield accepted
+    server.close()
+
+
+@pytest.mark.parametrize("option", vless_manager.DAEMON_LOCAL_OPTIONS)
+def test_process_local_options_are_not_dropped(journal, listening_daemon, monkeypatch, option):
+    monkeypatch.setattr(sys, "argv", ["vless_manager.py", "add", "alice", option])
+    with pytest.raises(RuntimeError, match=option):
+        vless_manager.run_user_op("add", "alice")
+    assert listening_daemon() == b""   # запрос демону не ушёл
+    assert journal == []
+
+    # С --local операция выполняется в этом процессе, с опцией
+    monkeypatch.setattr(sys, "argv", ["vless_manager.py", "add", "alice", option, "--local"])
+    assert vless_manager.run_user_op("add", "alice")["username"] == "alice"
+
+
+def post_with(path: str, body: bytes, authorization: str) -> bytes:
+    return (f"POST {path} HTTP/1.1\r\nAuthorization: {authorization}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+
+@pytest.mark.parametrize("authorization, status", [
+    (None, 401), ("Bearer wrong", 401), ("secret", 401), ("Bearer secret", 200),
+])
+def test_token_is_required(journal, authorization, status):
+    daemon = vless_manager.ManagerDaemon(workers=1, token="secret")
+    body = b'{"username": "alice"}'
+    raw = post("/add", body) if authorization is None else post_with("/add", body, authorization)
+    got, reply = asyncio.run(run_daemon(daemon, lambda: request(daemon, raw)))
+    assert got == status
+    assert len(journal) == (2 if status == 200 else 0)
+
+
+@pytest.mark.parametrize("address", ["0.0.0.0:9551", "[::]:9551", "10.0.0.5:9551", "example.com:9551"])
+def test_public_tcp_address_needs_token(address):
+    daemon = vless_manager.ManagerDaemon(workers=1, token="")
+    with pytest.raises(RuntimeError, match="VLESS_DAEMON_TOKEN"):
+        asyncio.run(daemon.serve(address))
+    daemon.executor.shutdown()
+
+
+def test_warm_up_keeps_ports_of_concurrent_local_runs(vm, dockerd):
+    vm.provision_user("alice", vm.get_next_port(), vm.generate_x25519_keys(), "node-1")
+    in_flight = vm.get_next_port()   # --local выделил порт, но сервис ещё не создан
+
+    vless_manager.ManagerDaemon(workers=1).warm_up()
+    assert in_flight in vm.PORTS.used()
+    assert vm.get_next_port() not in (in_flight, vm.STORE.get_user("alice")["port"])
+
+
+def test_warm_up_builds_missing_port_map(vm, dockerd):
+    port = vm.provision_user("alice", vm.get_next_port(), vm.generate_x25519_keys(), "node-1")["port"]
+    vm.PORTS.path.unlink()
+    vless_manager.ManagerDaemon(workers=1).warm_up()
+    assert vm.PORTS.used() == [port]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+deploy_master.py против tools/fake_twc.py (модель Server — из conftest, если
+objects.models проекта недоступен).
+"""
+
+import json
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from conftest import TOOLS_DIR
+
+import deploy_master as dm
+
+
+@pytest.fixture
+def twc(tmp_path, monkeypatch):
+    """Заглушка twc с отдельным состоянием; возвращает функцию чтения этого состояния."""
+    state_file = tmp_path / "fake_twc.json"
+    monkeypatch.setenv("FAKE_TWC_STATE", str(state_file))
+    monkeypatch.setenv("FAKE_TWC_BOOT", "0")
+    monkeypatch.setattr(dm, "TWC_BIN", str(TOOLS_DIR / "fake_twc.py"))
+    monkeypatch.setattr(dm, "TWC_OUTPUT", dm.TwcOutput("raw"))
+    monkeypatch.setattr(dm, "BACKOFF_BASE", 0.01)
+    return lambda: json.loads(state_file.read_text())
+
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures" / "twc"
+
+
+@pytest.mark.parametrize("fixture, transient", [
+    ("error_429.txt", True),
+    ("error_502.txt", True),    # HTML-страница шлюза: twc пишет «malformed response» без статуса
+    ("error_503.txt", True),    # twc 2.15 падает с трассировкой requests.HTTPError
+    ("error_400.txt", False),
+    ("error_404.txt", False),
+    ("error_no_such_option.txt", False),
+])
+def test_is_transient_captured(fixture, transient):
+    assert dm.is_transient((FIXTURES / fixture).read_text()) is transient
+
+
+@pytest.mark.parametrize("message, transient", [
+    ("Error ocurred.\nStatus code: 500\nError code: internal_error\nMessage: oops", True),
+    # Число 500 и слова timeout/connection в тексте — не признак временной ошибки
+    ("Error ocurred.\nStatus code: 400\nError code: bad_request\nMessage: name: max 500 chars, timeout", False),
+    ("Error ocurred.\nStatus code: 409\nError code: conflict\nMessage: connection limit", False),
+    ("Error: Coul'd not connect to server: HTTPSConnectionPool(host='api.timeweb.cloud', port=443)", True),
+    ("requests.exceptions.ReadTimeout: HTTPSConnectionPool(host='api.timeweb.cloud'): Read timed out.", True),
+    ("requests.exceptions.HTTPError: 501 Server Error: Not Implemented for url: https://api.timeweb.cloud", False),
+])
+def test_is_transient(message, transient):
+    assert dm.is_transient(message) is transient
+
+
+def test_retry_resumes_server_created_by_lost_request(twc, monkeypatch):
+    # Каждый create создаёт сервер, но ответ теряется (504)
+    monkeypatch.setenv("FAKE_TWC_LOST_RATE", "1")
+
+    async def create():
+        return await dm.create_with_retry("1", asyncio.Semaphore(1), retries=3)
+
+    server_id = asyncio.run(create())
+    state = twc()
+    assert list(state["servers"]) == [server_id]
+    assert state["calls"]["create"] == 1
+
+
+def test_poller_fails_waiters_on_unexpected_error(twc, monkeypatch):
+    def broken(srv):
+        raise ValueError(f"неожиданный ответ API: {srv['id']}")
+
+    monkeypatch.setattr(dm, "server_from_api", broken)
+
+    async def watch():
+        server_id = await dm.create_with_retry("1", asyncio.Semaphore(1), retries=0)
+        poller = dm.StatusPoller(initial=0.01, max_interval=0.01, timeout=5)
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(poller.watch(server_id), 5)
+        await asyncio.sleep(0)
+        assert poller.task.done() and poller.task.exception() is None
+        assert not poller.pending
+
+    asyncio.run(watch())
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import threading
+import socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+import vless_manager
+
+
+def test_fake_rejects_non_string_labels(vm):
+    status, data = vm.DOCKER._request("POST", "/configs/create",
+                                      {"Name": "bad", "Labels": {"vless-port": 10001}, "Data": ""})
+    assert status == 400
+    assert "Labels" in data["message"]
+
+
+def test_labels_sent_as_strings(vm):
+    vm.DOCKER.config_create("cfg", b"{}", {vm.MANAGED_LABEL: 1})
+    vm.DOCKER.service_create("vless-alice", 10001, "cfg", labels={"vless-port": 10001, vm.MANAGED_LABEL: 1},
+                             container_labels={vm.MANAGED_LABEL: 1})
+    spec = vm.DOCKER.service_spec("vless-alice")
+    assert spec["Labels"] == {"vless-port": "10001", vm.MANAGED_LABEL: "1"}
+    assert spec["TaskTemplate"]["ContainerSpec"]["Labels"] == {vm.MANAGED_LABEL: "1"}
+
+
+class _FlakyHandler(BaseHTTPRequestHandler):
+    """Отвечает на запросы keep-alive, но номера из server.drop читает и рвёт соединение без ответа."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.seen.append(self.command)
+        if len(self.server.seen) in self.server.drop:
+            self.close_connection = True
+            return
+        raw = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    do_GET = do_POST = _handle
+
+
+@pytest.fixture
+def flaky(tmp_path):
+    server = socketserver.ThreadingUnixStreamServer(str(tmp_path / "flaky.sock"), _FlakyHandler)
+    server.daemon_threads = True
+    server.seen, server.drop = [], set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_post_not_retried_after_send(flaky):
+    api = vless_manager.DockerEngineAPI(socket_path=flaky.server_address)
+    flaky.drop = {2}
+    api._call("GET", "/nodes")
+    with pytest.raises(http.client.RemoteDisconnected):
+        api._call("POST", "/configs/create", {"Name": "x", "Labels": {}, "Data": ""})
+    assert flaky.seen == ["GET", "POST"]
+
+
+def test_get_retried_on_reused_connection(flaky):
+    api = vless_manager.DockerEngineAPI(socket_path=flaky.server_address)
+    flaky.drop = {2}
+    api._call("GET", "/nodes")
+    assert api._call("GET", "/nodes") == {}
+    assert flaky.seen == ["GET", "GET", "GET"]
+
+
+def test_stale_pooled_connection_skipped(flaky):
+    api = vless_manager.DockerEngineAPI(socket_path=flaky.server_address)
+    api._call("GET", "/nodes")
+    conn = api._pool.get_nowait()
+    conn.sock.shutdown(0)   # как будто демон закрыл простаивающее соединение
+    api._pool.put_nowait(conn)
+    assert api._call("POST", "/configs/create", {"Name": "x"}) == {}
+    assert flaky.seen == ["GET", "POST"]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Генерация x25519-ключей в процессе: тестовые векторы RFC 7748."""
+
+import sys
+
+import pytest
+
+from vless_manager import (_b64url, _b64url_decode, _x25519_scalarmult, generate_x25519_keys_native,
+                           x25519_public_key)
+
+BASE_POINT = (9).to_bytes(32, "little")
+
+ALICE_PRIVATE = "77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a"
+ALICE_PUBLIC = "8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a"
+BOB_PRIVATE = "5dab087e624a8a4b79e17f8b83800ee66f3bb1292618b6fd1c2f8b27ff88e0eb"
+BOB_PUBLIC = "de9edb7d7b7dc1b4d35b61c2ece435373f8343c85b78674dadfc7e146f882b4f"
+SHARED = "4a5d9d5ba4ce2de1728e3bf480350f25e07e21c947d19e3376f09b3c1e161742"
+
+
+@pytest.fixture(params=["cryptography", "pure"])
+def backend(request, monkeypatch):
+    """x25519_public_key с пакетом cryptography и без него (чистый Python)."""
+    if request.param == "cryptography":
+        pytest.importorskip("cryptography")
+    else:
+        monkeypatch.setitem(sys.modules, "cryptography", None)
+    return request.param
+
+
+# RFC 7748, раздел 5.2
+@pytest.mark.parametrize("scalar, u_point, result", [
+    ("a546e36bf0527c9d3b16154b82465edd62144c0ac1fc5a18506a2244ba449ac4",
+     "e6db6867583030db3594c1a424b15f7c726624ec26b3353b10a903a6d0ab1c4c",
+     "c3da55379de9c6908e94ea4df28d084f32eccf03491c71f754b4075577a28552"),
+    ("4b66e9d4d1b4673c5ad22691957d6af5c11b6421e0ea01d42ca4169e7918ba0d",
+     "e5210f12786811d3f4b7959d0538ae2c31dbe7106fc03c3efc4cd549c715a493",
+     "95cbde9476e8907d7aade45cb4b873f88b595a68799fa152e6f8f7647aac7957"),
+])
+def test_scalarmult_vectors(scalar, u_point, result):
+    assert _x25519_scalarmult(bytes.fromhex(scalar), bytes.fromhex(u_point)).hex() == result
+
+
+@pytest.mark.parametrize("iterations, result", [
+    (1, "422c8e7a6227d7bca1350b3e2bb7279f7897b87bb6854b783c60e80311ae3079"),
+    (1000, "684cf59ba83309552800ef566f2f4d3c1c3887c49360e3875f2eb94d99532c51"),
+])
+def test_scalarmult_iterated(iterations, result):
+    k = u = BASE_POINT
+    for _ in range(iterations):
+        k, u = _x25519_scalarmult(k, u), k
+    assert k.hex() == result
+
+
+# RFC 7748, раздел 6.1
+def test_diffie_hellman_vectors():
+    alice, bob = bytes.fromhex(ALICE_PRIVATE), bytes.fromhex(BOB_PRIVATE)
+    assert _x25519_scalarmult(alice, BASE_POINT).hex() == ALICE_PUBLIC
+    assert _x25519_scalarmult(bob, BASE_POINT).hex() == BOB_PUBLIC
+    assert _x25519_scalarmult(alice, bytes.fromhex(BOB_PUBLIC)).hex() == SHARED
+    assert _x25519_scalarmult(bob, bytes.fromhex(ALICE_PUBLIC)).hex() == SHARED
+
+
+@pytest.mark.parametrize("private, public", [(ALICE_PRIVATE, ALICE_PUBLIC), (BOB_PRIVATE, BOB_PUBLIC)])
+def test_public_key_in_xray_format(backend, private, public):
+    assert x25519_public_key(_b64url(bytes.fromhex(private))) == _b64url(bytes.fromhex(public))
+
+
+def test_generated_keys_are_clamped_and_match(backend):
+    private_key, public_key = generate_x25519_keys_native()
+    raw = _b64url_decode(private_key)
+    assert len(raw) == 32 and "=" not in private_key + public_key
+    assert raw[0] & 7 == 0 and raw[31] & 0xC0 == 0x40
+    assert public_key == _b64url(_x25519_scalarmult(raw, BASE_POINT))
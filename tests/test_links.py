@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""list / links: ссылки из хранилища, один пакетный запрос к Swarm с --live и форматы вывода."""
+
+import io
+import json
+
+import pytest
+
+
+@pytest.fixture
+def users(vm, dockerd):
+    """Три отдельных сервиса и два клиента шарда; {username: ссылка из add}."""
+    links = {}
+    for name, node in (("alice", "node-1"), ("bob", "node-2"), ("carol", "node-3")):
+        links[name] = vm.provision_user(name, vm.get_next_port(), vm.generate_x25519_keys(), node)["link"]
+    for record in vm.add_shared_users([("dave", "node-1"), ("erin", "node-1")]):
+        links[record["username"]] = record["link"]
+    return links
+
+
+def rows(vm, fmt: str, **kwargs) -> str:
+    out = io.StringIO()
+    columns = vm.LINKS_COLUMNS if kwargs.get("with_links") else vm.LIST_COLUMNS
+    vm.write_rows(vm.iter_user_rows(**kwargs), columns, fmt, out=out)
+    return out.getvalue()
+
+
+def test_links_match_what_add_printed(vm, dockerd, users):
+    requests = dockerd.state.requests
+    got = {r["username"]: r["link"] for r in map(json.loads, rows(vm, "jsonl", with_links=True).splitlines())}
+    assert got == users
+    assert dockerd.state.requests == requests
+
+
+def test_live_listing_is_one_batch(vm, dockerd, users):
+    def live_requests() -> int:
+        before = dockerd.state.requests
+        rows(vm, "jsonl", live=True)
+        return dockerd.state.requests - before
+
+    few = live_requests()
+    for i in range(20):
+        vm.provision_user(f"user{i}", vm.get_next_port(), vm.generate_x25519_keys(), "node-2")
+    assert live_requests() == few   # число запросов не растёт с числом пользователей
+
+    # Сервис, удалённый в обход менеджера, виден как missing; хранилище не меняется
+    vm.DOCKER.service_rm("vless-bob")
+    live = {r["username"]: r for r in json.loads(rows(vm, "json", live=True))}
+    assert live["bob"]["status"] == "missing" and live["alice"]["status"] == "active"
+    assert live["dave"]["shard"] and live["dave"]["status"] == "active"
+    assert vm.STORE.get_user("bob")["status"] == "active"
+
+
+def test_output_formats(vm, users):
+    table = rows(vm, "table").splitlines()
+    assert table[0].split("\t") == [c.upper() for c in vm.LIST_COLUMNS]
+    assert len(table) == len(users) + 1
+    assert json.loads(rows(vm, "json")) == [json.loads(line) for line in rows(vm, "jsonl").splitlines()]
+
+
+def test_empty_store(vm):
+    assert json.loads(rows(vm, "json")) == []
+    assert rows(vm, "jsonl") == ""
+    assert rows(vm, "table") == "\t".join(c.upper() for c in vm.LIST_COLUMNS) + "\n"
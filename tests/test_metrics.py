@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""metrics: разбор --interval до запуска HTTP-сервера."""
+
+import sys
+
+import pytest
+
+import vless_manager
+
+
+@pytest.mark.parametrize("argv, interval", [
+    ([], vless_manager.METRICS_INTERVAL),
+    (["--interval", "30"], 30.0),
+    (["--interval", "0.5"], 0.5),
+])
+def test_interval_is_parsed(monkeypatch, argv, interval):
+    monkeypatch.setattr(sys, "argv", ["vless_manager.py", "metrics", *argv])
+    assert vless_manager.get_metrics_interval() == interval
+
+
+@pytest.mark.parametrize("value", ["abc", "0", "-5", "nan", "inf", ""])
+def test_bad_interval_prints_usage(monkeypatch, capsys, value):
+    monkeypatch.setattr(sys, "argv", ["vless_manager.py", "metrics", "--interval", value])
+    with pytest.raises(SystemExit) as exc:
+        vless_manager.get_metrics_interval()
+    assert exc.value.code == 1
+    assert "metrics --interval <сек>" in capsys.readouterr().out
+
+
+def test_missing_interval_value_prints_usage(monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["vless_manager.py", "metrics", "--interval"])
+    with pytest.raises(SystemExit):
+        vless_manager.get_metrics_interval()
+    assert "metrics --interval <сек>" in capsys.readouterr().out
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""node_bundle.py без образа Xray: сборка, установка, повторная установка и проверка хэшей."""
+
+import io
+import json
+import shutil
+import tarfile
+
+import pytest
+
+import node_bundle
+from conftest import REPO_DIR
+
+
+def phases(out: str) -> dict[str, str]:
+    """Таблица фаз из вывода PhaseTimer: {фаза: done|skipped}."""
+    rows = [line.split() for line in out.splitlines()]
+    return {row[0]: row[1] for row in rows if len(row) == 3 and row[1] in ("done", "skipped")}
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    """Команды, которые установка запустила бы (pip, docker load, change_hostname.py)."""
+    calls = []
+    monkeypatch.setattr(node_bundle, "run", lambda cmd, **kwargs: calls.append(cmd))
+    return calls
+
+
+@pytest.fixture
+def bundle(tmp_path, capsys):
+    assert node_bundle.main(["build", "--no-image", "--out", str(tmp_path / "bundles")]) == 0
+    path = next((tmp_path / "bundles").glob("vless-node-*.tar.gz"))
+    capsys.readouterr()
+    return path
+
+
+def test_build_without_image(bundle):
+    with tarfile.open(bundle) as tar:
+        names = set(tar.getnames())
+        manifest = json.load(tar.extractfile("manifest.json"))
+    assert {"scripts/vless_manager.py", "scripts/change_hostname.py", "scripts/node_bundle.py"} <= names
+    assert not any(name.startswith("images") for name in names)
+    assert manifest["image"] is None and manifest["hashes"]["image"] == ""
+    assert bundle.name == f"vless-node-{manifest['version']}.tar.gz"
+
+
+def test_reinstall_skips_unchanged_steps(bundle, tmp_path, capsys, commands):
+    dest = tmp_path / "node"
+    node_bundle.install_bundle(bundle, dest, hostname="edge-1")
+    assert phases(capsys.readouterr().out) == {
+        "extract": "done", "scripts": "done", "wheels": "skipped", "image": "skipped", "hostname": "done"}
+    assert (dest / "vless_manager.py").read_bytes() == (REPO_DIR / "vless_manager.py").read_bytes()
+    assert commands == [[node_bundle.sys.executable, str(dest / "change_hostname.py"), "edge-1"]]
+
+    node_bundle.install_bundle(bundle, dest, hostname="edge-1")
+    assert phases(capsys.readouterr().out) == {
+        "extract": "done", "scripts": "skipped", "wheels": "skipped", "image": "skipped", "hostname": "skipped"}
+    assert len(commands) == 1
+
+    # Другое имя хоста — только шаг hostname
+    state = node_bundle.install_bundle(bundle, dest, hostname="edge-2")
+    assert phases(capsys.readouterr().out)["hostname"] == "done"
+    assert state["steps"]["hostname"] == "edge-2" and len(commands) == 2
+
+
+def test_changed_scripts_are_reinstalled(bundle, tmp_path, capsys, commands, monkeypatch):
+    dest = tmp_path / "node"
+    node_bundle.install_bundle(bundle, dest)
+
+    source = tmp_path / "src"
+    for path in node_bundle.BUNDLE_SCRIPTS:
+        (source / path).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(REPO_DIR / path, source / path)
+    with open(source / "vless_manager.py", "a") as f:
+        f.write("# новая версия\n")
+    monkeypatch.setattr(node_bundle, "BASE_DIR", source)
+    newer = node_bundle.build_bundle(tmp_path / "bundles", [], with_image=False)
+    assert newer != bundle
+    capsys.readouterr()
+
+    state = node_bundle.install_bundle(newer, dest)
+    assert phases(capsys.readouterr().out)["scripts"] == "done"
+    assert (dest / "vless_manager.py").read_text().endswith("# новая версия\n")
+    assert state["version"] in newer.name
+
+
+def test_corrupted_bundle_is_rejected(bundle, tmp_path, capsys, commands):
+    # Тот же manifest, но подменённый скрипт
+    broken = tmp_path / "broken.tar.gz"
+    with tarfile.open(bundle) as src, tarfile.open(broken, "w:gz") as dst:
+        for member in src.getmembers():
+            data = src.extractfile(member).read() if member.isfile() else None
+            if member.name == "scripts/vless_manager.py":
+                data += "# подмена\n".encode()
+                member.size = len(data)
+            dst.addfile(member, io.BytesIO(data) if data is not None else None)
+
+    dest = tmp_path / "node"
+    assert node_bundle.main(["install", str(broken), "--dest", str(dest), "--hostname", "edge-1"]) == 1
+    assert "бандл повреждён: не совпал хэш scripts/vless_manager.py" in capsys.readouterr().err
+    # Ни один шаг не выполнен
+    assert not (dest / "vless_manager.py").exists()
+    assert not (dest / node_bundle.INSTALL_STATE_NAME).exists()
+    assert commands == []
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Размещение новых сервисов по нагрузке нод и rebalance."""
+
+import os
+import sys
+import json
+import subprocess
+from collections import Counter
+
+import pytest
+
+import vless_manager
+from conftest import REPO_DIR
+
+
+def per_node(vm) -> Counter:
+    return Counter(state["node"] for state in vm.actual_user_state().values())
+
+
+def pin(vm, count: int, node: str, prefix: str = "pinned"):
+    for i in range(count):
+        vm.provision_user(f"{prefix}{i}", vm.get_next_port(), vm.generate_x25519_keys(), node)
+
+
+def stat(cpus: float, services: int) -> dict:
+    return {"cpus": cpus, "memory": 0, "services": services, "reserved_cpus": 0.0, "reserved_memory": 0}
+
+
+def test_add_picks_least_loaded_node(vm, dockerd):
+    pin(vm, 3, "node-1")
+    for name in ("a", "b", "c", "d"):
+        vm.add_user(name)
+    assert per_node(vm) == {"node-1": 3, "node-2": 2, "node-3": 2}
+
+
+def test_placement_falls_back_to_swarm(vm, dockerd, monkeypatch, capsys):
+    monkeypatch.setattr(vm, "PLACEMENT", "swarm")
+    assert vm.place_users(2) == [None, None]
+
+    monkeypatch.setattr(vm, "PLACEMENT", "auto")
+
+    def broken():
+        raise RuntimeError("нет связи с менеджером")
+
+    monkeypatch.setattr(vm.DOCKER, "node_list", broken)
+    assert vm.place_users(1) == [None]
+    assert "нет связи с менеджером" in capsys.readouterr().err
+
+
+def test_plan_accounts_for_cpus():
+    plan = vless_manager.plan_rebalance
+    nodes = {"big": stat(4, 0), "small": stat(2, 6)}
+    users = {f"u{i}": "small" for i in range(6)}
+    assert [(m["from"], m["to"]) for m in plan(nodes, users)] == [("small", "big")] * 4   # 2 на 2 CPU и 4 на 4 CPU
+    assert len(plan(nodes, users, max_moves=1)) == 1
+    assert plan({"a": stat(2, 2), "b": stat(2, 1)}, {"x": "a", "y": "a"}) == []   # лучше не станет
+    # Переносятся только переданные пользователи (шарды в placements не попадают)
+    assert plan({"a": stat(2, 6), "b": stat(2, 0)}, {"x": "a"}) == [{"username": "x", "from": "a", "to": "b"}]
+
+
+def test_rebalance_dry_run_then_apply(vm, dockerd, capsys):
+    pin(vm, 6, "node-1")
+    vm.add_shared_users([("sh1", "node-1"), ("sh2", "node-1")])
+    mutations = dockerd.state.mutations
+
+    assert vm.rebalance(dry_run=True, fmt="jsonl") == 0
+    plan = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert dockerd.state.mutations == mutations
+    assert len(plan) == 4 and {m["to"] for m in plan} == {"node-2", "node-3"}
+
+    assert vm.rebalance(workers=3) == 0
+    capsys.readouterr()
+    placements = {name: state["node"] for name, state in vm.actual_user_state().items()}
+    assert Counter(node for name, node in placements.items() if name.startswith("pinned")) == \
+        {"node-1": 2, "node-2": 2, "node-3": 2}
+    assert placements["sh1"] == placements["sh2"] == "node-1"   # шард не переносится
+    assert vm.rebalance(fmt="jsonl") == 0 and capsys.readouterr().out == ""   # уже ровно
+
+
+def test_rebalance_reports_failed_moves(vm, dockerd, capsys, monkeypatch):
+    pin(vm, 4, "node-1")
+    migrate = vm.migrate_user
+
+    def flaky(username, node):
+        if username == "pinned3":
+            raise RuntimeError("нода недоступна")
+        migrate(username, node)
+
+    monkeypatch.setattr(vm, "migrate_user", flaky)
+    failed = vm.rebalance()
+    records = {r["username"]: r for r in map(json.loads, capsys.readouterr().out.splitlines())}
+    assert failed == 1 and records["pinned3"]["error"] == "нода недоступна"
+    assert all("error" not in r for name, r in records.items() if name != "pinned3")
+    assert per_node(vm)["node-1"] == 4 - (len(records) - 1)
+
+
+@pytest.mark.parametrize("argv", [["--max-moves", "x"], ["--workers", "-1"]])
+def test_rebalance_cli_rejects_bad_numbers(argv):
+    done = subprocess.run([sys.executable, str(REPO_DIR / "vless_manager.py"), "rebalance", *argv],
+                          capture_output=True, text=True, env=dict(os.environ, VLESS_DAEMON="0"))
+    assert done.returncode == 1 and "должны быть числами" in done.stdout
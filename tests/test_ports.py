@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""PortAllocator: параллельные потоки и процессы над одним файлом карты."""
+
+import sys
+import json
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import REPO_DIR
+
+# Отдельный процесс со своим PortAllocator над тем же файлом
+ALLOCATE = """
+import os, sys, json, time
+sys.path.insert(0, sys.argv[1])
+from vless_manager import PortAllocator
+ports = PortAllocator(sys.argv[2], 20000, 29999)
+while not os.path.exists(sys.argv[4]):   # стартуем одновременно
+    time.sleep(0.001)
+got = []
+for i in range(int(sys.argv[3])):
+    got += ports.allocate(1 + i % 3)
+print(json.dumps(got))
+"""
+ROUNDS = 500
+
+
+@pytest.fixture
+def bitmap(vm, tmp_path):
+    path = tmp_path / "shared.bitmap"
+    vm.PortAllocator(path, 20000, 29999).used()   # создаём карту заранее
+    return path
+
+
+def test_threads_get_unique_ports(vm, bitmap):
+    def worker(n: int) -> tuple[list[int], list[int]]:
+        ports = vm.PortAllocator(bitmap, 20000, 29999)   # свой дескриптор, как у отдельного запуска
+        kept, released = [], []
+        for i in range(200):
+            got = ports.allocate(1 + (n + i) % 3)
+            if i % 4 == 3:
+                ports.release(got)
+                released += got
+            else:
+                kept += got
+        return kept, released
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(worker, range(8)))
+
+    kept = [port for ports, _ in results for port in ports]
+    assert len(kept) == len(set(kept))
+    assert vm.PortAllocator(bitmap, 20000, 29999).used() == sorted(kept)
+
+
+def test_processes_get_unique_ports(vm, tmp_path):
+    bitmap, go = tmp_path / "shared.bitmap", tmp_path / "go"
+    vm.PortAllocator(bitmap, 20000, 29999).used()
+    procs = [subprocess.Popen([sys.executable, "-c", ALLOCATE, str(REPO_DIR), str(bitmap), str(ROUNDS), str(go)],
+                              stdout=subprocess.PIPE, text=True) for _ in range(4)]
+    time.sleep(0.5)
+    go.touch()
+    allocated = []
+    for proc in procs:
+        out, _ = proc.communicate(timeout=60)
+        assert proc.returncode == 0
+        allocated += json.loads(out)
+
+    assert len(allocated) == 4 * sum(1 + i % 3 for i in range(ROUNDS))
+    assert len(allocated) == len(set(allocated))
+    # Без дыр: наименьшие свободные порты выданы подряд
+    assert sorted(allocated) == list(range(20000, 20000 + len(allocated)))
+    assert vm.PortAllocator(bitmap, 20000, 29999).used() == sorted(allocated)
+
+
+def test_exhausted_range_allocates_nothing(vm, tmp_path):
+    ports = vm.PortAllocator(tmp_path / "small.bitmap", 20000, 20009)
+    ports.allocate(8)
+    with pytest.raises(RuntimeError):
+        ports.allocate(3)
+    assert ports.allocate(2) == [20008, 20009]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Имена shard-* зарезервированы: ни один вход не должен трогать общий сервис как пользователя."""
+
+import json
+
+import pytest
+
+
+@pytest.fixture
+def shard(vm, dockerd):
+    """Шард с двумя клиентами; возвращает его идентификатор."""
+    records = vm.add_shared_users([("alice", "node-1"), ("bob", "node-1")])
+    (shard_id,) = {record["shard"] for record in records}
+    return shard_id
+
+
+def assert_shard_intact(vm, dockerd, shard_id):
+    service = dockerd.state.services[vm._shard_service_name(shard_id)]
+    assert service["Spec"]["Labels"]["vless-shard"] == shard_id
+    state = json.loads(vm.SHARDS_FILE.read_text())
+    assert set(state["shards"][shard_id]["clients"]) == {"alice", "bob"}
+    port = state["shards"][shard_id]["port"]
+    assert port in vm.PORTS.used()
+    for username in ("alice", "bob"):
+        user = vm.STORE.get_user(username)
+        assert (user["status"], user["shard"], user["port"]) == ("active", shard_id, port)
+
+
+def test_read_batch_rejects_shard_name(vm, tmp_path):
+    batch = tmp_path / "batch.txt"
+    batch.write_text("carol\n# комментарий\nshard-1 node-1\n")
+    with pytest.raises(RuntimeError, match=f"{batch}:3"):
+        vm.read_batch(str(batch))
+
+
+def test_add_many_rejects_shard_name(vm, dockerd, shard, capsys):
+    assert vm.add_many([(shard, None), ("carol", "node-2")]) == 1
+    records = {r["username"]: r for r in map(json.loads, capsys.readouterr().out.splitlines())}
+    assert records[shard]["error"] == vm.RESERVED_NAME_ERROR
+    assert "link" in records["carol"]
+    assert_shard_intact(vm, dockerd, shard)
+
+
+def test_add_shared_and_single_reject_shard_name(vm, dockerd, shard):
+    [record] = vm.add_shared_users([(shard, "node-1")])
+    assert record["error"] == vm.RESERVED_NAME_ERROR
+    [record] = vm.add_single_users([shard])
+    assert record["error"] == vm.RESERVED_NAME_ERROR
+    assert json.loads(vm.SINGLE_STATE_FILE.read_text())["pending"] == 0
+    with pytest.raises(RuntimeError, match="зарезервированы"):
+        vm.add_user(shard)
+    assert_shard_intact(vm, dockerd, shard)
+
+
+def test_remove_refuses_shard_name(vm, dockerd, shard):
+    with pytest.raises(RuntimeError, match="общий сервис"):
+        vm.drop_user(shard)
+    assert_shard_intact(vm, dockerd, shard)
+
+    # Шард уходит вместе с последним клиентом — и из shards.json, и из хранилища
+    vm.drop_user("alice")
+    vm.drop_user("bob")
+    assert vm._shard_service_name(shard) not in dockerd.state.services
+    assert json.loads(vm.SHARDS_FILE.read_text())["shards"] == {}
+    assert vm.STORE.list_users() == [] and vm.PORTS.used() == []
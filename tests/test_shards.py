@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import threading
+
+import pytest
+
+from conftest import TOOLS_DIR
+from fake_xray_api import FakeXrayApiServer
+
+
+@pytest.fixture
+def xray(vm, monkeypatch):
+    server = FakeXrayApiServer("127.0.0.1:0")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    monkeypatch.setattr(vm, "XRAY_API", vm.XrayApi(f"{sys.executable} {TOOLS_DIR / 'fake_xray_api.py'}",
+                                                   f"{host}:{port}"))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def published_clients(vm, shard_id: str) -> set[str]:
+    """Клиенты шарда в Docker config, подключённом к сервису, — то, что увидит перезапущенная задача."""
+    spec = vm.DOCKER.service_spec(vm._shard_service_name(shard_id))
+    config_name = spec["TaskTemplate"]["ContainerSpec"]["Configs"][0]["ConfigName"]
+    config = json.loads(vm.DOCKER.config_data([config_name])[config_name])
+    return {client["email"] for client in config["inbounds"][0]["settings"]["clients"]}
+
+
+def test_hot_add_does_not_restart_shard(vm, dockerd, xray):
+    shard_id = vm.add_shared_users([("alice", None)], hot=True)[0]["shard"]
+    service = dict(dockerd.state.services[vm._shard_service_name(shard_id)])
+    mutations = dockerd.state.mutations
+
+    vm.add_shared_users([("bob", None), ("carol", None)], hot=True)
+    vm.remove_shared_user("carol", hot=True)   # заглушка знает только добавленных вживую
+
+    assert set(xray.state.inbounds[vm.SHARD_INBOUND_TAG]) == {"bob"}
+    # Ни одной записи в Docker: задача шарда не перезапускалась
+    assert dockerd.state.mutations == mutations
+    assert dockerd.state.services[vm._shard_service_name(shard_id)]["ContainerID"] == service["ContainerID"]
+    state = json.loads(vm.SHARDS_FILE.read_text())["shards"][shard_id]
+    assert state["pending"] is True and set(state["clients"]) == {"alice", "bob"}
+    config = json.loads((vm.SHARD_CONFIGS_DIR / f"{shard_id}.json").read_text())
+    assert {c["email"] for c in config["inbounds"][0]["settings"]["clients"]} == {"alice", "bob"}
+    assert published_clients(vm, shard_id) == {"alice"}
+
+
+def test_sync_shards_publishes_pending(vm, xray):
+    shard_id = vm.add_shared_users([("alice", None)], hot=True)[0]["shard"]
+    vm.add_shared_users([("bob", None)], hot=True)
+
+    assert vm.sync_shards() == [shard_id]
+    assert published_clients(vm, shard_id) == {"alice", "bob"}
+    assert "pending" not in json.loads(vm.SHARDS_FILE.read_text())["shards"][shard_id]
+    assert vm.sync_shards() == []
+
+
+def test_restarting_change_publishes_pending(vm, dockerd, xray):
+    shard_id = vm.add_shared_users([("alice", "node-1")], hot=True)[0]["shard"]
+    vm.add_shared_users([("bob", "node-1")], hot=True)
+    configs = set(dockerd.state.configs)
+
+    # Перенос шарда всё равно перезапускает задачу — горячий bob публикуется тем же обновлением
+    vm.migrate_user(shard_id, "node-2")
+    assert published_clients(vm, shard_id) == {"alice", "bob"}
+    assert vm.actual_user_state()["bob"]["node"] == "node-2"
+    state = json.loads(vm.SHARDS_FILE.read_text())["shards"][shard_id]
+    assert "pending" not in state and state["node"] == "node-2"
+    assert len(dockerd.state.configs) == 1 and not set(dockerd.state.configs) & configs
+
+    # Изменение без hot перезапускает шард и тоже подхватывает накопленное
+    vm.add_shared_users([("carol", "node-2")], hot=True)
+    vm.add_shared_users([("dave", "node-2")])
+    assert published_clients(vm, shard_id) == {"alice", "bob", "carol", "dave"}
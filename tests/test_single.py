@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Общий контейнер: изменения, пришедшие за debounce, применяются одним перезапуском."""
+
+import json
+import time
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def single(vm, dockerd):
+    """Общий контейнер уже создан первой перезагрузкой."""
+    vm.add_single_users(["alice"])
+    assert len(vm.reload_single(debounce=0, max_delay=1)) == 1
+    assert "xray-server" in dockerd.state.containers and dockerd.state.restarts == 0
+    return vm
+
+
+def test_concurrent_changes_coalesce_into_one_restart(single, dockerd):
+    vm = single
+    users = [f"user{i}" for i in range(12)]
+    results = {}
+    barrier = threading.Barrier(len(users) + 1)
+
+    def change(username: str, delay: float) -> None:
+        barrier.wait()
+        time.sleep(delay)
+        vm.add_single_users([username])
+        results[username] = vm.reload_single(debounce=0.3, max_delay=5)
+
+    threads = [threading.Thread(target=change, args=(u, i * 0.02)) for i, u in enumerate(users)]
+    threads.append(threading.Thread(target=lambda: (barrier.wait(), time.sleep(0.1), vm.remove_single_user("alice"))))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert dockerd.state.restarts == 1
+    reloads = [r for r in results.values() if r]
+    assert len(reloads) == 1 and [r["ops"] for r in reloads[0]] == [len(users) + 1]
+    config = json.loads(vm.SINGLE_CONFIG_FILE.read_text())
+    assert sorted(c["email"] for c in config["inbounds"][0]["settings"]["clients"]) == sorted(users)
+
+
+def test_change_during_restart_gets_next_reload(single, dockerd, monkeypatch):
+    vm = single
+    restart = vm._restart_single_container
+
+    def slow_restart():
+        if dockerd.state.restarts == 0:
+            vm.add_single_users(["late"])   # пришло, пока контейнер перезапускается
+        restart()
+
+    monkeypatch.setattr(vm, "_restart_single_container", slow_restart)
+    vm.add_single_users(["bob"])
+    reloads = vm.reload_single(debounce=0, max_delay=1)
+    assert [r["ops"] for r in reloads] == [1, 1]
+    assert dockerd.state.restarts == 2
+    assert vm.reload_single(debounce=0, max_delay=1) == []
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Хранилище пользователей: запросы без Docker, reconcile и расхождение со Swarm."""
+
+import pytest
+
+from conftest import TOOLS_DIR
+
+
+@pytest.fixture(params=["api", "cli"])
+def docker(vm, request, monkeypatch):
+    if request.param == "cli":
+        monkeypatch.setattr(vm, "DOCKER", vm.DockerCLI(binary=str(TOOLS_DIR / "fake_docker.py")))
+    return vm.DOCKER
+
+
+def node_constraints(dockerd, service_name):
+    placement = dockerd.state.services[service_name]["Spec"]["TaskTemplate"].get("Placement") or {}
+    return [c for c in placement.get("Constraints") or [] if c.startswith("node.hostname==")]
+
+
+def test_link_and_list_make_no_docker_requests(vm, dockerd):
+    record = vm.provision_user("alice", vm.get_next_port(), vm.generate_x25519_keys(), "node-1")
+    requests = dockerd.state.requests
+    assert vm.get_user_link("alice")["link"] == record["link"]
+    assert [u["username"] for u in vm.STORE.list_users()] == ["alice"]
+    assert dockerd.state.requests == requests
+    with pytest.raises(RuntimeError, match="не найден"):
+        vm.get_user_link("bob")
+
+
+def test_reconcile_restores_store_and_ports(vm, dockerd, tmp_path):
+    alice = vm.provision_user("alice", vm.get_next_port(), vm.generate_x25519_keys(), "node-1")
+    vm.provision_user("bob", vm.get_next_port(), vm.generate_x25519_keys(), "node-2")
+    vm.STORE.delete_user("alice")
+    vm.STORE.update_user("bob", node="node-3", port=1)
+    vm.STORE.upsert_user({**vm.STORE.get_user("bob"), "username": "ghost", "port": 2})
+    vm.PORTS.rebuild([])
+
+    services = vm.list_vless_services()
+    assert vm.reconcile_ports(services) == 2
+    counts = vm.reconcile_store(services)
+    assert (counts["imported"], counts["missing"]) == (1, 1)
+
+    assert vm.get_user_link("alice")["link"] == alice["link"]   # ключи прочитаны из Docker config
+    bob = vm.STORE.get_user("bob")
+    assert (bob["node"], bob["port"]) == ("node-2", alice["port"] + 1)
+    assert vm.STORE.get_user("ghost")["status"] == "missing"
+    assert vm.PORTS.used() == [alice["port"], alice["port"] + 1]
+
+
+def test_migrate_uses_actual_placement_when_store_drifted(vm, docker, dockerd):
+    vm.provision_user("alice", vm.get_next_port(), vm.generate_x25519_keys(), "node-1")
+    vm.STORE.update_user("alice", node="node-3")   # хранилище разошлось со Swarm
+
+    vm.migrate_user("alice", "node-2")
+    assert node_constraints(dockerd, "vless-alice") == ["node.hostname==node-2"]
+    assert vm.STORE.get_user("alice")["node"] == "node-2"
+    assert vm.actual_user_state()["alice"]["node"] == "node-2"
+
+    # Повторный перенос на ту же ноду не добавляет вторую привязку
+    vm.migrate_user("alice", "node-2")
+    assert node_constraints(dockerd, "vless-alice") == ["node.hostname==node-2"]
+
+
+def test_migrate_missing_service_fails(vm, docker):
+    with pytest.raises(RuntimeError, match="vless-nobody"):
+        vm.migrate_user("nobody", "node-2")
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Трассировка: выключенная ничего не вычисляет, включённая пишет спаны и сводку."""
+
+import json
+
+import pytest
+
+import vless_manager
+from conftest import TOOLS_DIR
+
+
+@pytest.fixture
+def tracer(tmp_path, monkeypatch):
+    tracer = vless_manager.Tracer()
+    monkeypatch.setattr(vless_manager, "TRACER", tracer)
+    yield tracer
+    tracer.close()
+
+
+def spans(path) -> list[dict]:
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_disabled_tracer_does_not_build_names(tracer, monkeypatch):
+    def fail(*args):
+        raise AssertionError("имя спана вычислено при выключенной трассировке")
+
+    monkeypatch.setattr(vless_manager, "_api_route", fail)
+    with tracer.span("docker", lambda: fail()) as span:
+        span.set(status=200)
+    assert span is vless_manager._NO_SPAN
+
+
+@pytest.mark.parametrize("backend", ["api", "cli"])
+def test_docker_calls_are_traced(vm, tracer, tmp_path, monkeypatch, capsys, backend):
+    if backend == "cli":
+        monkeypatch.setattr(vm, "DOCKER", vm.DockerCLI(binary=str(TOOLS_DIR / "fake_docker.py")))
+    tracer.enable(tmp_path / "trace.jsonl", "add")
+    vm.provision_user("alice", vm.get_next_port(), vm.generate_x25519_keys(), "node-1")
+    vm.DOCKER.service_spec("vless-missing")
+    tracer.close()
+
+    records = spans(tmp_path / "trace.jsonl")
+    names = {(r["kind"], r["name"]) for r in records}
+    if backend == "api":
+        assert ("docker", "POST /services/create") in names
+        assert ("docker", "GET /services/{id}") in names   # ID и имена сворачиваются в шаблон маршрута
+    else:
+        assert ("docker", "service create") in names
+    assert ("sqlite", "upsert users") in names
+    assert records[-1]["kind"] == "command" and records[-1]["name"] == "add"
+    assert "Трассировка" in capsys.readouterr().err
+
+
+def test_deploy_master_shares_the_tracer():
+    import deploy_master
+    assert deploy_master.TRACER is vless_manager.TRACER
+    assert not hasattr(deploy_master, "Tracer")
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Разбор вывода twc на выводе настоящего twc 2.15 (tests/fixtures/twc):
+таблицы по умолчанию, -o raw/json/yaml и сообщения об ошибках.
+"""
+
+import sys
+import asyncio
+from pathlib import Path
+
+import pytest
+
+import deploy_master as dm
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures" / "twc"
+LIST_FORMATS = {"default": "server_list.txt", "raw": "server_list.raw", "json": "server_list.json",
+                "yaml": "server_list.yaml"}
+
+
+def fixture(name: str) -> str:
+    return (FIXTURES / name).read_text()
+
+
+def test_parse_table_names_with_spaces():
+    servers = dm.parse_table(fixture("server_list.txt"))
+    assert [(s["id"], s["name"], s["location"], s["status"]) for s in servers] == [
+        ("4012345", "master-1", "nl-1", "on"),
+        ("4012346", "master-2 test node", "nl-1", "installing"),
+        ("4012347", "master-3", "nl-1", "off"),
+    ]
+    assert servers[1]["networks"] == []
+    assert dm.server_from_api(servers[0]).ip == "185.10.20.31"
+
+
+@pytest.mark.parametrize("output_format", list(LIST_FORMATS))
+def test_parse_server_list_formats(output_format):
+    servers = dm.parse_server_list(fixture(LIST_FORMATS[output_format]), output_format)
+    assert list(servers) == ["4012345", "4012346", "4012347"]
+    assert servers["4012346"]["name"] == "master-2 test node"
+    assert {i: s["status"] for i, s in servers.items()} == {"4012345": "on", "4012346": "installing",
+                                                             "4012347": "off"}
+    assert dm.server_from_api(servers["4012347"]).ip == "185.10.20.33"
+    assert dm.server_from_api(servers["4012346"]).ip is None
+
+
+@pytest.mark.parametrize("name, output_format", [("server_get.txt", "default"), ("server_get.raw", "raw"),
+                                                 ("server_get.yaml", "yaml")])
+def test_parse_server(name, output_format):
+    server = dm.parse_server(fixture(name), output_format)
+    assert (str(server["id"]), server["name"], server["status"]) == ("4012346", "master-2 test node", "installing")
+
+
+@pytest.mark.parametrize("name, output_format", [("server_create.txt", "default"), ("server_create.raw", "raw"),
+                                                 ("server_create.json", "json")])
+def test_parse_created_id(name, output_format):
+    assert dm.parse_created_id(fixture(name), output_format) == "4012348"
+
+
+def test_parse_structured_strips_colors():
+    colored = fixture("server_get.raw").replace('"status"', '\x1b[94m"status"\x1b[39;49;00m')
+    assert dm.parse_structured(colored)["server"]["status"] == "installing"
+
+
+@pytest.mark.parametrize("call, text", [
+    (dm.parse_structured, ""),
+    (dm.parse_structured, '["not", "an", "object"]'),
+    (dm.parse_structured, "{not json: [}"),
+    (dm.parse_table, ""),
+    (dm.parse_table, "Error: No such option: --output\n"),
+    (dm.parse_table, "ID  NAME  STATUS\nabc  x  on\n"),
+    (lambda text: dm.parse_server(text, "default"), fixture("server_list.txt")),
+    (lambda text: dm.parse_server(text, "raw"), '{"server": {"id": 1}}'),
+    (lambda text: dm.parse_server_list(text, "raw"), '{"meta": {"total": 0}}'),
+    (lambda text: dm.parse_created_id(text, "default"), fixture("error_429.txt")),
+    (lambda text: dm.parse_created_id(text, "raw"), '{"response_id": "x"}'),
+])
+def test_malformed_output_raises(call, text):
+    with pytest.raises(dm.TwcParseError):
+        call(text)
+
+
+def fake_twc(tmp_path, monkeypatch, body: str) -> None:
+    """Подменяет twc скриптом с телом body (args — аргументы командной строки)."""
+    script = tmp_path / "twc"
+    script.write_text(f"#!{sys.executable}\nimport sys\nargs = sys.argv[1:]\n{body}\n")
+    script.chmod(0o755)
+    monkeypatch.setattr(dm, "TWC_BIN", str(script))
+
+
+def test_twc_output_falls_back_to_table(tmp_path, monkeypatch):
+    # Старый twc без --output: ошибка click, а без опции — таблица
+    fake_twc(tmp_path, monkeypatch, f"""
+if "--output" in args:
+    sys.stderr.write({fixture("error_no_such_option.txt")!r})
+    sys.exit(2)
+sys.stdout.write({fixture("server_list.txt")!r})
+""")
+    output = dm.TwcOutput("raw")
+    text, output_format = asyncio.run(output.run("server", "list"))
+    assert output_format == "default" and output.format == "default"
+    assert list(dm.parse_server_list(text, output_format)) == ["4012345", "4012346", "4012347"]
+
+
+def test_twc_output_error_is_not_fallback(tmp_path, monkeypatch):
+    fake_twc(tmp_path, monkeypatch, f"""
+sys.stderr.write({fixture("error_429.txt")!r})
+sys.exit(1)
+""")
+    output = dm.TwcOutput("raw")
+    with pytest.raises(dm.TwcError) as error:
+        asyncio.run(output.run("server", "list"))
+    assert error.value.transient
+    assert output.format == "raw"
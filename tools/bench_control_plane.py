@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный бенчмарк управляющей части vless_manager.py без настоящего Docker.
+Для каждого масштаба (по умолчанию 10, 100, 1000 и 10000 пользователей) в
+отдельном временном каталоге поднимается заглушка tools/fake_dockerd.py с
+заданной задержкой, и операции выполняются по разу на каждого пользователя:
+
+    get_next_port, release_port, allocate_ports (пакетом),
+    create_config_object, create_docker_config, build_vless_link, user_link,
+    provision_user (add), migrate_user, discard_user (remove),
+    list_vless_services и reconcile_store на заполненном кластере.
+
+Для каждой операции пишутся число вызовов, пропускная способность и
+перцентили задержки; результат — JSON (по умолчанию в bench-results/),
+чтобы сравнивать версии:
+
+    python3 tools/bench_control_plane.py [--scales 10,100,1000] [--latency-ms 1]
+        [--backend api|cli] [--out results.json] [--baseline old.json [--threshold 1.25]]
+
+С --baseline печатается отношение p50 к прошлому прогону, и код возврата 1,
+если какая-то операция замедлилась больше чем в --threshold раз.
+Бэкенд cli запускает tools/fake_docker.py на каждую операцию Docker, поэтому
+на 10000 пользователей он заметно дольше.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+REPO_DIR = TOOLS_DIR.parent
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(TOOLS_DIR))
+
+import vless_manager as vm  # noqa: E402
+from fake_dockerd import FakeDockerDaemon  # noqa: E402
+
+DEFAULT_SCALES = "10,100,1000,10000"
+RESULTS_DIR = REPO_DIR / "bench-results"
+NODES = ["node-1", "node-2", "node-3"]
+# Генерация x25519 на чистом Python не зависит от масштаба — меряем на небольшой выборке,
+# а пользователям раздаём одну заранее созданную пару
+KEYGEN_SAMPLES = 20
+# Разница p50 меньше этой считается шумом и регрессией не помечается
+MIN_REGRESSION_MS = 0.01
+
+
+def summarize(samples: list[float], wall: float) -> dict:
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 4)
+
+    return {
+        "count": len(ordered),
+        "total_s": round(wall, 4),
+        "ops_per_s": round(len(ordered) / wall, 1) if wall else None,
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 4),
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+        "max_ms": round(ordered[-1] * 1000, 4),
+    }
+
+
+class Recorder:
+    """Замеры по операциям: {операция: сводка}."""
+
+    def __init__(self):
+        self.results: dict[str, dict] = {}
+
+    def each(self, op: str, items, call) -> list:
+        """Вызывает call(item) для каждого item, замеряя каждый вызов."""
+        samples, values = [], []
+        started = time.perf_counter()
+        for item in items:
+            t0 = time.perf_counter()
+            values.append(call(item))
+            samples.append(time.perf_counter() - t0)
+        self.results[op] = summarize(samples, time.perf_counter() - started)
+        return values
+
+    def once(self, op: str, call, count: int = 1):
+        """Один вызов, обрабатывающий count элементов (пакетная операция)."""
+        started = time.perf_counter()
+        value = call()
+        wall = time.perf_counter() - started
+        self.results[op] = {**summarize([wall], wall), "items": count,
+                            "items_per_s": round(count / wall, 1) if wall else None}
+        return value
+
+
+def isolate(workdir: Path, socket_path: str, backend: str) -> None:
+    """Переключает глобальное состояние vless_manager на временный каталог и заглушку."""
+    vm.PORTS = vm.PortAllocator(workdir / "ports.bitmap")
+    vm.STORE = vm.StateStore(workdir / "state.db")
+    vm.SHARDS_FILE = workdir / "shards.json"
+    vm.SHARD_CONFIGS_DIR = workdir / "shards"
+    vm.NODE_STATS_FILE = workdir / "node_stats.json"
+    vm.CLEANUP_STAMP_FILE = workdir / "cleanup.stamp"
+    vm.USED_PORTS_FILE = workdir / "used_ports.txt"
+    if backend == "cli":
+        vm.DOCKER = vm.DockerCLI(binary=str(TOOLS_DIR / "fake_docker.py"))
+    else:
+        vm.DOCKER = vm.DockerEngineAPI(socket_path=socket_path)
+
+
+def run_scale(users: int, latency: float, backend: str) -> dict:
+    rec = Recorder()
+    names = [f"user{i:05d}" for i in range(users)]
+    with tempfile.TemporaryDirectory(prefix="vless-bench-") as tmp:
+        workdir = Path(tmp)
+        socket_path = str(workdir / "docker.sock")
+        daemon = FakeDockerDaemon(socket_path, latency, ",".join(NODES)).start()
+        os.environ["DOCKER_HOST"] = f"unix://{socket_path}"
+        isolate(workdir, socket_path, backend)
+        try:
+            # Порты: по одному и пакетом
+            ports = rec.each("get_next_port", names, lambda _: vm.get_next_port())
+            rec.each("release_port", ports, vm.release_port)
+            vm.release_ports(rec.once("allocate_ports", lambda: vm.allocate_ports(users), users))
+
+            # Конфиги и ссылки — без Docker
+            private_key, public_key = rec.each("generate_x25519_keys", range(min(users, KEYGEN_SAMPLES)),
+                                               lambda _: vm.generate_x25519_keys())[0]
+            rec.each("create_config_object", names,
+                     lambda name: vm.create_config_object(name, "00000000-0000-4000-8000-000000000000",
+                                                          private_key, "0123abcd", metrics=False))
+            rec.each("build_vless_link", enumerate(names),
+                     lambda item: vm.build_vless_link(item[1], "00000000-0000-4000-8000-000000000000",
+                                                      vm.PORT_RANGE_START + item[0], public_key, "0123abcd"))
+
+            # Docker config отдельно, затем полный add (config + сервис + хранилище)
+            config = vm.create_config_object("bench", "00000000-0000-4000-8000-000000000000",
+                                             private_key, "0123abcd", metrics=False)
+            rec.each("create_docker_config", names,
+                     lambda name: vm.create_docker_config(name, config, f"bench-config-{name}"))
+            rec.each("provision_user", enumerate(names),
+                     lambda item: vm.provision_user(item[1], vm.get_next_port(), (private_key, public_key),
+                                                    NODES[item[0] % len(NODES)]))
+
+            # Операции на заполненном кластере
+            users_by_name = {u["username"]: u for u in vm.STORE.list_users()}
+            rec.each("user_link", names, lambda name: vm.user_link(users_by_name[name]))
+            rec.each("store_get_user", names, vm.STORE.get_user)
+            services = rec.once("list_vless_services", vm.list_vless_services, users)
+            rec.once("reconcile_store", lambda: vm.reconcile_store(services), users)
+            rec.each("migrate_user", enumerate(names),
+                     lambda item: vm.migrate_user(item[1], NODES[(item[0] + 1) % len(NODES)]))
+            rec.each("discard_user", names, vm.discard_user)
+            requests = daemon.state.requests
+        finally:
+            daemon.stop()
+    return {"users": users, "docker_requests": requests, "operations": rec.results}
+
+
+def source_version() -> dict:
+    """Версия кода, которую мерили: хэш vless_manager.py и (если есть) коммит git."""
+    digest = hashlib.sha256((REPO_DIR / "vless_manager.py").read_bytes()).hexdigest()[:12]
+    try:
+        commit = subprocess.run(["git", "-C", str(REPO_DIR), "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        commit = None
+    return {"vless_manager_sha256": digest, "git_commit": commit}
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """Печатает отношение p50 к базовому прогону; возвращает список регрессий."""
+    regressions = []
+    for key in ("backend", "latency_ms"):
+        if baseline.get(key) != current[key]:
+            print(f"⚠️ Прогоны несравнимы: {key} было {baseline.get(key)!r}, стало {current[key]!r}")
+    print(f"\n{'масштаб':>8}  {'операция':<22}{'было p50, мс':>14}{'стало p50, мс':>15}{'x':>8}")
+    for scale, result in current["scales"].items():
+        old_ops = baseline.get("scales", {}).get(scale, {}).get("operations", {})
+        for op, stats in result["operations"].items():
+            old = old_ops.get(op)
+            if not old or not old["p50_ms"]:
+                continue
+            ratio = stats["p50_ms"] / old["p50_ms"]
+            slower = ratio > threshold and stats["p50_ms"] - old["p50_ms"] > MIN_REGRESSION_MS
+            mark = "  <-- регрессия" if slower else ""
+            print(f"{scale:>8}  {op:<22}{old['p50_ms']:>14.3f}{stats['p50_ms']:>15.3f}{ratio:>8.2f}{mark}")
+            if mark:
+                regressions.append(f"{scale}/{op}")
+    return regressions
+
+
+def print_table(report: dict) -> None:
+    print(f"{'масштаб':>8}  {'операция':<22}{'ops/s':>12}{'p50, мс':>11}{'p95, мс':>11}{'p99, мс':>11}")
+    for scale, result in report["scales"].items():
+        for op, stats in result["operations"].items():
+            rate = stats.get("items_per_s", stats["ops_per_s"]) or 0
+            print(f"{scale:>8}  {op:<22}{rate:>12.1f}"
+                  f"{stats['p50_ms']:>11.3f}{stats['p95_ms']:>11.3f}{stats['p99_ms']:>11.3f}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default=DEFAULT_SCALES, help="числа пользователей через запятую")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка заглушки Docker на каждый запрос")
+    parser.add_argument("--backend", choices=("api", "cli"), default="api")
+    parser.add_argument("--out", type=Path, help="файл результатов (по умолчанию bench-results/<время>.json)")
+    parser.add_argument("--baseline", type=Path, help="прошлый результат для сравнения")
+    parser.add_argument("--threshold", type=float, default=1.25, help="допустимое замедление p50")
+    args = parser.parse_args(argv)
+
+    try:
+        scales = [int(s) for s in args.scales.split(",") if s.strip()]
+    except ValueError:
+        parser.error("--scales: ожидаются числа через запятую")
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "source": source_version(),
+        "python": platform.python_version(),
+        "backend": args.backend,
+        "latency_ms": args.latency_ms,
+        "scales": {},
+    }
+    for users in scales:
+        print(f"… {users} пользователей", file=sys.stderr, flush=True)
+        report["scales"][str(users)] = run_scale(users, args.latency_ms / 1000, args.backend)
+
+    out = args.out or RESULTS_DIR / f"control-plane-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print_table(report)
+    print(f"\nРезультаты: {out}")
+
+    if args.baseline:
+        regressions = compare(report, json.loads(args.baseline.read_text()), args.threshold)
+        if regressions:
+            print(f"\n⚠️ Замедление больше {args.threshold}x: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
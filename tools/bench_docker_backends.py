@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнивает задержку операций vless_manager.py для двух бэкендов Docker:
+CLI (процесс на каждую операцию) и Engine API (пул keep-alive соединений).
+Оба бэкенда работают с одной заглушкой tools/fake_dockerd.py, поднятой
+внутри процесса; CLI-бэкенд вызывает tools/fake_docker.py.
+
+    python3 tools/bench_docker_backends.py [--iterations 20] [--latency-ms 0] [--json]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(TOOLS_DIR.parent))
+sys.path.insert(0, str(TOOLS_DIR))
+
+from fake_dockerd import FakeDockerDaemon  # noqa: E402
+from vless_manager import DockerCLI, DockerEngineAPI  # noqa: E402
+
+CONFIG_DATA = json.dumps({"log": {"loglevel": "warning"}}).encode("utf-8")
+
+
+def run_operations(backend, iteration: int, timings: dict[str, list[float]]) -> None:
+    """
+    Один цикл жизни пользователя: config → service → inspect/list → migrate → удаление.
+    """
+    name = f"bench-{backend.name}-{iteration}"
+    config = f"vless-config-{name}"
+    service = f"vless-{name}"
+    steps = [
+        ("config_create", lambda: backend.config_create(config, CONFIG_DATA)),
+        ("service_create", lambda: backend.service_create(service, 20000 + iteration, config,
+                                                          [], {"vless-port": 20000 + iteration})),
+        ("service_spec", lambda: backend.service_spec(service)),
+        ("service_specs", lambda: backend.service_specs("vless-port")),
+        ("service_update", lambda: backend.service_update(service, constraints_add=["node.hostname==bench"])),
+        ("config_data", lambda: backend.config_data([config])),
+        ("service_rm", lambda: backend.service_rm(service)),
+        ("config_rm", lambda: backend.config_rm(config)),
+    ]
+    for op, call in steps:
+        started = time.perf_counter()
+        call()
+        timings.setdefault(op, []).append((time.perf_counter() - started) * 1000)
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "mean_ms": round(statistics.fmean(ordered), 3),
+        "p50_ms": round(ordered[len(ordered) // 2], 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка заглушки на каждый запрос")
+    parser.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        socket_path = os.path.join(tmp, "docker.sock")
+        daemon = FakeDockerDaemon(socket_path, args.latency_ms / 1000).start()
+        os.environ["DOCKER_HOST"] = f"unix://{socket_path}"
+        backends = [
+            DockerCLI(binary=str(TOOLS_DIR / "fake_docker.py")),
+            DockerEngineAPI(socket_path=socket_path),
+        ]
+        results = {}
+        try:
+            for backend in backends:
+                timings: dict[str, list[float]] = {}
+                for i in range(args.iterations):
+                    run_operations(backend, i, timings)
+                results[backend.name] = {op: summarize(samples) for op, samples in timings.items()}
+        finally:
+            daemon.stop()
+
+    if args.json:
+        print(json.dumps({"iterations": args.iterations, "latency_ms": args.latency_ms, "results": results},
+                         indent=2))
+        return 0
+
+    print(f"{'операция':<16}{'cli p50, мс':>14}{'api p50, мс':>14}{'ускорение':>12}")
+    for op in results["cli"]:
+        cli, api = results["cli"][op]["p50_ms"], results["api"][op]["p50_ms"]
+        print(f"{op:<16}{cli:>14.2f}{api:>14.2f}{cli / api if api else float('inf'):>11.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Заглушка CLI `docker`: разбирает те же аргументы, что передаёт vless_manager.py
+(бэкенд cli), и выполняет их через Engine API заглушки tools/fake_dockerd.py.
+Так оба бэкенда работают с одним состоянием, а разница во времени — это цена
+запуска отдельного процесса на каждую операцию.
+
+    DOCKER_HOST=unix:///tmp/fake-docker.sock DOCKER_BIN=tools/fake_docker.py python3 vless_manager.py add alice
+"""
+
+import sys
+import json
+import base64
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from vless_manager import DockerEngineAPI  # noqa: E402
+
+
+def _options(args: list[str], flag: str) -> list[str]:
+    return [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == flag]
+
+
+def _positional(args: list[str], with_value: tuple[str, ...]) -> list[str]:
+    result, skip = [], False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in with_value:
+            skip = True
+        elif not arg.startswith("-") or arg == "-":
+            result.append(arg)
+    return result
+
+
+def _source(value: str) -> str:
+    return dict(kv.split("=", 1) for kv in value.split(","))["source"]
+
+
+def main(argv: list[str]) -> int:
+    api = DockerEngineAPI()
+    group, command, args = (argv + ["", ""])[0], (argv + ["", ""])[1], argv[2:]
+    try:
+        if (group, command) == ("config", "create"):
+            name = _positional(args, ("--label",))[0]
+            labels = dict(item.split("=", 1) for item in _options(args, "--label"))
+            api.config_create(name, sys.stdin.buffer.read(), labels)
+        elif (group, command) == ("config", "rm"):
+            return 0 if api.config_rm(args[0]) else 1
+        elif (group, command) == ("config", "inspect"):
+            names = _positional(args, ("--format",))
+            if "CreatedAt" in (_options(args, "--format") or [""])[0]:
+                configs = api._call("GET", "/configs", query=api._filters(names=names))
+                for config in configs:
+                    print(config["Spec"]["Name"], json.dumps(config["CreatedAt"]))
+                return 0
+            for name, data in api.config_data(names).items():
+                print(name, json.dumps(base64.b64encode(data).decode("ascii")))
+        elif (group, command) == ("service", "create"):
+            name = _options(args, "--name")[0]
+            publish = dict(kv.split("=", 1) for kv in _options(args, "--publish")[0].split(","))
+            labels = dict(item.split("=", 1) for item in _options(args, "--label"))
+            container_labels = dict(item.split("=", 1) for item in _options(args, "--container-label"))
+            api.service_create(name, int(publish["published"]), _source(_options(args, "--config")[0]),
+                               _options(args, "--constraint"), labels, container_labels)
+        elif (group, command) == ("service", "rm"):
+            return 0 if api.service_rm(args[0]) else 1
+        elif (group, command) == ("service", "ls"):
+            labels = [f[len("label="):] for f in _options(args, "--filter") if f.startswith("label=")]
+            for spec in api.service_specs(labels[0] if labels else ""):
+                print(spec["Name"])
+        elif (group, command) == ("service", "inspect"):
+            for name in _positional(args, ("--format",)):
+                spec = api.service_spec(name)
+                if spec is None:
+                    print(f"Error: no such service: {name}", file=sys.stderr)
+                    return 1
+                print(json.dumps(spec))
+        elif (group, command) == ("service", "update"):
+            api.service_update(
+                args[-1],
+                constraints_rm=_options(args, "--constraint-rm"),
+                constraints_add=_options(args, "--constraint-add"),
+                config_rm=(_options(args, "--config-rm") or [None])[0],
+                config_add=next((_source(v) for v in _options(args, "--config-add")), None),
+            )
+        elif group == "ps":
+            label = next(f[len("label="):] for f in _options(argv, "--filter") if f.startswith("label="))
+            if label.startswith("com.docker.swarm.service.name="):
+                print("\n".join(api.service_containers(label.split("=", 1)[1])))
+            else:
+                for cid, service in api.local_containers(label).items():
+                    print(f"{cid}\t{service}")
+        elif (group, command) == ("config", "ls"):
+            labels = [f[len("label="):] for f in _options(args, "--filter") if f.startswith("label=")]
+            print("\n".join(api.config_created(labels[0] if labels else "")))
+        elif (group, command) == ("node", "ls"):
+            print("\n".join(n["ID"] for n in api.node_list()))
+        elif (group, command) == ("node", "inspect"):
+            wanted = set(_positional(args, ("--format",)))
+            print(json.dumps([n for n in api.node_list() if n["ID"] in wanted], indent=4))
+        elif (group, command) == ("node", "ps"):
+            wanted = set(_positional(args, ("--filter", "--format")))
+            nodes = {n["Description"]["Hostname"] for n in api.node_list() if n["ID"] in wanted}
+            for service, node in api.running_tasks().items():
+                if node in nodes:
+                    print(f"{service}.1\t{node}")
+        elif group == "restart":
+            return 0 if api.container_restart(command) else 1
+        elif group == "run":
+            args = argv[1:]
+            volumes = dict(v.rsplit(":", 1) for v in _options(args, "-v"))
+            ports = [int(p.split(":", 1)[0]) for p in _options(args, "-p")]
+            api.container_run(_options(args, "--name")[0], volumes, ports,
+                              host_network=_options(args, "--network") == ["host"])
+        elif (group, command) == ("container", "prune"):
+            labels = [f[len("label="):] for f in _options(args, "--filter") if f.startswith("label=")]
+            api.container_prune(labels[0] if labels else "")
+        else:
+            print(f"fake docker: неподдерживаемая команда: {' '.join(argv)}", file=sys.stderr)
+            return 1
+    except RuntimeError as e:
+        print(f"Error response from daemon: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
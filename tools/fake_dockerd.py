@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Заглушка Docker Engine API на Unix-сокете: хранит configs, сервисы Swarm,
+их «контейнеры» и ноды, на которых они запущены, в памяти. Реализует только те эндпоинты, которые использует
+vless_manager.py (бэкенд api), и позволяет добавить искусственную задержку.
+
+    python3 tools/fake_dockerd.py --socket /tmp/fake-docker.sock [--latency-ms 5]
+    VLESS_DOCKER_BACKEND=api DOCKER_HOST=unix:///tmp/fake-docker.sock python3 vless_manager.py list --live
+
+Кроме Swarm есть отдельные контейнеры (create/start/restart) для общего
+контейнера vless_manager.py add --single.
+
+GET /_fake/stats возвращает число обработанных запросов, изменяющих (POST/DELETE)
+и перезапусков отдельных контейнеров.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import argparse
+import threading
+import socketserver
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+
+DEFAULT_NODES = "node-1,node-2,node-3"
+
+
+def _make_nodes(spec: str) -> dict[str, dict]:
+    """Ноды Swarm из строки вида "node-1,node-2:4" (после двоеточия — число CPU, по умолчанию 2)."""
+    nodes = {}
+    for item in filter(None, spec.split(",")):
+        hostname, _, cpus = item.partition(":")
+        node_id = uuid.uuid4().hex[:25]
+        nodes[node_id] = {
+            "ID": node_id,
+            "Description": {"Hostname": hostname, "Resources": {
+                "NanoCPUs": int(float(cpus or 2) * 1e9), "MemoryBytes": 4 << 30,
+            }},
+            "Spec": {"Availability": "active", "Role": "worker"},
+            "Status": {"State": "ready"},
+        }
+    return nodes
+
+
+class FakeDockerState:
+    """
+    Состояние «демона»: configs и сервисы по имени, ноды Swarm по ID.
+    Каждый сервис — одна задача на ноде: по constraint node.hostname==,
+    иначе на ноде с наименьшим числом задач. Все операции под одной блокировкой.
+    Индексы по ID, ссылки на configs и число задач на нодах ведутся отдельно,
+    чтобы цена запроса не росла с числом сервисов (заглушка нужна и для бенчмарков).
+    """
+
+    def __init__(self, nodes: str = DEFAULT_NODES):
+        self.configs: dict[str, dict] = {}
+        self.services: dict[str, dict] = {}
+        self.nodes: dict[str, dict] = _make_nodes(nodes)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.mutations = 0
+        self.restarts = 0
+        self.containers: dict[str, dict] = {}             # отдельные контейнеры (не задачи Swarm) по имени
+        self.by_id: dict[str, dict] = {}                 # ID config/сервиса -> объект
+        self.config_users: dict[str, set[str]] = {}      # ID config -> имена сервисов
+        self.node_tasks: dict[str, int] = {node_id: 0 for node_id in self.nodes}
+
+    def find(self, table: dict, key: str) -> dict | None:
+        obj = table.get(key) or self.by_id.get(key)
+        return obj if obj is not None and table.get(obj["Spec"]["Name"]) is obj else None
+
+    @staticmethod
+    def config_ids(service: dict) -> set[str]:
+        refs = service["Spec"].get("TaskTemplate", {}).get("ContainerSpec", {}).get("Configs") or []
+        return {ref.get("ConfigID") for ref in refs}
+
+    def add_config(self, config: dict) -> None:
+        self.configs[config["Spec"]["Name"]] = config
+        self.by_id[config["ID"]] = config
+
+    def remove_config(self, config: dict) -> None:
+        del self.configs[config["Spec"]["Name"]]
+        del self.by_id[config["ID"]]
+        self.config_users.pop(config["ID"], None)
+
+    def add_service(self, service: dict) -> None:
+        name = service["Spec"]["Name"]
+        self.services[name] = service
+        self.by_id[service["ID"]] = service
+        for config_id in self.config_ids(service):
+            self.config_users.setdefault(config_id, set()).add(name)
+        self.schedule(service)
+
+    def remove_service(self, service: dict) -> None:
+        name = service["Spec"]["Name"]
+        for config_id in self.config_ids(service):
+            self.config_users.get(config_id, set()).discard(name)
+        if service.get("NodeID") in self.node_tasks:
+            self.node_tasks[service["NodeID"]] -= 1
+        service["NodeID"] = None
+        del self.services[name]
+        del self.by_id[service["ID"]]
+
+    def schedule(self, service: dict) -> None:
+        constraints = ((service["Spec"].get("TaskTemplate") or {}).get("Placement") or {}).get("Constraints") or []
+        pinned = {c.split("==", 1)[1] for c in constraints if c.startswith("node.hostname==")}
+        candidates = [n for n in self.nodes.values()
+                      if not pinned or n["Description"]["Hostname"] in pinned]
+        if not candidates:
+            service["NodeID"] = None   # задача в pending: подходящей ноды нет
+            return
+        load = {n["ID"]: self.node_tasks[n["ID"]] for n in candidates}
+        service["NodeID"] = min(load, key=lambda node_id: (load[node_id], node_id))
+        self.node_tasks[service["NodeID"]] += 1
+
+
+def _label_error(*labels) -> str | None:
+    """Как и Engine API, метки принимаются только строками (map[string]string)."""
+    for mapping in labels:
+        for key, value in (mapping or {}).items():
+            if not isinstance(value, str):
+                return (f"json: cannot unmarshal {type(value).__name__} into Go struct field "
+                        f"Labels of type string (label {key!r})")
+    return None
+
+
+def _matches_labels(labels: dict, wanted: list[str]) -> bool:
+    for item in wanted:
+        key, eq, value = item.partition("=")
+        if key not in labels or (eq and str(labels[key]) != value):
+            return False
+    return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "fake-dockerd/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body=None) -> None:
+        raw = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        if raw:
+            self.wfile.write(raw)
+
+    def _error(self, status: int, message: str) -> None:
+        self._send(status, {"message": message})
+
+    def _dispatch(self, method: str) -> None:
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        path = re.sub(r"^/v[\d.]+", "", url.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        filters = json.loads(query.get("filters", "{}"))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        state = self.server.state
+        with state.lock:
+            state.requests += 1
+            state.mutations += method != "GET"
+            handler = getattr(self, "_route_" + method.lower())
+            handler(state, path, query, filters, body)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    # --- GET -------------------------------------------------------
+    def _route_get(self, state, path, query, filters, body):
+        if path == "/_ping":
+            return self._send(200, "OK")
+        if path == "/_fake/stats":
+            return self._send(200, {"requests": state.requests, "mutations": state.mutations,
+                                    "restarts": state.restarts})
+        if path == "/configs":
+            names = set(filters.get("names", []) + filters.get("name", []))
+            labels = filters.get("label", [])
+            return self._send(200, [c for n, c in state.configs.items()
+                                    if (not names or n in names)
+                                    and _matches_labels(c["Spec"].get("Labels") or {}, labels)])
+        if path.startswith("/configs/"):
+            config = state.find(state.configs, urllib.parse.unquote(path[len("/configs/"):]))
+            return self._send(200, config) if config else self._error(404, "config not found")
+        if path == "/services":
+            labels = filters.get("label", [])
+            return self._send(200, [s for s in state.services.values()
+                                    if _matches_labels(s["Spec"].get("Labels") or {}, labels)])
+        if path.startswith("/services/"):
+            service = state.find(state.services, urllib.parse.unquote(path[len("/services/"):]))
+            return self._send(200, service) if service else self._error(404, "service not found")
+        if path == "/nodes":
+            return self._send(200, list(state.nodes.values()))
+        if path == "/tasks":
+            return self._send(200, [
+                {"ID": s["ContainerID"][:25], "ServiceID": s["ID"], "NodeID": s["NodeID"],
+                 "DesiredState": "running"}
+                for s in state.services.values() if s.get("NodeID")
+            ])
+        if path == "/containers/json":
+            labels = filters.get("label", [])
+            containers = [
+                {"Id": s["ContainerID"], "Labels": {
+                    **(s["Spec"].get("TaskTemplate", {}).get("ContainerSpec", {}).get("Labels") or {}),
+                    "com.docker.swarm.service.name": s["Spec"]["Name"],
+                }}
+                for s in state.services.values()
+            ]
+            return self._send(200, [c for c in containers if _matches_labels(c["Labels"], labels)])
+        self._error(404, f"page not found: {path}")
+
+    # --- POST ------------------------------------------------------
+    def _route_post(self, state, path, query, filters, body):
+        if isinstance(body, dict):
+            error = _label_error(body.get("Labels"),
+                                 (body.get("TaskTemplate") or {}).get("ContainerSpec", {}).get("Labels"))
+            if error:
+                return self._error(400, error)
+        if path == "/configs/create":
+            if body["Name"] in state.configs:
+                return self._error(409, f"config {body['Name']} already exists")
+            base64.b64decode(body.get("Data", ""))
+            now = time.time_ns()
+            created = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now // 10**9)) + f".{now % 10**9:09d}Z"
+            config = {"ID": uuid.uuid4().hex[:25], "Version": {"Index": 1}, "CreatedAt": created, "Spec": body}
+            state.add_config(config)
+            return self._send(201, {"ID": config["ID"]})
+        if path == "/services/create":
+            name = body["Name"]
+            if name in state.services:
+                return self._error(409, f"service {name} already exists")
+            for ref in body.get("TaskTemplate", {}).get("ContainerSpec", {}).get("Configs") or []:
+                if state.find(state.configs, ref["ConfigID"]) is None:
+                    return self._error(404, f"config {ref['ConfigID']} not found")
+            service = {"ID": uuid.uuid4().hex[:25], "Version": {"Index": 1}, "Spec": body,
+                       "ContainerID": uuid.uuid4().hex}
+            state.add_service(service)
+            return self._send(201, {"ID": service["ID"]})
+        match = re.fullmatch(r"/services/([^/]+)/update", path)
+        if match:
+            service = state.find(state.services, urllib.parse.unquote(match.group(1)))
+            if service is None:
+                return self._error(404, "service not found")
+            if int(query.get("version", -1)) != service["Version"]["Index"]:
+                return self._error(500, "update out of sequence")
+            state.remove_service(service)
+            service["Spec"] = body
+            service["Version"]["Index"] += 1
+            service["ContainerID"] = uuid.uuid4().hex   # обновление перезапускает задачу
+            state.add_service(service)
+            return self._send(200, {"Warnings": None})
+        if path == "/containers/create":
+            name = query.get("name") or uuid.uuid4().hex[:12]
+            if name in state.containers:
+                return self._error(409, f"Conflict. The container name \"/{name}\" is already in use")
+            state.containers[name] = {"Id": uuid.uuid4().hex, "Name": name, "Config": body, "Running": False}
+            return self._send(201, {"Id": state.containers[name]["Id"], "Warnings": []})
+        match = re.fullmatch(r"/containers/([^/]+)/(start|restart)", path)
+        if match:
+            key = urllib.parse.unquote(match.group(1))
+            container = state.containers.get(key) or next(
+                (c for c in state.containers.values() if c["Id"] == key), None)
+            if container is None:
+                return self._error(404, f"No such container: {key}")
+            state.restarts += match.group(2) == "restart"
+            container["Running"] = True
+            return self._send(204)
+        if path in ("/containers/prune", "/networks/prune", "/images/prune", "/build/prune"):
+            return self._send(200, {"SpaceReclaimed": 0})
+        self._error(404, f"page not found: {path}")
+
+    # --- DELETE ----------------------------------------------------
+    def _route_delete(self, state, path, query, filters, body):
+        if path.startswith("/configs/"):
+            config = state.find(state.configs, urllib.parse.unquote(path[len("/configs/"):]))
+            if config is None:
+                return self._error(404, "config not found")
+            users = sorted(state.config_users.get(config["ID"]) or ())
+            if users:
+                return self._error(400, f"config is in use by the following service: {', '.join(users)}")
+            state.remove_config(config)
+            return self._send(204)
+        if path.startswith("/services/"):
+            service = state.find(state.services, urllib.parse.unquote(path[len("/services/"):]))
+            if service is None:
+                return self._error(404, "service not found")
+            state.remove_service(service)
+            return self._send(200)
+        self._error(404, f"page not found: {path}")
+
+
+class FakeDockerDaemon(socketserver.ThreadingUnixStreamServer):
+    """
+    Сервер заглушки. Можно запустить в фоне внутри процесса: FakeDockerDaemon(path).start().
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, latency: float = 0.0, nodes: str = DEFAULT_NODES):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _Handler)
+        self.socket_path = socket_path
+        self.latency = latency
+        self.state = FakeDockerState(nodes)
+
+    def start(self) -> "FakeDockerDaemon":
+        threading.Thread(target=self.serve_forever, name="fake-dockerd", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Заглушка Docker Engine API на Unix-сокете")
+    parser.add_argument("--socket", default="/tmp/fake-docker.sock")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка на каждый запрос")
+    parser.add_argument("--nodes", default=DEFAULT_NODES,
+                        help="ноды Swarm через запятую, hostname[:CPU] (по умолчанию %(default)s)")
+    args = parser.parse_args()
+
+    daemon = FakeDockerDaemon(args.socket, args.latency_ms / 1000, args.nodes)
+    print(f"fake dockerd: слушаю {args.socket}", flush=True)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
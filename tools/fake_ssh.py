@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Заглушка `ssh` для проверки bootstrap_nodes.py без настоящих серверов.
+Принимает те же аргументы, что передаёт bootstrap_nodes.py, и выполняет
+удалённую команду локально через sh -c. Каждый «хост» — отдельный каталог
+FAKE_SSH_ROOT/<host>: он становится HOME и рабочим каталогом команды,
+поэтому маркеры идемпотентности и скачанные файлы у хостов не пересекаются.
+
+Переменные окружения:
+    FAKE_SSH_ROOT        корень каталогов хостов (по умолчанию /tmp/fake_ssh)
+    FAKE_SSH_LATENCY     задержка «подключения», секунд
+    FAKE_SSH_FAIL_HOSTS  хосты через запятую, к которым подключиться нельзя (код 255)
+
+    SSH_BIN=tools/fake_ssh.py python3 bootstrap_nodes.py --script my_test.sh
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(os.getenv("FAKE_SSH_ROOT", "/tmp/fake_ssh"))
+LATENCY = float(os.getenv("FAKE_SSH_LATENCY", "0"))
+FAIL_HOSTS = {h for h in os.getenv("FAKE_SSH_FAIL_HOSTS", "").split(",") if h}
+
+# Опции ssh, у которых есть значение
+OPTIONS_WITH_VALUE = {"-o", "-p", "-i", "-l", "-F", "-J"}
+
+
+def main(argv: list[str]) -> int:
+    args = iter(argv)
+    destination = None
+    for arg in args:
+        if arg in OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif arg.startswith("-"):
+            continue
+        else:
+            destination = arg
+            break
+    if destination is None:
+        print("usage: ssh [options] destination [command]", file=sys.stderr)
+        return 255
+    command = " ".join(args)
+    host = destination.rsplit("@", 1)[-1]
+
+    if LATENCY:
+        time.sleep(LATENCY)
+    if host in FAIL_HOSTS:
+        print(f"ssh: connect to host {host} port 22: Connection refused", file=sys.stderr)
+        return 255
+
+    home = ROOT / host
+    home.mkdir(parents=True, exist_ok=True)
+    env = dict(os.environ, HOME=str(home), FAKE_SSH_HOST=host)
+    os.chdir(home)
+    os.execvpe("sh", ["sh", "-c", command or "exec sh"], env)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
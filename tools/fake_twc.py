@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Заглушка CLI `twc` для проверки deploy_master.py без облака Timeweb.
+Состояние хранится в JSON-файле FAKE_TWC_STATE; сервер после создания
+FAKE_TWC_BOOT секунд находится в статусе installing, затем переходит в on.
+
+Поддерживаются команды, которые вызывает deploy_master.py:
+    server create --name <имя> [...]       -> ID (или JSON при -o raw/json)
+    server list|ls [--limit N] [--ids]     -> таблица ID NAME REGION STATUS IPV4
+    server get <ID> [--status]
+и вывод -o/--output default|raw|json|yaml, как у настоящего twc.
+
+Переменные окружения:
+    FAKE_TWC_STATE      файл состояния (по умолчанию /tmp/fake_twc.json)
+    FAKE_TWC_BOOT       секунд до статуса on (по умолчанию 5)
+    FAKE_TWC_LATENCY    задержка каждого вызова, секунд
+    FAKE_TWC_FAIL_RATE  доля create, завершающихся 502 от шлюза (временная ошибка)
+    FAKE_TWC_LOST_RATE  доля create, которые создают сервер, но завершаются 504 от шлюза
+                        (ответ потерян по пути — повтор без проверки даст дубликат)
+
+Ошибки печатаются в том же виде, что у настоящего twc 2.15: «Error ocurred.» с
+полями Status code / Error code для ответов API с телом ошибки и «Error: API
+returned malformed response» для HTML-страниц шлюза.
+
+Число вызовов каждой команды копится в state["calls"]:
+    TWC_BIN=tools/fake_twc.py python3 deploy_master.py --count 20
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+import argparse
+from pathlib import Path
+from contextlib import contextmanager
+
+STATE_FILE = Path(os.getenv("FAKE_TWC_STATE", "/tmp/fake_twc.json"))
+BOOT_SECONDS = float(os.getenv("FAKE_TWC_BOOT", "5"))
+LATENCY = float(os.getenv("FAKE_TWC_LATENCY", "0"))
+FAIL_RATE = float(os.getenv("FAKE_TWC_FAIL_RATE", "0"))
+LOST_RATE = float(os.getenv("FAKE_TWC_LOST_RATE", "0"))
+
+
+@contextmanager
+def locked_state():
+    lock_path = STATE_FILE.with_suffix(".lock")
+    with open(lock_path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            state = json.loads(STATE_FILE.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            state = {"next_id": 4000000, "servers": {}, "calls": {}}
+        try:
+            yield state
+        finally:
+            tmp = STATE_FILE.with_suffix(".tmp")
+            tmp.write_text(json.dumps(state, indent=2, ensure_ascii=False))
+            os.replace(tmp, STATE_FILE)
+
+
+def fail(message: str):
+    print(f"Error: {message}", file=sys.stderr)
+    sys.exit(1)
+
+
+def fail_api(status: int, error_code: str, message: str):
+    """Ошибка API с телом ответа (exc.TimewebCloudException в twc)."""
+    print(f"Error ocurred.\nStatus code: {status}\nError code: {error_code}\n"
+          f"Message: {message}\nResponse ID: 00000000-0000-0000-0000-000000000000", file=sys.stderr)
+    sys.exit(1)
+
+
+def fail_gateway():
+    """HTML-ответ шлюза (502/504 от nginx): twc не находит в нём JSON и не показывает статус."""
+    fail("API returned malformed response: Response have no JSON schema or have invalid JSON syntax.\n"
+         "Try run command with '--verbose' option for details.")
+
+
+def server_view(srv: dict) -> dict:
+    """Сервер в форме ответа API с текущим статусом."""
+    status = "on" if time.time() - srv["created_at"] >= BOOT_SECONDS else "installing"
+    return {
+        "id": srv["id"],
+        "name": srv["name"],
+        "location": srv["location"],
+        "status": status,
+        "networks": [{
+            "type": "public",
+            "ips": [{"type": "ipv4", "ip": srv["ip"], "is_main": True}],
+        }],
+    }
+
+
+def main_ipv4(srv: dict):
+    for network in srv["networks"]:
+        if network["type"] == "public":
+            for addr in network["ips"]:
+                if addr["type"] == "ipv4" and addr["is_main"]:
+                    return addr["ip"]
+    return None
+
+
+def print_table(servers: list[dict]):
+    """Та же таблица, что печатает twc: колонки через два пробела, ljust по ширине."""
+    rows = [["ID", "NAME", "REGION", "STATUS", "IPV4"]]
+    rows += [[str(s["id"]), s["name"], s["location"], s["status"], str(main_ipv4(s))] for s in servers]
+    widths = [max(map(len, col)) for col in zip(*rows)]
+    for row in rows:
+        print("  ".join(val.ljust(width) for val, width in zip(row, widths)))
+
+
+def print_response(data: dict, output_format: str, default):
+    if output_format in ("raw", "json"):
+        print(json.dumps(data))
+    elif output_format == "yaml":
+        import yaml
+        print(yaml.dump(data, sort_keys=True, allow_unicode=True).strip())
+    else:
+        default()
+
+
+def main(argv: list[str]) -> int:
+    if LATENCY:
+        time.sleep(LATENCY)
+    parser = argparse.ArgumentParser(prog="twc")
+    parser.add_argument("group")
+    parser.add_argument("command")
+    parser.add_argument("server_id", nargs="?")
+    parser.add_argument("-o", "--output", default=os.getenv("TWC_OUTPUT_FORMAT", "default"))
+    parser.add_argument("--name")
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--ids", action="store_true")
+    parser.add_argument("--status", action="store_true")
+    parser.add_argument("--region", default="nl-1")
+    args, _ = parser.parse_known_args(argv)
+    if args.group != "server":
+        fail(f"unsupported command group: {args.group}")
+
+    command = "list" if args.command == "ls" else args.command
+    with locked_state() as state:
+        state["calls"][command] = state["calls"].get(command, 0) + 1
+
+        if command == "create":
+            if not args.name:
+                fail("Missing option '--name'")
+            if random.random() < FAIL_RATE:
+                fail_gateway()
+            server_id = state["next_id"]
+            state["next_id"] += 1
+            n = len(state["servers"]) + 1
+            state["servers"][str(server_id)] = {
+                "id": server_id, "name": args.name, "location": args.region,
+                "ip": f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}",
+                "created_at": time.time(),
+            }
+            if random.random() < LOST_RATE:
+                fail_gateway()
+            print_response({"server": {"id": server_id, "name": args.name}},
+                           args.output, lambda: print(server_id))
+            return 0
+
+        if command == "list":
+            servers = [server_view(s) for s in state["servers"].values()][:args.limit]
+            if args.ids:
+                for srv in servers:
+                    print(srv["id"])
+                return 0
+            print_response({"meta": {"total": len(servers)}, "servers": servers},
+                           args.output, lambda: print_table(servers))
+            return 0
+
+        if command == "get":
+            srv = state["servers"].get(str(args.server_id))
+            if srv is None:
+                fail_api(404, "not_found", "Server not found")
+            view = server_view(srv)
+            if args.status:
+                print(view["status"])
+                return 0 if view["status"] == "on" else 1
+            print_response({"server": view}, args.output, lambda: print_table([view]))
+            return 0
+
+    fail(f"unsupported command: server {args.command}")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
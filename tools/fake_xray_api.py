@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальная заглушка API Xray для проверки горячего добавления/удаления клиентов
+без настоящего xray.
+
+Запуск сервера:
+    python3 tools/fake_xray_api.py serve [-listen=127.0.0.1:10085]
+
+Клиентские команды повторяют интерфейс `xray api`:
+    python3 tools/fake_xray_api.py adu -s=127.0.0.1:10085 <файл.json|stdin:> ...
+    python3 tools/fake_xray_api.py rmu -s=127.0.0.1:10085 -tag=<tag> <email> ...
+    python3 tools/fake_xray_api.py inbounduser -s=127.0.0.1:10085 -tag=<tag>
+    python3 tools/fake_xray_api.py statsquery -s=127.0.0.1:10085 -pattern=user>>> [-reset]
+    python3 tools/fake_xray_api.py statsgetallonlineusers -s=127.0.0.1:10085
+
+statsquery возвращает синтетический трафик всех известных клиентов: при каждом
+запросе счётчики растут, как будто клиенты активны. Опция -container=<id>
+(её можно подставить в XRAY_API_CMD через {container}) разделяет счётчики
+разных контейнеров.
+
+Для vless_manager.py:
+    XRAY_API_CMD="python3 tools/fake_xray_api.py" XRAY_API_SERVER=127.0.0.1:10085 \\
+        python3 vless_manager.py add <username> --shared --hot
+"""
+
+import sys
+import json
+import zlib
+import socket
+import threading
+import socketserver
+
+DEFAULT_ADDR = "127.0.0.1:10085"
+
+
+class ApiState:
+    """
+    Состояние «ядра»: {inbound_tag: {email: client}}. Потокобезопасно.
+    """
+
+    def __init__(self):
+        self.inbounds: dict[str, dict[str, dict]] = {}
+        self.traffic: dict[tuple[str, str, str], int] = {}   # (контейнер, email, направление) -> байт
+        self.lock = threading.Lock()
+
+    def _emails(self) -> list[str]:
+        return sorted({email for users in self.inbounds.values() for email in users if email})
+
+    def handle(self, request: dict) -> dict:
+        op = request.get("op")
+        with self.lock:
+            if op == "adu":
+                added = 0
+                for inbound in request.get("inbounds", []):
+                    users = self.inbounds.setdefault(inbound.get("tag", ""), {})
+                    for client in inbound.get("settings", {}).get("clients", []):
+                        email = client.get("email", "")
+                        if email in users:
+                            return {"ok": False, "error": f"User {email} already exists."}
+                        users[email] = client
+                        added += 1
+                return {"ok": True, "added": added}
+            if op == "rmu":
+                users = self.inbounds.get(request.get("tag", ""), {})
+                missing = [e for e in request.get("emails", []) if e not in users]
+                if missing:
+                    return {"ok": False, "error": f"User {missing[0]} not found."}
+                for email in request.get("emails", []):
+                    del users[email]
+                return {"ok": True, "removed": len(request.get("emails", []))}
+            if op == "statsquery":
+                container, stats = request.get("container", ""), []
+                for email in self._emails():
+                    for direction in ("uplink", "downlink"):
+                        key = (container, email, direction)
+                        step = zlib.crc32(f"{container}/{email}/{direction}".encode()) % 4096 + 1
+                        self.traffic[key] = self.traffic.get(key, 0) + step
+                        name = f"user>>>{email}>>>traffic>>>{direction}"
+                        if name.startswith(request.get("pattern", "")):
+                            stats.append({"name": name, "value": str(self.traffic[key])})
+                        if request.get("reset"):
+                            self.traffic[key] = 0
+                return {"ok": True, "stat": stats}
+            if op == "statsgetallonlineusers":
+                return {"ok": True, "users": self._emails()}
+            if op == "inbounduser":
+                return {"ok": True, "users": list(self.inbounds.get(request.get("tag", ""), {}).values())}
+        return {"ok": False, "error": f"unknown operation {op!r}"}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.state.handle(json.loads(line))
+            except ValueError as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+class FakeXrayApiServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, addr: str = DEFAULT_ADDR):
+        host, port = addr.rsplit(":", 1)
+        super().__init__((host, int(port)), _Handler)
+        self.state = ApiState()
+
+
+def _parse_flags(args: list[str]) -> tuple[dict, list[str]]:
+    """
+    Разбирает флаги в стиле Go (-s=addr, -s addr, --server=addr) и позиционные аргументы.
+    """
+    flags, rest = {}, []
+    it = iter(args)
+    for arg in it:
+        if arg.startswith("-") and arg != "-":
+            name, _, value = arg.lstrip("-").partition("=")
+            flags[name] = value if value else next(it, "")
+        else:
+            rest.append(arg)
+    if "server" in flags:
+        flags["s"] = flags["server"]
+    return flags, rest
+
+
+def _call(addr: str, request: dict) -> dict:
+    host, port = addr.rsplit(":", 1)
+    with socket.create_connection((host, int(port)), timeout=5) as sock:
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        return json.loads(sock.makefile("r", encoding="utf-8").readline())
+
+
+def _load(path: str) -> dict:
+    if path == "stdin:":
+        return json.load(sys.stdin)
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(argv: list[str]) -> int:
+    flags, rest = _parse_flags(argv)
+    if not rest:
+        print(__doc__)
+        return 1
+    command = rest.pop(0)
+
+    if command == "serve":
+        server = FakeXrayApiServer(flags.get("listen", DEFAULT_ADDR))
+        print(f"fake xray api: слушаю {flags.get('listen', DEFAULT_ADDR)}", flush=True)
+        server.serve_forever()
+        return 0
+
+    addr = flags.get("s", DEFAULT_ADDR)
+    if command == "adu":
+        inbounds = [inbound for path in rest for inbound in _load(path).get("inbounds", [])]
+        response = _call(addr, {"op": "adu", "inbounds": inbounds})
+    elif command == "rmu":
+        response = _call(addr, {"op": "rmu", "tag": flags.get("tag", ""), "emails": rest})
+    elif command == "statsquery":
+        response = _call(addr, {"op": "statsquery", "pattern": flags.get("pattern", ""),
+                                "reset": "reset" in flags, "container": flags.get("container", "")})
+    elif command == "statsgetallonlineusers":
+        response = _call(addr, {"op": "statsgetallonlineusers"})
+    elif command == "inbounduser":
+        response = _call(addr, {"op": "inbounduser", "tag": flags.get("tag", "")})
+    else:
+        print(f"unknown command: {command}", file=sys.stderr)
+        return 1
+
+    if not response.get("ok"):
+        print(response.get("error"), file=sys.stderr)
+        return 1
+    response.pop("ok")
+    print(json.dumps(response, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
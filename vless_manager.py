@@ -2,297 +2,3286 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import sys
+import mmap
+import fcntl
+import struct
 import uuid
 import random
 import json
+import base64
+import hmac
+import hashlib
+import functools
+import queue
+import threading
+import time
+import shlex
+import select
+import socket
+import ipaddress
+import atexit
+import signal
+import asyncio
+import sqlite3
 import subprocess
+import http.client
+import http.server
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import urllib.request
 from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+from collections.abc import Callable
 
 # -------------------------------------------------------------------
 #  Константы и пути
 # -------------------------------------------------------------------
 BASE_DIR = Path(__file__).parent.resolve()
-USED_PORTS_FILE = BASE_DIR / "used_ports.txt"
-CONFIG_NAME_PREFIX = "vless-config"   # префикс для docker config: vless-config-<username>
+USED_PORTS_FILE = BASE_DIR / "used_ports.txt"     # старый формат, импортируется однократно
+PORTS_DB_FILE = BASE_DIR / "ports.bitmap"
+STATE_DB_FILE = BASE_DIR / "state.db"         # SQLite: пользователи, ключи, порты, ноды
+PORT_RANGE_START = 10000
+PORT_RANGE_END = 65535
+CONFIG_NAME_PREFIX = "vless-config"   # префикс для docker config: vless-config-<username>-<хэш>
+CONFIG_HASH_LENGTH = 12               # символов sha256 содержимого в имени config
 
 # Базовый домен, под которым будет работать VLESS для всех пользователей.
 # Можно задать через переменную окружения BASE_DOMAIN, иначе прописать прямо:
 BASE_DOMAIN = os.getenv("BASE_DOMAIN", "4903923-pi05715.twc1.net")
 
+# Общий режим: несколько клиентов в одном сервисе vless-shard-<N>
+SHARDS_FILE = BASE_DIR / "shards.json"
+SHARD_PREFIX = "shard-"
+RESERVED_NAME_ERROR = f"Имена, начинающиеся с «{SHARD_PREFIX}», зарезервированы под общие сервисы."
+SHARD_SIZE = int(os.getenv("VLESS_SHARD_SIZE", "50"))
+# Отрендеренные конфиги шардов — источник истины для горячих изменений
+SHARD_CONFIGS_DIR = BASE_DIR / "shards"
+SHARD_INBOUND_TAG = "vless-in"
 
-def get_next_port(start: int = 10000) -> int:
+# Общий контейнер (режим vless_manager.sh / vless_manager_no_domain.sh): все пользователи
+# в одном xray-server на 443 с конфигом BASE_DIR/config.json. Изменения копятся и
+# применяются одной перезагрузкой после RELOAD_DEBOUNCE секунд тишины
+SINGLE_STATE_FILE = BASE_DIR / "single.json"
+SINGLE_CONFIG_FILE = BASE_DIR / "config.json"
+SINGLE_USERS_FILE = BASE_DIR / "users.json"     # users.json shell-версии, импортируется однократно
+SINGLE_CONTAINER = os.getenv("VLESS_SINGLE_CONTAINER", "xray-server")
+SINGLE_PORT = 443
+# Адрес в ссылках: пусто — BASE_DOMAIN (порт 443 публикуется), ipv6 — глобальный IPv6 хоста (сеть host)
+SINGLE_ADDRESS = os.getenv("VLESS_SINGLE_ADDRESS", "")
+RELOAD_DEBOUNCE = float(os.getenv("VLESS_RELOAD_DEBOUNCE", "2"))      # секунд тишины перед перезагрузкой
+RELOAD_MAX_DELAY = float(os.getenv("VLESS_RELOAD_MAX_DELAY", "10"))   # но не дольше этого от первого изменения
+
+# Горячее добавление/удаление клиентов через API Xray (HandlerService) без рестарта шарда
+HOT_RELOAD = os.getenv("VLESS_HOT_RELOAD", "0") == "1"
+XRAY_API_PORT = int(os.getenv("XRAY_API_PORT", "10085"))
+# Команда `xray api`; {container} подставляется ID контейнера шарда на этой ноде.
+# Для локальной заглушки: XRAY_API_CMD="python3 tools/fake_xray_api.py"
+XRAY_API_CMD = os.getenv("XRAY_API_CMD", "docker exec -i {container} xray api")
+XRAY_API_SERVER = os.getenv("XRAY_API_SERVER", f"127.0.0.1:{XRAY_API_PORT}")
+
+# Метрики: в конфиги добавляются stats/policy и StatsService API Xray,
+# команда metrics собирает счётчики со всех сервисов ноды и отдаёт их Prometheus
+METRICS = os.getenv("VLESS_METRICS", "0") == "1"
+METRICS_LISTEN = os.getenv("VLESS_METRICS_LISTEN", "127.0.0.1:9550")
+METRICS_INTERVAL = float(os.getenv("VLESS_METRICS_INTERVAL", "15"))   # секунд между опросами Xray
+METRICS_WORKERS = int(os.getenv("VLESS_METRICS_WORKERS", "16"))
+
+# Сколько пользователей add-many создаёт параллельно
+ADD_MANY_WORKERS = int(os.getenv("ADD_MANY_WORKERS", "8"))
+
+# Образ Xray и путь, по которому в него монтируется конфиг
+XRAY_IMAGE = "teddysun/xray"
+XRAY_CONFIG_TARGET = "/etc/xray/config.json"
+
+# Бэкенд Docker: "cli" (процесс docker на каждую операцию) или "api" (Engine API через сокет)
+DOCKER_BACKEND = os.getenv("VLESS_DOCKER_BACKEND", "cli").lower()
+DOCKER_BIN = os.getenv("DOCKER_BIN", "docker")
+DOCKER_SOCKET = os.getenv("DOCKER_HOST", "unix:///var/run/docker.sock").removeprefix("unix://")
+DOCKER_API_VERSION = os.getenv("DOCKER_API_VERSION", "v1.41")
+
+# Метка, которой помечаются все ресурсы Docker, созданные этим скриптом;
+# отложенная очистка трогает только их (и никогда — образ XRAY_IMAGE)
+MANAGED_LABEL = "vless-managed"
+CLEANUP_STAMP_FILE = BASE_DIR / "cleanup.stamp"
+CLEANUP_LOG_FILE = BASE_DIR / "cleanup.log"
+CLEANUP_MIN_INTERVAL = int(os.getenv("VLESS_CLEANUP_MIN_INTERVAL", "3600"))   # секунд между очистками
+# Не удалять configs моложе этого: их мог только что создать add, ещё не подключив к сервису
+CLEANUP_CONFIG_GRACE = int(os.getenv("VLESS_CLEANUP_CONFIG_GRACE", "600"))
+
+# Размещение новых сервисов: "auto" — на наименее загруженную ноду по кэшу
+# статистики нод, "swarm" — без привязки (решает планировщик Swarm)
+PLACEMENT = os.getenv("VLESS_PLACEMENT", "auto").lower()
+NODE_STATS_FILE = BASE_DIR / "node_stats.json"
+NODE_STATS_TTL = int(os.getenv("VLESS_NODE_STATS_TTL", "60"))   # секунд до повторного опроса нод
+REBALANCE_WORKERS = int(os.getenv("REBALANCE_WORKERS", "4"))
+# Сколько операций плана apply выполняется параллельно
+APPLY_WORKERS = int(os.getenv("APPLY_WORKERS", "8"))
+
+# Способ генерации x25519-ключей: "native" (в процессе) или "docker" (через teddysun/xray)
+XRAY_KEYGEN = os.getenv("XRAY_KEYGEN", "native").lower()
+# Сколько готовых пар ключей держать в фоновом пуле
+KEY_POOL_SIZE = int(os.getenv("KEY_POOL_SIZE", "32"))
+
+# Демон serve: HTTP поверх Unix-сокета (путь) или localhost (host:port). Если демон запущен,
+# add/remove/migrate/link выполняются через него; VLESS_DAEMON=0 или --local — всегда локально
+DAEMON_ADDRESS = os.getenv("VLESS_DAEMON_ADDRESS", str(BASE_DIR / "vless_manager.sock"))
+DAEMON_ENABLED = os.getenv("VLESS_DAEMON", "1") != "0"
+DAEMON_WORKERS = int(os.getenv("VLESS_DAEMON_WORKERS", "8"))     # одновременных операций в демоне
+DAEMON_TIMEOUT = float(os.getenv("VLESS_DAEMON_TIMEOUT", "300"))  # секунд ожидания ответа клиентом
+# Токен демона: клиент шлёт его в Authorization: Bearer. Без токена TCP-адрес serve — только loopback
+DAEMON_TOKEN = os.getenv("VLESS_DAEMON_TOKEN", "")
+# Опции, которые меняют только этот процесс: демон их не получает и работает со своими
+DAEMON_LOCAL_OPTIONS = ("--metrics", "--docker-backend", "--trace", "--trace-file")
+
+# Трассировка внешних вызовов: --trace [--trace-file <путь>] или VLESS_TRACE=1 (или путь к файлу)
+TRACE_ENV = os.getenv("VLESS_TRACE", "")
+TRACE_FILE = BASE_DIR / "trace.jsonl"
+
+
+# -------------------------------------------------------------------
+#  Трассировка: спаны внешних вызовов (docker, xray api, подпроцессы, файлы)
+# -------------------------------------------------------------------
+class _NoSpan:
+    """Span выключенной трассировки: один общий объект, вход и выход ничего не делают."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "kind", "name", "attrs", "wall", "started")
+
+    def __init__(self, tracer: "Tracer", kind: str, name: str, attrs: dict):
+        self.tracer, self.kind, self.name, self.attrs = tracer, kind, name, attrs
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.attrs["error"] = f"{exc_type.__name__}: {exc}"[:300]
+        self.tracer.record(self, time.perf_counter() - self.started)
+        return False
+
+
+class Tracer:
+    """
+    Записывает спаны внешних вызовов: вид (docker, xray, subprocess, file, sqlite),
+    имя операции, длительность, код возврата (или HTTP-статус) и объём вывода.
+    Включённый трассировщик пишет каждый span строкой в JSONL-файл и при выходе
+    печатает в stderr сводку по операциям. Выключенный возвращает общий пустой
+    span, так что цена инструментирования — проверка одного флага: имя, которое
+    нужно собирать (f-строка, регулярное выражение), передаётся функцией без
+    аргументов и вычисляется, только когда трассировка включена.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path: Path | None = None
+        self.command = ""
+        self._file = None
+        self._lock = threading.Lock()
+        self._stats: dict[tuple[str, str], list] = {}   # (вид, имя) -> [count, total, max, errors, out_bytes]
+        self._started = 0.0
+
+    def enable(self, path: Path, command: str = "") -> None:
+        self.path = Path(path)
+        self.command = command
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._started = time.perf_counter()
+        self.enabled = True
+        atexit.register(self.close)
+
+    def span(self, kind: str, name: str | Callable[[], str], **attrs):
+        if not self.enabled:
+            return _NO_SPAN
+        return Span(self, kind, name() if callable(name) else name, attrs)
+
+    def record(self, span: Span, duration: float) -> None:
+        attrs = span.attrs
+        failed = "error" in attrs or attrs.get("exit_code") not in (None, 0) or attrs.get("status", 0) >= 400
+        line = json.dumps({
+            "ts": round(span.wall, 6), "pid": os.getpid(), "thread": threading.current_thread().name,
+            "command": self.command, "kind": span.kind, "name": span.name,
+            "duration_ms": round(duration * 1000, 3), **attrs,
+        }, ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            stat = self._stats.setdefault((span.kind, span.name), [0, 0.0, 0.0, 0, 0])
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] = max(stat[2], duration)
+            stat[3] += failed
+            stat[4] += attrs.get("out_bytes", 0)
+
+    def close(self) -> None:
+        """Дописывает span всей команды, закрывает файл и печатает сводку."""
+        if not self.enabled:
+            return
+        with Span(self, "command", self.command, {}) as span:
+            span.wall -= time.perf_counter() - self._started
+            span.started = self._started
+        with self._lock:
+            self.enabled = False
+            self._file.close()
+            self._file = None
+            stats = sorted(self._stats.items(), key=lambda item: -item[1][1])
+        rows = [["KIND", "NAME", "COUNT", "TOTAL_MS", "MEAN_MS", "MAX_MS", "ERRORS", "OUT_BYTES"]]
+        rows += [[kind, name, str(count), f"{total * 1000:.1f}", f"{total * 1000 / count:.2f}",
+                  f"{peak * 1000:.1f}", str(errors), str(out_bytes)]
+                 for (kind, name), (count, total, peak, errors, out_bytes) in stats]
+        widths = [max(map(len, col)) for col in zip(*rows)]
+        print(f"\n⏱️ Трассировка: {self.path}", file=sys.stderr)
+        for row in rows:
+            print("  ".join(val.ljust(width) for val, width in zip(row, widths)).rstrip(), file=sys.stderr)
+
+
+TRACER = Tracer()
+
+
+# -------------------------------------------------------------------
+#  Бэкенды Docker: CLI (процесс на каждый вызов) и Engine API (сокет)
+# -------------------------------------------------------------------
+_DOCKER_TIME = re.compile(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)$")
+
+
+def _docker_time(value: str) -> float | None:
+    """Время Docker в RFC 3339 с наносекундами -> Unix time (None, если не разобрать)."""
+    match = _DOCKER_TIME.match(value or "")
+    if not match:
+        return None
+    base, fraction, zone = match.groups()
+    stamp = datetime.fromisoformat(base + ("+00:00" if zone == "Z" else zone)).timestamp()
+    return stamp + float(fraction or 0)
+
+
+class DockerCLI:
+    """
+    Бэкенд Docker через CLI: каждая операция запускает отдельный процесс `docker`.
+    Ошибки Docker пробрасываются как RuntimeError с текстом stderr.
+    """
+
+    name = "cli"
+
+    def __init__(self, binary: str = DOCKER_BIN):
+        self.binary = binary
+
+    @staticmethod
+    def _span_name(args: list[str]) -> str:
+        return " ".join(args[:2]) if args[0] in ("config", "service", "node", "container") else args[0]
+
+    def _run(self, args: list[str], input: bytes | None = None) -> subprocess.CompletedProcess:
+        with TRACER.span("docker", lambda: self._span_name(args)) as span:
+            proc = subprocess.run([self.binary, *args], input=input, capture_output=True)
+            span.set(exit_code=proc.returncode, out_bytes=len(proc.stdout), err_bytes=len(proc.stderr))
+        return proc
+
+    def _check(self, proc: subprocess.CompletedProcess) -> str:
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.decode("utf-8", "replace").strip())
+        return proc.stdout.decode("utf-8", "replace")
+
+    def config_create(self, name: str, data: bytes, labels: dict | None = None) -> None:
+        args = ["config", "create"]
+        for key, value in (labels or {}).items():
+            args += ["--label", f"{key}={value}"]
+        self._check(self._run(args + [name, "-"], input=data))
+
+    def config_rm(self, name: str) -> bool:
+        return self._run(["config", "rm", name]).returncode == 0
+
+    def config_exists(self, name: str) -> bool:
+        proc = self._run(["config", "inspect", name, "--format", "{{.ID}}"])
+        return proc.returncode == 0 and bool(proc.stdout.strip())
+
+    def config_data(self, names: list[str]) -> dict[str, bytes]:
+        if not names:
+            return {}
+        proc = self._run(["config", "inspect", *names, "--format", "{{.Spec.Name}} {{json .Spec.Data}}"])
+        configs = {}
+        for line in proc.stdout.decode("utf-8", "replace").splitlines():
+            name, _, data = line.partition(" ")
+            try:
+                configs[name] = base64.b64decode(json.loads(data))
+            except ValueError:
+                continue
+        return configs
+
+    def service_create(self, name: str, port: int, config_name: str,
+                       constraints: list[str] = (), labels: dict | None = None,
+                       container_labels: dict | None = None) -> None:
+        args = [
+            "service", "create",
+            "--name", name,
+            *[arg for c in constraints for arg in ("--constraint", c)],
+            "--replicas", "1",
+            "--publish", f"mode=host,target=443,published={port},protocol=tcp",
+            "--restart-condition", "any",
+            "--config", f"source={config_name},target={XRAY_CONFIG_TARGET}",
+        ]
+        for key, value in (labels or {}).items():
+            args += ["--label", f"{key}={value}"]
+        for key, value in (container_labels or {}).items():
+            args += ["--container-label", f"{key}={value}"]
+        self._check(self._run(args + [XRAY_IMAGE]))
+
+    def service_rm(self, name: str) -> bool:
+        return self._run(["service", "rm", name]).returncode == 0
+
+    def service_spec(self, name: str) -> dict | None:
+        proc = self._run(["service", "inspect", name, "--format", "{{json .Spec}}"])
+        if proc.returncode != 0 or not proc.stdout.strip():
+            return None
+        return json.loads(proc.stdout)
+
+    def service_specs(self, label: str) -> list[dict]:
+        names = self._check(self._run(["service", "ls", "--filter", f"label={label}", "--format", "{{.Name}}"])).split()
+        if not names:
+            return []
+        out = self._check(self._run(["service", "inspect", *names, "--format", "{{json .Spec}}"]))
+        return [json.loads(line) for line in out.splitlines() if line.strip()]
+
+    def service_update(self, name: str, constraints_rm: list[str] = (), constraints_add: list[str] = (),
+                       config_rm: str | None = None, config_add: str | None = None, node: str | None = None) -> None:
+        if node is not None:
+            # Привязка к ноде заменяет все node.hostname==* из текущей спецификации сервиса
+            spec = self.service_spec(name)
+            if spec is None:
+                raise RuntimeError(f"service {name} not found")
+            placed = [c for c in ((spec.get("TaskTemplate") or {}).get("Placement") or {}).get("Constraints") or []
+                      if c.startswith("node.hostname==")]
+            pin = f"node.hostname=={node}"
+            constraints_rm = [*constraints_rm, *(c for c in placed if c != pin)]
+            constraints_add = [*constraints_add, *([pin] if pin not in placed else [])]
+        args = ["service", "update"]
+        for c in constraints_rm:
+            args += ["--constraint-rm", c]
+        for c in constraints_add:
+            args += ["--constraint-add", c]
+        if config_rm:
+            args += ["--config-rm", config_rm]
+        if config_add:
+            args += ["--config-add", f"source={config_add},target={XRAY_CONFIG_TARGET}"]
+        self._check(self._run(args + [name]))
+
+    def service_containers(self, name: str) -> list[str]:
+        proc = self._run(["ps", "-q", "--filter", f"label=com.docker.swarm.service.name={name}"])
+        return proc.stdout.decode("utf-8", "replace").split()
+
+    def local_containers(self, label: str) -> dict[str, str]:
+        out = self._check(self._run(["ps", "--filter", f"label={label}", "--format",
+                                     '{{.ID}}\t{{.Label "com.docker.swarm.service.name"}}']))
+        return dict(line.split("\t", 1) for line in out.splitlines() if "\t" in line)
+
+    def config_created(self, label: str) -> dict[str, float | None]:
+        ids = self._check(self._run(["config", "ls", "--filter", f"label={label}", "--format", "{{.ID}}"])).split()
+        if not ids:
+            return {}
+        out = self._check(self._run(["config", "inspect", *ids, "--format", "{{.Spec.Name}} {{json .CreatedAt}}"]))
+        created = {}
+        for line in out.splitlines():
+            name, _, stamp = line.partition(" ")
+            created[name] = _docker_time(stamp.strip().strip('"'))
+        return created
+
+    def container_prune(self, label: str) -> None:
+        self._check(self._run(["container", "prune", "-f", "--filter", f"label={label}"]))
+
+    def container_restart(self, name: str) -> bool:
+        return self._run(["restart", name]).returncode == 0
+
+    def container_run(self, name: str, volumes: dict[str, str], ports: list[int] = (),
+                      host_network: bool = False) -> None:
+        args = ["run", "-d", "--name", name, "--restart", "always"]
+        if host_network:
+            args += ["--network", "host"]
+        for port in ports:
+            args += ["-p", f"{port}:{port}"]
+        for source, target in volumes.items():
+            args += ["-v", f"{source}:{target}"]
+        self._check(self._run(args + [XRAY_IMAGE]))
+
+    def node_list(self) -> list[dict]:
+        ids = self._check(self._run(["node", "ls", "-q"])).split()
+        if not ids:
+            return []
+        return json.loads(self._check(self._run(["node", "inspect", *ids])))
+
+    def running_tasks(self) -> dict[str, str]:
+        ids = self._check(self._run(["node", "ls", "-q"])).split()
+        if not ids:
+            return {}
+        out = self._check(self._run(["node", "ps", *ids, "--filter", "desired-state=running",
+                                     "--format", "{{.Name}}\t{{.Node}}"]))
+        tasks = {}
+        for line in out.splitlines():
+            name, _, node = line.partition("\t")
+            if node:
+                tasks[name.strip().rsplit(".", 1)[0]] = node.strip()
+        return tasks
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP/1.1-соединение поверх Unix-сокета Docker."""
+
+    def __init__(self, socket_path: str, timeout: float = 60):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+# Имя операции Engine API для трассировки: /services/vless-alice/update -> /services/{id}/update
+_API_ROUTE = re.compile(r"^(/[a-z]+)/(?!create$|json$|prune$)[^/]+")
+
+
+def _api_route(path: str) -> str:
+    return _API_ROUTE.sub(r"\1/{id}", path)
+
+
+class DockerEngineAPI:
+    """
+    Бэкенд Docker через Engine API на /var/run/docker.sock. Держит пул
+    keep-alive соединений, поэтому операция — один HTTP-запрос без запуска процессов.
+    Интерфейс совпадает с DockerCLI.
+    """
+
+    name = "api"
+
+    def __init__(self, socket_path: str = DOCKER_SOCKET, pool_size: int = 8,
+                 api_version: str = DOCKER_API_VERSION):
+        self.socket_path = socket_path
+        self.api_version = api_version
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+
+    def _acquire(self) -> tuple[_UnixHTTPConnection, bool]:
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                return _UnixHTTPConnection(self.socket_path), False
+            # Закрытое демоном соединение простаивает «готовым к чтению» (EOF) — его не берём
+            if conn.sock is not None and not select.select([conn.sock], [], [], 0)[0]:
+                return conn, True
+            conn.close()
+
+    def _release(self, conn: _UnixHTTPConnection) -> None:
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _request(self, method: str, path: str, body=None, query: dict | None = None):
+        url = f"/{self.api_version}{path}"
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        payload = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        with TRACER.span("docker", lambda: f"{method} {_api_route(path)}") as span:
+            while True:
+                conn, reused = self._acquire()
+                sent = False
+                try:
+                    conn.request(method, url, body=payload, headers=headers)
+                    sent = True
+                    resp = conn.getresponse()
+                    raw = resp.read()
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    # Соединение из пула закрыто демоном — повторяем на новом, но только
+                    # если запрос до него не дошёл или это GET: POST/DELETE могли уже выполниться
+                    if reused and (not sent or method == "GET"):
+                        continue
+                    raise
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._release(conn)
+                span.set(status=resp.status, out_bytes=len(raw), reused=reused)
+                data = json.loads(raw) if raw and resp.getheader("Content-Type", "").startswith("application/json") else None
+                return resp.status, data
+
+    def _call(self, method: str, path: str, body=None, query: dict | None = None, allow_404: bool = False):
+        status, data = self._request(method, path, body, query)
+        if status == 404 and allow_404:
+            return None
+        if status >= 400:
+            message = data.get("message") if isinstance(data, dict) else None
+            raise RuntimeError(message or f"Docker API {method} {path}: HTTP {status}")
+        return data if data is not None else {}
+
+    @staticmethod
+    def _filters(**filters) -> dict:
+        return {"filters": json.dumps(filters)}
+
+    def config_create(self, name: str, data: bytes, labels: dict | None = None) -> None:
+        self._call("POST", "/configs/create", {
+            "Name": name, "Labels": {k: str(v) for k, v in (labels or {}).items()},
+            "Data": base64.b64encode(data).decode("ascii"),
+        })
+
+    def config_rm(self, name: str) -> bool:
+        return self._call("DELETE", f"/configs/{urllib.parse.quote(name)}", allow_404=True) is not None
+
+    def config_exists(self, name: str) -> bool:
+        return self._call("GET", f"/configs/{urllib.parse.quote(name)}", allow_404=True) is not None
+
+    def config_data(self, names: list[str]) -> dict[str, bytes]:
+        if not names:
+            return {}
+        wanted = set(names)
+        configs = self._call("GET", "/configs", query=self._filters(names=names))
+        return {
+            c["Spec"]["Name"]: base64.b64decode(c["Spec"].get("Data", ""))
+            for c in configs if c["Spec"]["Name"] in wanted
+        }
+
+    def _config_ref(self, name: str) -> dict:
+        config = self._call("GET", f"/configs/{urllib.parse.quote(name)}")
+        return {
+            "File": {"Name": XRAY_CONFIG_TARGET, "UID": "0", "GID": "0", "Mode": 0o444},
+            "ConfigID": config["ID"],
+            "ConfigName": name,
+        }
+
+    def service_create(self, name: str, port: int, config_name: str,
+                       constraints: list[str] = (), labels: dict | None = None,
+                       container_labels: dict | None = None) -> None:
+        self._call("POST", "/services/create", {
+            "Name": name,
+            "Labels": {k: str(v) for k, v in (labels or {}).items()},
+            "TaskTemplate": {
+                "ContainerSpec": {
+                    "Image": XRAY_IMAGE,
+                    "Labels": {k: str(v) for k, v in (container_labels or {}).items()},
+                    "Configs": [self._config_ref(config_name)],
+                },
+                "Placement": {"Constraints": list(constraints)},
+                "RestartPolicy": {"Condition": "any"},
+            },
+            "Mode": {"Replicated": {"Replicas": 1}},
+            "EndpointSpec": {"Ports": [
+                {"Protocol": "tcp", "TargetPort": 443, "PublishedPort": port, "PublishMode": "host"},
+            ]},
+        })
+
+    def service_rm(self, name: str) -> bool:
+        return self._call("DELETE", f"/services/{urllib.parse.quote(name)}", allow_404=True) is not None
+
+    def service_spec(self, name: str) -> dict | None:
+        service = self._call("GET", f"/services/{urllib.parse.quote(name)}", allow_404=True)
+        return service["Spec"] if service else None
+
+    def service_specs(self, label: str) -> list[dict]:
+        return [s["Spec"] for s in self._call("GET", "/services", query=self._filters(label=[label]))]
+
+    def service_update(self, name: str, constraints_rm: list[str] = (), constraints_add: list[str] = (),
+                       config_rm: str | None = None, config_add: str | None = None, node: str | None = None) -> None:
+        service = self._call("GET", f"/services/{urllib.parse.quote(name)}")
+        spec = service["Spec"]
+        task = spec.setdefault("TaskTemplate", {})
+        placement = task.setdefault("Placement", {})
+        constraints = [c for c in placement.get("Constraints") or [] if c not in constraints_rm
+                       and not (node is not None and c.startswith("node.hostname=="))]
+        if node is not None:
+            constraints_add = [*constraints_add, f"node.hostname=={node}"]
+        placement["Constraints"] = constraints + [c for c in constraints_add if c not in constraints]
+        container = task.setdefault("ContainerSpec", {})
+        configs = [c for c in container.get("Configs") or [] if c.get("ConfigName") != config_rm]
+        if config_add:
+            configs.append(self._config_ref(config_add))
+        container["Configs"] = configs
+        self._call("POST", f"/services/{service['ID']}/update", spec,
+                   query={"version": service["Version"]["Index"]})
+
+    def service_containers(self, name: str) -> list[str]:
+        containers = self._call("GET", "/containers/json",
+                                query=self._filters(label=[f"com.docker.swarm.service.name={name}"]))
+        return [c["Id"] for c in containers]
+
+    def local_containers(self, label: str) -> dict[str, str]:
+        containers = self._call("GET", "/containers/json", query=self._filters(label=[label]))
+        return {c["Id"]: (c.get("Labels") or {}).get("com.docker.swarm.service.name", "") for c in containers}
+
+    def config_created(self, label: str) -> dict[str, float | None]:
+        configs = self._call("GET", "/configs", query=self._filters(label=[label]))
+        return {c["Spec"]["Name"]: _docker_time(c.get("CreatedAt", "")) for c in configs}
+
+    def container_prune(self, label: str) -> None:
+        self._call("POST", "/containers/prune", query=self._filters(label=[label]))
+
+    def container_restart(self, name: str) -> bool:
+        return self._call("POST", f"/containers/{urllib.parse.quote(name)}/restart", allow_404=True) is not None
+
+    def container_run(self, name: str, volumes: dict[str, str], ports: list[int] = (),
+                      host_network: bool = False) -> None:
+        body = {
+            "Image": XRAY_IMAGE,
+            "ExposedPorts": {f"{port}/tcp": {} for port in ports},
+            "HostConfig": {
+                "Binds": [f"{source}:{target}" for source, target in volumes.items()],
+                "RestartPolicy": {"Name": "always"},
+                "NetworkMode": "host" if host_network else "default",
+                "PortBindings": {f"{port}/tcp": [{"HostPort": str(port)}] for port in ports},
+            },
+        }
+        try:
+            created = self._call("POST", "/containers/create", body, query={"name": name})
+        except RuntimeError as e:
+            if "No such image" not in str(e):
+                raise
+            # Как и `docker run`, скачиваем недостающий образ; ответ — поток JSON-строк прогресса
+            try:
+                self._request("POST", "/images/create", query={"fromImage": XRAY_IMAGE, "tag": "latest"})
+            except ValueError:
+                pass
+            created = self._call("POST", "/containers/create", body, query={"name": name})
+        self._call("POST", f"/containers/{created['Id']}/start")
+
+    def node_list(self) -> list[dict]:
+        return self._call("GET", "/nodes")
+
+    def running_tasks(self) -> dict[str, str]:
+        services = {s["ID"]: s["Spec"]["Name"] for s in self._call("GET", "/services")}
+        nodes = {n["ID"]: n["Description"]["Hostname"] for n in self.node_list()}
+        tasks = self._call("GET", "/tasks", query=self._filters(**{"desired-state": ["running"]}))
+        return {
+            services[t["ServiceID"]]: nodes[t["NodeID"]]
+            for t in tasks if t.get("ServiceID") in services and t.get("NodeID") in nodes
+        }
+
+
+def make_docker_backend(name: str = DOCKER_BACKEND):
+    """
+    Возвращает бэкенд Docker по имени ("cli" или "api"). Если сокет Engine API
+    недоступен, используется CLI.
+    """
+    if name == "api":
+        if os.path.exists(DOCKER_SOCKET):
+            return DockerEngineAPI()
+        print(f"⚠️ Сокет {DOCKER_SOCKET} недоступен, используется Docker CLI.", file=sys.stderr)
+    return DockerCLI()
+
+
+DOCKER = make_docker_backend()
+
+
+class PortAllocator:
+    """
+    Персистентный аллокатор портов: битовая карта диапазона [start, end] в небольшом
+    файле PORTS_DB_FILE (~7 КБ на весь диапазон). Бит = 1 — порт занят.
+    В заголовке хранится подсказка — индекс первого байта, где может быть свободный бит,
+    поэтому выделение и освобождение не зависят от числа пользователей.
+    Каждая операция выполняется под эксклюзивной блокировкой файла (flock),
+    так что параллельные запуски vless_manager.py не выдадут один и тот же порт.
+    """
+
+    HEADER = struct.Struct("<4sIII")   # magic, start, end, hint (индекс байта)
+    MAGIC = b"VPB1"
+    _NOT_FULL = re.compile(rb"[^\xff]")
+
+    def __init__(self, path: Path = None, start: int = PORT_RANGE_START, end: int = PORT_RANGE_END):
+        self.path = Path(path or PORTS_DB_FILE)
+        self.start = start
+        self.end = end
+        self.size = (end - start) // 8 + 1
+
+    @contextmanager
+    def _transaction(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with TRACER.span("file", "ports.bitmap"):
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.fstat(fd).st_size < self.HEADER.size + self.size:
+                    self._initialize(fd)
+                with mmap.mmap(fd, self.HEADER.size + self.size) as mm:
+                    magic, start, end, _ = self.HEADER.unpack_from(mm)
+                    if magic != self.MAGIC or (start, end) != (self.start, self.end):
+                        raise RuntimeError(f"Файл {self.path} создан для другого диапазона портов.")
+                    yield mm
+                    mm.flush()
+        finally:
+            os.close(fd)   # закрытие дескриптора снимает flock
+
+    def _initialize(self, fd: int) -> None:
+        """
+        Создаёт пустую карту; при первом запуске переносит занятые порты из used_ports.txt.
+        """
+        bitmap = bytearray(self.size)
+        if USED_PORTS_FILE.exists():
+            with open(USED_PORTS_FILE, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line.isdigit() and self.start <= int(line) <= self.end:
+                        idx = int(line) - self.start
+                        bitmap[idx >> 3] |= 1 << (idx & 7)
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.start, self.end, 0) + bytes(bitmap), 0)
+
+    def _set_hint(self, mm, hint: int) -> None:
+        self.HEADER.pack_into(mm, 0, self.MAGIC, self.start, self.end, hint)
+
+    def allocate(self, count: int = 1, start: int | None = None) -> list[int]:
+        """
+        Выделяет count свободных портов (наименьшие свободные >= start) одной транзакцией.
+        """
+        lowest = max(start or self.start, self.start) - self.start
+        limit = self.end - self.start
+        base = self.HEADER.size
+        ports = []
+        with self._transaction() as mm:
+            hint = self.HEADER.unpack_from(mm)[3]
+            first = max(hint, lowest >> 3)
+            # подсказку можно сдвигать, только пока идём подряд от неё
+            contiguous = first == hint
+            pos = base + first
+            while len(ports) < count:
+                match = self._NOT_FULL.search(mm, pos, base + self.size)
+                if match is None:
+                    break
+                offset = match.start()
+                byte_idx = offset - base
+                value = mm[offset]
+                for bit in range(8):
+                    idx = (byte_idx << 3) + bit
+                    if idx > limit or len(ports) == count:
+                        break
+                    if idx < lowest or value & (1 << bit):
+                        continue
+                    value |= 1 << bit
+                    ports.append(self.start + idx)
+                mm[offset] = value
+                if contiguous:
+                    hint = byte_idx + 1 if value == 0xFF else byte_idx
+                    contiguous = value == 0xFF
+                pos = offset + 1
+
+            if len(ports) < count:
+                for port in ports:
+                    idx = port - self.start
+                    mm[base + (idx >> 3)] &= ~(1 << (idx & 7)) & 0xFF
+                raise RuntimeError("Свободные порты в диапазоне закончились.")
+            self._set_hint(mm, hint)
+        return ports
+
+    def release(self, ports: list[int]) -> None:
+        """
+        Освобождает порты (повторное освобождение безопасно).
+        """
+        ports = [p for p in ports if self.start <= p <= self.end]
+        if not ports:
+            return
+        with self._transaction() as mm:
+            base = self.HEADER.size
+            hint = self.HEADER.unpack_from(mm)[3]
+            for port in ports:
+                idx = port - self.start
+                mm[base + (idx >> 3)] &= ~(1 << (idx & 7)) & 0xFF
+                hint = min(hint, idx >> 3)
+            self._set_hint(mm, hint)
+
+    def reserve(self, ports: list[int]) -> None:
+        """
+        Помечает порты занятыми, не освобождая остальные (в отличие от rebuild).
+        """
+        ports = [p for p in ports if self.start <= p <= self.end]
+        if not ports:
+            return
+        with self._transaction() as mm:
+            base = self.HEADER.size
+            for port in ports:
+                idx = port - self.start
+                mm[base + (idx >> 3)] |= 1 << (idx & 7)
+
+    def rebuild(self, ports: list[int]) -> None:
+        """
+        Полностью перезаписывает карту заданным набором занятых портов (для reconcile).
+        """
+        bitmap = bytearray(self.size)
+        for port in ports:
+            if self.start <= port <= self.end:
+                idx = port - self.start
+                bitmap[idx >> 3] |= 1 << (idx & 7)
+        with self._transaction() as mm:
+            mm[self.HEADER.size:] = bytes(bitmap)
+            self._set_hint(mm, 0)
+
+    def used(self) -> list[int]:
+        """
+        Возвращает отсортированный список занятых портов.
+        """
+        with self._transaction() as mm:
+            bitmap = mm[self.HEADER.size:]
+        return [
+            self.start + (i << 3) + bit
+            for i, value in enumerate(bitmap) if value
+            for bit in range(8) if value & (1 << bit)
+        ]
+
+
+PORTS = PortAllocator()
+
+
+def get_next_port(start: int = PORT_RANGE_START) -> int:
+    """
+    Выделяет первый свободный порт >= start в PORTS_DB_FILE и возвращает его.
+    """
+    return PORTS.allocate(1, start)[0]
+
+
+def allocate_ports(count: int, start: int = PORT_RANGE_START) -> list[int]:
+    """
+    Выделяет сразу count свободных портов >= start одной транзакцией.
+    """
+    return PORTS.allocate(count, start)
+
+
+def release_ports(ports: list[int]) -> None:
+    """
+    Освобождает сразу несколько портов одной транзакцией.
+    """
+    PORTS.release(ports)
+
+
+def release_port(port: int) -> None:
+    """
+    Освобождает конкретный порт (при удалении пользователя).
+    """
+    PORTS.release([port])
+
+
+def list_vless_services() -> dict[str, dict]:
+    """
+    Возвращает сведения обо всех сервисах с меткой vless-port:
+    {имя_сервиса: {"port", "node", "shard", "configs", "reserved_cpus", "reserved_memory"}}.
+    Выполняет не больше двух вызовов Docker независимо от числа сервисов.
+    """
+    try:
+        specs = DOCKER.service_specs("vless-port")
+    except RuntimeError as e:
+        raise RuntimeError(f"Не удалось получить список сервисов: {e}")
+    services = {}
+    for spec in specs:
+        labels = spec.get("Labels") or {}
+        if not str(labels.get("vless-port", "")).isdigit():
+            continue
+        task = spec.get("TaskTemplate") or {}
+        constraints = (task.get("Placement") or {}).get("Constraints") or []
+        node = next((c.split("==", 1)[1] for c in constraints if c.startswith("node.hostname==")), None)
+        reservations = (task.get("Resources") or {}).get("Reservations") or {}
+        services[spec["Name"]] = {
+            "port": int(labels["vless-port"]),
+            "node": node,
+            "shard": labels.get("vless-shard"),
+            "configs": [c.get("ConfigName") for c in (task.get("ContainerSpec") or {}).get("Configs") or []],
+            "reserved_cpus": reservations.get("NanoCPUs", 0) / 1e9,
+            "reserved_memory": reservations.get("MemoryBytes", 0),
+        }
+    return services
+
+
+def list_service_ports() -> dict[str, int]:
+    """
+    Возвращает {имя_сервиса: порт} для всех сервисов с меткой vless-port.
+    """
+    return {name: info["port"] for name, info in list_vless_services().items()}
+
+
+def reconcile_ports(services: dict[str, dict] | None = None, merge: bool = False) -> int:
+    """
+    Перестраивает карту портов по меткам vless-port существующих сервисов.
+    С merge=True только добавляет их порты к уже занятым: порт, который
+    параллельный запуск выделил, но ещё не создал под ним сервис, не освобождается.
+    Возвращает число портов сервисов.
+    """
+    if services is None:
+        services = list_vless_services()
+    ports = [info["port"] for info in services.values()]
+    if merge:
+        PORTS.reserve(ports)
+    else:
+        PORTS.rebuild(ports)
+    return len(services)
+
+
+def _read_docker_configs(names: list[str]) -> dict[str, dict]:
+    """
+    Читает содержимое Docker configs одним вызовом Docker.
+    Возвращает {имя_config: разобранный JSON}.
+    """
+    configs = {}
+    for name, data in DOCKER.config_data(names).items():
+        try:
+            configs[name] = json.loads(data)
+        except ValueError:
+            continue
+    return configs
+
+
+def reconcile_store(services: dict[str, dict] | None = None) -> dict[str, int]:
+    """
+    Синхронизирует локальное хранилище со Swarm:
+      • обновляет порт/ноду пользователей по сервисам vless-<username>;
+      • импортирует сервисы, которых нет в хранилище (ключи читаются из их Docker config);
+      • переносит в хранилище клиентов шардов из shards.json;
+      • помечает статусом missing пользователей, чьих сервисов больше нет.
+    Возвращает счётчики imported / updated / missing.
+    """
+    if services is None:
+        services = list_vless_services()
+    known = {user["username"]: user for user in STORE.list_users()}
+    shard_state = json.loads(SHARDS_FILE.read_text(encoding="utf-8")) if SHARDS_FILE.exists() else {}
+    counts = {"imported": 0, "updated": 0, "missing": 0}
+    records = []
+
+    # 1) Отдельные сервисы пользователей
+    to_import = {}
+    for name, info in services.items():
+        if info["shard"]:
+            continue
+        username = name[len("vless-"):]
+        user = known.get(username)
+        if user is None:
+            if info["configs"]:
+                to_import[username] = info
+            continue
+        if (user["port"], user["node"], user["status"]) != (info["port"], info["node"], "active"):
+            records.append({**user, "port": info["port"], "node": info["node"], "status": "active"})
+            counts["updated"] += 1
+
+    configs = _read_docker_configs([info["configs"][0] for info in to_import.values()])
+    for username, info in to_import.items():
+        config = configs.get(info["configs"][0])
+        if not config:
+            continue
+        inbound = config["inbounds"][0]
+        reality = inbound["streamSettings"]["realitySettings"]
+        records.append({
+            "username": username, "uuid": inbound["settings"]["clients"][0]["id"],
+            "private_key": reality["privateKey"], "public_key": x25519_public_key(reality["privateKey"]),
+            "short_id": reality["shortIds"][0], "port": info["port"], "node": info["node"],
+        })
+        counts["imported"] += 1
+
+    # 2) Клиенты общих сервисов
+    shard_users = set()
+    for shard_id, shard in shard_state.get("shards", {}).items():
+        status = "active" if _shard_service_name(shard_id) in services else "missing"
+        for username, uuid_str in shard["clients"].items():
+            shard_users.add(username)
+            user = known.get(username)
+            record = {
+                "username": username, "uuid": uuid_str, "private_key": shard["private_key"],
+                "public_key": shard["public_key"], "short_id": shard["short_id"], "port": shard["port"],
+                "node": shard.get("node"), "mode": "shared", "shard": shard_id, "status": status,
+            }
+            if user is None or any(user.get(k) != v for k, v in record.items()):
+                records.append(record)
+                counts["imported" if user is None else "updated"] += 1
+
+    # 3) Пользователи, чьих сервисов больше нет
+    for username, user in known.items():
+        if username in shard_users or user["status"] == "missing" or user["mode"] == "single":
+            continue
+        if user["mode"] == "shared" or f"vless-{username}" not in services:
+            records.append({**user, "status": "missing"})
+            counts["missing"] += 1
+
+    STORE.upsert_users(records)
+    return counts
+
+
+def _b64url(raw: bytes) -> str:
+    """
+    Кодирует ключ так же, как это делает `xray x25519`: base64url без паддинга.
+    """
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _clamp_x25519(raw: bytes) -> bytes:
+    key = bytearray(raw)
+    key[0] &= 248
+    key[31] &= 127
+    key[31] |= 64
+    return bytes(key)
+
+
+def _x25519_scalarmult(scalar: bytes, u_point: bytes) -> bytes:
+    """
+    Умножение точки на скаляр на кривой Curve25519 (лестница Монтгомери, RFC 7748).
+    Используется, только если пакет cryptography не установлен.
+    """
+    p = 2 ** 255 - 19
+    k = int.from_bytes(_clamp_x25519(scalar), "little")
+    x1 = int.from_bytes(u_point, "little") & ((1 << 255) - 1)
+    x2, z2, x3, z3 = 1, 0, x1, 1
+    swap = 0
+    for t in reversed(range(255)):
+        bit = (k >> t) & 1
+        swap ^= bit
+        if swap:
+            x2, x3 = x3, x2
+            z2, z3 = z3, z2
+        swap = bit
+        a = x2 + z2
+        aa = a * a % p
+        b = x2 - z2
+        bb = b * b % p
+        e = aa - bb
+        c = x3 + z3
+        d = x3 - z3
+        da = d * a % p
+        cb = c * b % p
+        x3 = (da + cb) ** 2 % p
+        z3 = x1 * (da - cb) ** 2 % p
+        x2 = aa * bb % p
+        z2 = e * (aa + 121665 * e) % p
+    if swap:
+        x2, z2 = x3, z3
+    return (x2 * pow(z2, p - 2, p) % p).to_bytes(32, "little")
+
+
+def x25519_public_key(private_key: str) -> str:
+    """
+    Вычисляет публичный ключ по приватному (аналог `xray x25519 -i <private_key>`).
+    """
+    raw = _clamp_x25519(_b64url_decode(private_key))
+    try:
+        from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+        from cryptography.hazmat.primitives import serialization
+    except ImportError:
+        return _b64url(_x25519_scalarmult(raw, (9).to_bytes(32, "little")))
+    pub = X25519PrivateKey.from_private_bytes(raw).public_key()
+    return _b64url(pub.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw))
+
+
+def generate_x25519_keys_native() -> tuple[str, str]:
+    """
+    Генерирует x25519-ключи прямо в процессе, без запуска контейнера.
+    Формат совпадает с выводом `xray x25519`. Возвращает (private_key, public_key).
+    """
+    private_key = _b64url(_clamp_x25519(os.urandom(32)))
+    return private_key, x25519_public_key(private_key)
+
+
+def generate_x25519_keys_docker() -> tuple[str, str]:
+    """
+    Генерирует x25519-ключи через Docker-контейнер teddysun/xray.
+    Возвращает (private_key, public_key).
+    """
+    with TRACER.span("docker", "run xray x25519") as span:
+        proc = subprocess.run(
+            [DOCKER_BIN, "run", "--rm", XRAY_IMAGE, "xray", "x25519"],
+            capture_output=True,
+            text=True
+        )
+        span.set(exit_code=proc.returncode, out_bytes=len(proc.stdout))
+    if proc.returncode != 0:
+        print("❌ Ошибка при запуске контейнера teddysun/xray для генерации ключей.")
+        print(proc.stderr)
+        sys.exit(1)
+
+    out = proc.stdout.splitlines()
+    priv = ""
+    pub = ""
+    for line in out:
+        if line.startswith("Private key:"):
+            priv = line.split(":", 1)[1].strip()
+        elif line.startswith("Public key:"):
+            pub = line.split(":", 1)[1].strip()
+    if not priv or not pub:
+        raise RuntimeError("Не удалось сгенерировать x25519-ключи.")
+    return priv, pub
+
+
+def generate_x25519_keys() -> tuple[str, str]:
+    """
+    Генерирует x25519-ключи способом из XRAY_KEYGEN (по умолчанию — в процессе).
+    Возвращает (private_key, public_key).
+    """
+    if XRAY_KEYGEN == "docker":
+        return generate_x25519_keys_docker()
+    return generate_x25519_keys_native()
+
+
+class KeyPool:
+    """
+    Пул заранее сгенерированных x25519-пар. Фоновый поток держит пул полным,
+    поэтому выдача ключа при создании пользователя не ждёт генерации.
+    """
+
+    def __init__(self, size: int = KEY_POOL_SIZE, generator=generate_x25519_keys):
+        self._keys: queue.Queue = queue.Queue(maxsize=max(size, 1))
+        self._generator = generator
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def start(self) -> "KeyPool":
+        """Запускает фоновое пополнение пула (повторный вызов ничего не делает)."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refill, name="key-pool", daemon=True)
+                self._thread.start()
+        return self
+
+    def _refill(self) -> None:
+        while True:
+            # put() блокируется, пока пул полон, — поток просыпается только после выдачи ключа
+            self._keys.put(self._generator())
+
+    def get(self) -> tuple[str, str]:
+        """Возвращает готовую пару ключей; если пул пуст — генерирует на месте."""
+        try:
+            return self._keys.get_nowait()
+        except queue.Empty:
+            return self._generator()
+
+    def take(self, count: int) -> list[tuple[str, str]]:
+        """Возвращает сразу count пар ключей."""
+        return [self.get() for _ in range(count)]
+
+
+KEY_POOL = KeyPool()
+
+
+def create_docker_config(username: str, config_json: dict, config_name: str | None = None) -> tuple[str, bool]:
+    """
+    Публикует JSON-конфиг как Docker config и возвращает (имя, создан ли он сейчас).
+    По умолчанию имя содержит хэш содержимого — vless-config-<username>-<хэш>:
+    если такой config уже есть, он используется как есть, без записи в Docker.
+    Config с явным config_name удаляется и создаётся заново.
+    """
+    # Сериализуем JSON и передаём в `docker config create`
+    json_bytes = json.dumps(config_json, ensure_ascii=False, indent=2).encode("utf-8")
+    hashed = config_name is None
+    if hashed:
+        config_name = f"{CONFIG_NAME_PREFIX}-{username}-{hashlib.sha256(json_bytes).hexdigest()[:CONFIG_HASH_LENGTH]}"
+        if DOCKER.config_exists(config_name):
+            return config_name, False
+    else:
+        DOCKER.config_rm(config_name)
+
+    try:
+        DOCKER.config_create(config_name, json_bytes, {MANAGED_LABEL: "1"})
+    except RuntimeError as e:
+        # Тот же хэш мог только что опубликовать параллельный запуск — содержимое совпадает
+        if hashed and DOCKER.config_exists(config_name):
+            return config_name, False
+        raise RuntimeError(f"Не удалось создать Docker config «{config_name}»: {e}")
+    return config_name, True
+
+
+def create_config_object(username: str, uuid_str: str, private_key: str, short_id: str,
+                         metrics: bool | None = None) -> dict:
+    """
+    Формирует Python-словарь (dict) с JSON-конфигом для Xray/VLESS.
+    При metrics=True (по умолчанию — VLESS_METRICS) клиент получает email=username
+    и включаются статистика по пользователям и StatsService API.
+    Возвращает этот словарь.
+    """
+    client = {"id": uuid_str, "flow": "xtls-rprx-vision"}
+    config = {
+        "log": {"loglevel": "warning"},
+        "inbounds": [
+            {
+                "port": 443,
+                "protocol": "vless",
+                "settings": {
+                    "clients": [client],
+                    "decryption": "none"
+                },
+                "streamSettings": {
+                    "network": "tcp",
+                    "security": "reality",
+                    "realitySettings": {
+                        "show": False,
+                        "dest": "www.google.com:443",
+                        "xver": 0,
+                        "serverNames": ["www.google.com"],
+                        "privateKey": private_key,
+                        "shortIds": [short_id]
+                    }
+                }
+            }
+        ],
+        "outbounds": [{"protocol": "freedom"}]
+    }
+    if metrics is None:
+        metrics = METRICS
+    if metrics:
+        if username:
+            client["email"] = username
+        config["stats"] = {}
+        config["policy"] = {"levels": {"0": {
+            "statsUserUplink": True, "statsUserDownlink": True, "statsUserOnline": True,
+        }}}
+        _enable_xray_api(config, "StatsService")
+    return config
+
+
+def _enable_xray_api(config: dict, service: str) -> None:
+    """
+    Включает API Xray с сервисом service на 127.0.0.1:XRAY_API_PORT внутри
+    контейнера (dokodemo-door + маршрут). Повторный вызов добавляет сервис.
+    """
+    api = config.setdefault("api", {"tag": "api", "services": []})
+    if service not in api["services"]:
+        api["services"].append(service)
+    if not any(inbound.get("tag") == "api" for inbound in config["inbounds"]):
+        config["inbounds"].append({
+            "tag": "api",
+            "listen": "127.0.0.1",
+            "port": XRAY_API_PORT,
+            "protocol": "dokodemo-door",
+            "settings": {"address": "127.0.0.1"},
+        })
+        config.setdefault("routing", {"rules": []})["rules"].append(
+            {"type": "field", "inboundTag": ["api"], "outboundTag": "api"}
+        )
+
+
+def create_service(username: str, port: int, target_node: str | None = None,
+                   config_name: str | None = None, labels: dict | None = None) -> bool:
+    """
+    В Docker Swarm создаёт сервис vless-<username>:
+      • пробрасывает порт <port>:443/tcp с mode=host
+      • монтирует ранее созданный Docker config (config_name, по умолчанию vless-config-<username>) в /etc/xray/config.json
+      • (опционально) привязывает сервис к конкретной ноде через --constraint node.hostname==<target_node>
+      • (опционально) добавляет дополнительные метки labels
+    Если сервис с этим портом уже есть, он не пересоздаётся: другой config
+    подключается через service update (--config-rm/--config-add, старый config
+    удаляется), другая нода — через замену constraint, а совпадающий сервис
+    не трогается вовсе. Возвращает True, если в Swarm что-то изменилось.
+    """
+    service_name = f"vless-{username}"
+    config_name = config_name or f"{CONFIG_NAME_PREFIX}-{username}"
+    constraints = [f"node.hostname=={target_node}"] if target_node else []
+
+    spec = DOCKER.service_spec(service_name)
+    if spec is not None and str((spec.get("Labels") or {}).get("vless-port")) == str(port):
+        task = spec.get("TaskTemplate") or {}
+        current = [c.get("ConfigName") for c in (task.get("ContainerSpec") or {}).get("Configs") or []]
+        placed = [c for c in (task.get("Placement") or {}).get("Constraints") or [] if c.startswith("node.hostname==")]
+        stale = [c for c in current if c != config_name]
+        constraints_rm = [c for c in placed if c not in constraints]
+        constraints_add = [c for c in constraints if c not in placed]
+        if config_name in current and not (stale or constraints_rm or constraints_add):
+            return False
+        try:
+            DOCKER.service_update(service_name, constraints_rm=constraints_rm, constraints_add=constraints_add,
+                                  config_rm=stale[0] if stale else None,
+                                  config_add=config_name if config_name not in current else None)
+        except RuntimeError as e:
+            raise RuntimeError(f"Не удалось обновить сервис «{service_name}»: {e}")
+        for name in stale:
+            DOCKER.config_rm(name)
+        return True
+
+    # Сервис с другим портом пересоздаётся целиком
+    if spec is not None:
+        DOCKER.service_rm(service_name)
+    try:
+        DOCKER.service_create(service_name, port, config_name, constraints,
+                              {"vless-port": port, MANAGED_LABEL: "1", **(labels or {})},
+                              container_labels={MANAGED_LABEL: "1"})
+    except RuntimeError as e:
+        raise RuntimeError(f"Не удалось создать сервис «{service_name}»: {e}")
+    return True
+
+
+def build_vless_link(username: str, uuid_str: str, port: int, public_key: str, short_id: str,
+                     domain: str = BASE_DOMAIN) -> str:
+    """
+    Собирает VLESS-ссылку для клиента. Используется чистый базовый домен,
+    порт — тот, который выделен пользователю.
+    """
+    return (
+        f"vless://{uuid_str}@{domain}:{port}"
+        f"?security=reality&encryption=none&alpn=h2,http/1.1&headerType=none"
+        f"&fp=chrome&type=tcp&flow=xtls-rprx-vision&sni=www.google.com"
+        f"&pbk={public_key}&sid={short_id}#{username}"
+    )
+
+
+def provision_user(username: str, port: int, keys: tuple[str, str], node: str | None = None,
+                   user: dict | None = None) -> dict:
+    """
+    Создаёт Docker config и сервис для пользователя на уже выделенном порту.
+    С user (запись из хранилища) переиспользуются его uuid и short_id: если
+    конфиг и нода не изменились, Docker не получает ни одного запроса на запись.
+    При ошибке удаляет созданный config и пробрасывает исключение
+    (порт освобождает вызывающий код). Возвращает запись с VLESS-ссылкой.
+    """
+    private_key, public_key = keys
+    uuid_str = user["uuid"] if user else str(uuid.uuid4())
+    short_id = user["short_id"] if user else "".join(random.choice("0123456789abcdef") for _ in range(8))
+
+    config_dict = create_config_object(username, uuid_str, private_key, short_id)
+    config_name, created = create_docker_config(username, config_dict)
+    try:
+        create_service(username, port, node, config_name)
+    except Exception:
+        if created:
+            DOCKER.config_rm(config_name)
+        raise
+
+    STORE.upsert_user({
+        "username": username, "uuid": uuid_str, "private_key": private_key,
+        "public_key": public_key, "short_id": short_id, "port": port, "node": node,
+    })
+    return {
+        "username": username,
+        "port": port,
+        "node": node,
+        "uuid": uuid_str,
+        "link": build_vless_link(username, uuid_str, port, public_key, short_id),
+    }
+
+
+class StateStore:
+    """
+    Локальное хранилище пользователей (SQLite в режиме WAL): uuid, ключи, short_id,
+    порт, нода, режим (service/shared) и статус. Все поиски — запросы по первичному
+    ключу, без обращений к Docker CLI. Синхронизируется со Swarm командой reconcile.
+    """
+
+    COLUMNS = ("username", "uuid", "private_key", "public_key", "short_id",
+               "port", "node", "mode", "shard", "status", "updated_at")
+
+    def __init__(self, path: Path = None):
+        self.path = Path(path or STATE_DB_FILE)
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    username    TEXT PRIMARY KEY,
+                    uuid        TEXT NOT NULL,
+                    private_key TEXT NOT NULL,
+                    public_key  TEXT NOT NULL,
+                    short_id    TEXT NOT NULL,
+                    port        INTEGER NOT NULL,
+                    node        TEXT,
+                    mode        TEXT NOT NULL DEFAULT 'service',
+                    shard       TEXT,
+                    status      TEXT NOT NULL DEFAULT 'active',
+                    updated_at  REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS users_shard ON users (shard)")
+            self._conn = conn
+        return self._conn
+
+    def upsert_users(self, records: list[dict]) -> None:
+        """
+        Добавляет или обновляет пользователей одной транзакцией.
+        """
+        if not records:
+            return
+        now = time.time()
+        rows = [
+            (r["username"], r["uuid"], r["private_key"], r["public_key"], r["short_id"],
+             r["port"], r.get("node"), r.get("mode", "service"), r.get("shard"),
+             r.get("status", "active"), now)
+            for r in records
+        ]
+        with self._lock, TRACER.span("sqlite", "upsert users", rows=len(rows)):
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    f"INSERT OR REPLACE INTO users ({', '.join(self.COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                    rows
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def upsert_user(self, record: dict) -> None:
+        self.upsert_users([record])
+
+    def get_user(self, username: str) -> dict | None:
+        with self._lock, TRACER.span("sqlite", "get user"):
+            row = self.conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        return dict(row) if row else None
+
+    def list_users(self) -> list[dict]:
+        with self._lock:
+            return [dict(row) for row in self.conn.execute("SELECT * FROM users ORDER BY username")]
+
+    def iter_users(self):
+        """
+        Отдаёт пользователей по одному прямо из курсора — без загрузки всей таблицы в память.
+        """
+        cursor = self.conn.execute("SELECT * FROM users ORDER BY username")
+        for row in cursor:
+            yield dict(row)
+
+    def update_user(self, username: str, **fields) -> None:
+        """
+        Обновляет отдельные поля пользователя (например node или status).
+        """
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, TRACER.span("sqlite", "update user"):
+            self.conn.execute(
+                f"UPDATE users SET {assignments}, updated_at = ? WHERE username = ?",
+                (*fields.values(), time.time(), username)
+            )
+
+    def delete_user(self, username: str) -> None:
+        with self._lock, TRACER.span("sqlite", "delete user"):
+            self.conn.execute("DELETE FROM users WHERE username = ?", (username,))
+
+
+STORE = StateStore()
+
+
+def user_link(user: dict) -> str:
+    """
+    Восстанавливает VLESS-ссылку по записи из хранилища.
+    """
+    domain = single_address() if user["mode"] == "single" else BASE_DOMAIN
+    return build_vless_link(user["username"], user["uuid"], user["port"],
+                            user["public_key"], user["short_id"], domain)
+
+
+def iter_user_rows(live: bool = False, with_links: bool = False):
+    """
+    Перебирает пользователей из хранилища. При live=True состояние сервисов
+    берётся из Swarm одним пакетным запросом (list_vless_services) и
+    подставляется в поля node/status; хранилище при этом не меняется.
+    """
+    services = list_vless_services() if live else None
+    for user in STORE.iter_users():
+        if services is not None:
+            service_name = _shard_service_name(user["shard"]) if user["shard"] else f"vless-{user['username']}"
+            info = services.get(service_name)
+            user["status"] = "active" if info else "missing"
+            if info:
+                user["node"] = info["node"]
+        if with_links:
+            user["link"] = user_link(user)
+        yield user
+
+
+def write_rows(rows, columns: list[str], fmt: str = "table", out=None) -> int:
+    """
+    Потоково печатает строки в формате table, json или jsonl (в out, по умолчанию
+    в текущий sys.stdout). Возвращает число строк.
+    Таблица печатается без выравнивания по всей выборке, чтобы не буферизовать вывод.
+    """
+    out = out or sys.stdout
+    count = 0
+    if fmt == "table":
+        out.write("\t".join(c.upper() for c in columns) + "\n")
+    elif fmt == "json":
+        out.write("[")
+    for row in rows:
+        item = {c: row.get(c) for c in columns}
+        if fmt == "table":
+            out.write("\t".join("-" if v is None else str(v) for v in item.values()) + "\n")
+        elif fmt == "json":
+            out.write(("," if count else "") + "\n  " + json.dumps(item, ensure_ascii=False))
+        else:
+            out.write(json.dumps(item, ensure_ascii=False) + "\n")
+        count += 1
+    if fmt == "json":
+        out.write("\n]\n" if count else "]\n")
+    out.flush()
+    return count
+
+
+def read_batch(source: str) -> list[tuple[str, str | None]]:
+    """
+    Читает список пользователей для add-many из файла (или stdin, если source == "-").
+    Формат строки: <username> [<имя_ноды>]; пустые строки и строки с # пропускаются.
+    Имя общего сервиса (shard-*) в списке — ошибка всего пакета (RuntimeError).
+    """
+    if source == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        lines = Path(source).read_text(encoding="utf-8").splitlines()
+
+    entries = []
+    for lineno, line in enumerate(lines, 1):
+        parts = line.split("#", 1)[0].split()
+        if not parts:
+            continue
+        if parts[0].startswith(SHARD_PREFIX):
+            raise RuntimeError(f"{source}:{lineno}: {RESERVED_NAME_ERROR}")
+        entries.append((parts[0], parts[1] if len(parts) > 1 else None))
+    return entries
+
+
+def add_many(entries: list[tuple[str, str | None]], workers: int = ADD_MANY_WORKERS) -> int:
+    """
+    Пакетно создаёт пользователей: порты выделяются одним проходом, ключи берутся
+    из пула, а docker config/service создаются в пуле из workers потоков.
+    Результаты печатаются в stdout как JSONL. Возвращает число неудачных пользователей.
+    Уже существующий пользователь с отдельным сервисом сохраняет порт и ключи
+    (как при повторном add); клиент общего сервиса или контейнера — ошибка.
+    """
+    seen = set()
+    unique = []
+    existing: dict[str, dict] = {}
+    failures = 0
+
+    def fail(username: str, error: str) -> None:
+        nonlocal failures
+        print(json.dumps({"username": username, "error": error}, ensure_ascii=False), flush=True)
+        failures += 1
+
+    for username, node in entries:
+        if username.startswith(SHARD_PREFIX):
+            fail(username, RESERVED_NAME_ERROR)
+            continue
+        if username in seen:
+            fail(username, "повтор в списке")
+            continue
+        seen.add(username)
+        user = STORE.get_user(username)
+        if user and user["status"] == "active":
+            if user["mode"] == "shared":
+                fail(username, f"уже есть в шарде {user['shard']}")
+                continue
+            if user["mode"] == "single":
+                fail(username, "уже есть в общем контейнере")
+                continue
+            existing[username] = user
+        unique.append((username, node))
+
+    # Новым пользователям без явной ноды ноды подбираются одним проходом по нагрузке
+    new = [(username, node) for username, node in unique if username not in existing]
+    auto_nodes = iter(place_users(sum(1 for _, node in new if node is None)))
+    new = [(username, node if node is not None else next(auto_nodes)) for username, node in new]
+
+    ports = allocate_ports(len(new))
+    keys = KEY_POOL.start().take(len(new))
+
+    jobs = [(username, port, key, node, None) for (username, node), port, key in zip(new, ports, keys)]
+    jobs += [(username, user["port"], (user["private_key"], user["public_key"]), node or user["node"], user)
+             for username, node in unique if (user := existing.get(username))]
+
+    failed_ports = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(provision_user, *job): job for job in jobs}
+        for future in as_completed(futures):
+            username, port, _, _, user = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                if user is None:   # порт существующего пользователя остаётся за ним
+                    failed_ports.append(port)
+                failures += 1
+                record = {"username": username, "error": str(e)}
+            print(json.dumps(record, ensure_ascii=False), flush=True)
+
+    release_ports(failed_ports)
+    return failures
+
+
+@contextmanager
+def locked_state(path: Path):
+    """
+    Открывает JSON-файл состояния под эксклюзивной блокировкой (flock на <path>.lock)
+    и отдаёт его содержимое как dict. Изменения записываются атомарно
+    (временный файл + rename) только при успешном выходе из блока.
+    """
+    lock_fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        with TRACER.span("file", lambda: f"read {path.name}") as span:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            text = path.read_text(encoding="utf-8") if path.exists() else ""
+            span.set(in_bytes=len(text))
+        state = json.loads(text) if text else {}
+        yield state
+        with TRACER.span("file", lambda: f"write {path.name}") as span:
+            text = json.dumps(state, ensure_ascii=False, indent=2)
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_text(text, encoding="utf-8")
+            os.replace(tmp, path)
+            span.set(out_bytes=len(text))
+    finally:
+        os.close(lock_fd)
+
+
+def create_shared_config_object(clients: dict[str, str], private_key: str, short_id: str,
+                                api: bool = False, metrics: bool | None = None) -> dict:
+    """
+    Формирует JSON-конфиг общего сервиса (шарда): тот же inbound, что и у
+    отдельного пользователя, но в settings.clients перечислены все клиенты шарда.
+    clients — {username: uuid}; username записывается в поле email клиента.
+    При api=True включается API Xray (HandlerService) на 127.0.0.1:XRAY_API_PORT
+    внутри контейнера — через него клиенты меняются без перезапуска;
+    metrics — как в create_config_object.
+    """
+    config = create_config_object("", "", private_key, short_id, metrics)
+    inbound = config["inbounds"][0]
+    inbound["tag"] = SHARD_INBOUND_TAG
+    inbound["settings"]["clients"] = [_shard_client(username, uuid_str)
+                                      for username, uuid_str in sorted(clients.items())]
+    if api:
+        _enable_xray_api(config, "HandlerService")
+    return config
+
+
+def _shard_client(username: str, uuid_str: str) -> dict:
+    return {"id": uuid_str, "flow": "xtls-rprx-vision", "email": username}
+
+
+class XrayApi:
+    """
+    Клиент API Xray поверх команды `xray api` (adu/rmu). По умолчанию команда
+    выполняется внутри контейнера шарда через `docker exec`, поэтому работает
+    только для шардов, запущенных на этой ноде.
+    """
+
+    def __init__(self, command: str = XRAY_API_CMD, server: str = XRAY_API_SERVER):
+        self.command = command
+        self.server = server
+
+    def _base_cmd(self, shard_id: str) -> list[str]:
+        container = ""
+        if "{container}" in self.command:
+            containers = DOCKER.service_containers(_shard_service_name(shard_id))
+            container = containers[0] if containers else ""
+            if not container:
+                raise RuntimeError(f"Контейнер шарда «{shard_id}» не запущен на этой ноде.")
+        return shlex.split(self.command.format(container=container))
+
+    def _query(self, container: str, args: list[str]) -> dict:
+        with TRACER.span("xray", lambda: f"api {args[0]}") as span:
+            proc = subprocess.run(
+                shlex.split(self.command.format(container=container)) + args,
+                capture_output=True, text=True, timeout=30
+            )
+            span.set(exit_code=proc.returncode, out_bytes=len(proc.stdout))
+        if proc.returncode != 0:
+            raise RuntimeError(f"xray api {args[0]}: {(proc.stderr or proc.stdout).strip()}")
+        return json.loads(proc.stdout or "{}")
+
+    def user_traffic(self, container: str, reset: bool = True) -> dict[tuple[str, str], int]:
+        """
+        Счётчики трафика пользователей контейнера: {(username, uplink|downlink): байт}.
+        С reset=True Xray обнуляет их после чтения, так что возвращаются приращения.
+        """
+        args = ["statsquery", f"-s={self.server}", "-pattern", "user>>>"]
+        traffic = {}
+        for stat in self._query(container, args + (["-reset"] if reset else [])).get("stat") or []:
+            parts = stat.get("name", "").split(">>>")
+            if len(parts) == 4 and parts[0] == "user" and parts[2] == "traffic":
+                traffic[(parts[1], parts[3])] = int(stat.get("value") or 0)
+        return traffic
+
+    def online_users(self, container: str) -> list[str]:
+        """Пользователи контейнера, у которых сейчас есть подключения."""
+        data = self._query(container, ["statsgetallonlineusers", f"-s={self.server}"])
+        return [name.split(">>>")[1] if ">>>" in name else name for name in data.get("users") or []]
+
+    def _run(self, shard_id: str, args: list[str], payload: dict | None = None) -> None:
+        command = self._base_cmd(shard_id) + args
+        with TRACER.span("xray", lambda: f"api {args[0]}") as span:
+            proc = subprocess.run(
+                command,
+                input=json.dumps(payload) if payload is not None else None,
+                capture_output=True, text=True
+            )
+            span.set(exit_code=proc.returncode, out_bytes=len(proc.stdout))
+        if proc.returncode != 0:
+            raise RuntimeError(f"xray api {args[0]}: {(proc.stderr or proc.stdout).strip()}")
+
+    def add_users(self, shard_id: str, clients: dict[str, str]) -> None:
+        """Добавляет клиентов {username: uuid} во входящий vless-in шарда."""
+        payload = {"inbounds": [{
+            "tag": SHARD_INBOUND_TAG,
+            "protocol": "vless",
+            "settings": {"clients": [_shard_client(u, i) for u, i in clients.items()], "decryption": "none"},
+        }]}
+        self._run(shard_id, ["adu", f"-s={self.server}", "stdin:"], payload)
+
+    def remove_users(self, shard_id: str, usernames: list[str]) -> None:
+        """Удаляет клиентов (по email = username) из входящего vless-in шарда."""
+        self._run(shard_id, ["rmu", f"-s={self.server}", f"-tag={SHARD_INBOUND_TAG}", *usernames])
+
+
+XRAY_API = XrayApi()
+
+
+def _shard_service_name(shard_id: str) -> str:
+    return f"vless-{shard_id}"
+
+
+def _write_shard_config_file(shard_id: str, shard: dict) -> dict:
+    """
+    Рендерит конфиг шарда и сохраняет его в SHARD_CONFIGS_DIR/<shard_id>.json.
+    Возвращает отрендеренный dict.
+    """
+    config_dict = create_shared_config_object(shard["clients"], shard["private_key"],
+                                              shard["short_id"], api=shard.get("api", False))
+    SHARD_CONFIGS_DIR.mkdir(exist_ok=True)
+    path = SHARD_CONFIGS_DIR / f"{shard_id}.json"
+    with TRACER.span("file", "write shard config") as span:
+        text = json.dumps(config_dict, ensure_ascii=False, indent=2)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, path)
+        span.set(out_bytes=len(text))
+    return config_dict
+
+
+def _apply_shard_config(shard_id: str, shard: dict, is_new: bool, api: bool = False) -> None:
+    """
+    Публикует новую ревизию конфига шарда и подключает её к сервису.
+    Docker config неизменяемый, поэтому каждая ревизия — отдельный
+    vless-config-<shard_id>-<хэш>; старая ревизия удаляется после переключения,
+    а если содержимое не изменилось, сервис не трогается.
+    Затрагивается только сервис этого шарда. api=True включает в шарде API Xray.
+    """
+    old_config = shard.get("config")
+
+    shard["api"] = shard.get("api", False) or api
+    config_dict = _write_shard_config_file(shard_id, shard)
+    new_config, created = create_docker_config(shard_id, config_dict)
+    if new_config == old_config and not is_new:
+        shard.pop("pending", None)
+        return
+
+    try:
+        if is_new:
+            create_service(shard_id, shard["port"], shard.get("node"),
+                           config_name=new_config, labels={"vless-shard": shard_id})
+        else:
+            try:
+                DOCKER.service_update(_shard_service_name(shard_id), config_rm=old_config, config_add=new_config)
+            except RuntimeError as e:
+                raise RuntimeError(f"Не удалось обновить сервис «{_shard_service_name(shard_id)}»: {e}")
+    except Exception:
+        if created:
+            DOCKER.config_rm(new_config)
+        raise
+
+    _commit_shard_config(shard, new_config)
+
+
+def _commit_shard_config(shard: dict, new_config: str) -> None:
+    """Запоминает подключённую к сервису ревизию конфига шарда и удаляет прежнюю."""
+    old_config = shard.get("config")
+    shard["revision"] = shard.get("revision", 0) + 1
+    shard["config"] = new_config
+    shard.pop("pending", None)
+    if old_config and old_config != new_config:
+        DOCKER.config_rm(old_config)
+
+
+def _hot_update_shard(shard_id: str, shard: dict, added: dict[str, str], removed: list[str]) -> bool:
+    """
+    Применяет изменения клиентов шарда вживую через API Xray, без перезапуска контейнера.
+    Конфиг сохраняется только как файл-источник истины, шард помечается pending —
+    Docker config догоняется командой sync-shards или вместе с изменением, которое
+    и так перезапускает задачу (обновление без hot, перенос шарда). Возвращает
+    False, если горячее обновление невозможно (API в шарде не включён или недоступен).
+    """
+    if not shard.get("api"):
+        return False
+    try:
+        if added:
+            XRAY_API.add_users(shard_id, added)
+        if removed:
+            XRAY_API.remove_users(shard_id, removed)
+    except RuntimeError as e:
+        print(f"⚠️ Горячее обновление шарда «{shard_id}» не удалось ({e}), применяем с перезапуском.",
+              file=sys.stderr)
+        return False
+    _write_shard_config_file(shard_id, shard)
+    shard["pending"] = True
+    return True
+
+
+def add_shared_users(entries: list[tuple[str, str | None]], shard_size: int = SHARD_SIZE,
+                     hot: bool = HOT_RELOAD) -> list[dict]:
+    """
+    Добавляет пользователей в общие сервисы (шарды) по shard_size клиентов в каждом.
+    Сначала заполняются уже существующие шарды на нужной ноде, затем создаются новые.
+    Каждый затронутый шард получает ровно одно обновление конфига за вызов;
+    при hot=True существующие шарды обновляются через API Xray без перезапуска.
+    Возвращает записи с VLESS-ссылками (формат ссылки тот же, что и в обычном режиме);
+    для пользователей, чей шард не удалось обновить, запись содержит поле error.
+    """
+    records = []
+    with locked_state(SHARDS_FILE) as state:
+        shards = state.setdefault("shards", {})
+        users = state.setdefault("users", {})
+
+        snapshots: dict[str, dict | None] = {}   # shard_id -> состояние до вызова (None — новый шард)
+        placed: dict[str, list[tuple[str, str]]] = {}
+        for username, node in entries:
+            if username.startswith(SHARD_PREFIX):
+                records.append({"username": username, "error": RESERVED_NAME_ERROR})
+                continue
+            if username in users:
+                records.append({"username": username, "error": f"уже есть в шарде {users[username]}"})
+                continue
+            candidates = [
+                sid for sid, sh in shards.items()
+                if sh.get("node") == node and len(sh["clients"]) < shard_size
+            ]
+            if candidates:
+                # плотнее упаковываем: выбираем самый заполненный из неполных шардов
+                shard_id = max(candidates, key=lambda sid: len(shards[sid]["clients"]))
+                snapshots.setdefault(shard_id, json.loads(json.dumps(shards[shard_id])))
+            else:
+                shard_id = f"{SHARD_PREFIX}{state.get('next_shard', 1)}"
+                state["next_shard"] = state.get("next_shard", 1) + 1
+                private_key, public_key = KEY_POOL.get()
+                shards[shard_id] = {
+                    "port": get_next_port(),
+                    "node": node,
+                    "private_key": private_key,
+                    "public_key": public_key,
+                    "short_id": "".join(random.choice("0123456789abcdef") for _ in range(8)),
+                    "clients": {},
+                }
+                snapshots[shard_id] = None
+            uuid_str = str(uuid.uuid4())
+            shards[shard_id]["clients"][username] = uuid_str
+            users[username] = shard_id
+            placed.setdefault(shard_id, []).append((username, uuid_str))
+
+        for shard_id, members in placed.items():
+            shard = shards[shard_id]
+            is_new = snapshots[shard_id] is None
+            try:
+                if not (hot and not is_new and _hot_update_shard(shard_id, shard, dict(members), [])):
+                    _apply_shard_config(shard_id, shard, is_new=is_new, api=hot)
+            except Exception as e:
+                # откатываем только этот шард, остальные уже применены
+                for username, _ in members:
+                    del users[username]
+                    records.append({"username": username, "error": str(e)})
+                if snapshots[shard_id] is None:
+                    release_port(shard["port"])
+                    del shards[shard_id]
+                else:
+                    shards[shard_id] = snapshots[shard_id]
+                continue
+            STORE.upsert_users([
+                {"username": username, "uuid": uuid_str, "private_key": shard["private_key"],
+                 "public_key": shard["public_key"], "short_id": shard["short_id"], "port": shard["port"],
+                 "node": shard.get("node"), "mode": "shared", "shard": shard_id}
+                for username, uuid_str in members
+            ])
+            for username, uuid_str in members:
+                records.append({
+                    "username": username,
+                    "port": shard["port"],
+                    "node": shard.get("node"),
+                    "shard": shard_id,
+                    "uuid": uuid_str,
+                    "link": build_vless_link(username, uuid_str, shard["port"],
+                                             shard["public_key"], shard["short_id"]),
+                })
+    return records
+
+
+def find_shard(username: str) -> str | None:
+    """
+    Возвращает идентификатор шарда, в котором живёт пользователь, или None.
+    """
+    if not SHARDS_FILE.exists():
+        return None
+    state = json.loads(SHARDS_FILE.read_text(encoding="utf-8"))
+    return state.get("users", {}).get(username)
+
+
+def remove_shared_user(username: str, hot: bool = HOT_RELOAD) -> bool:
+    """
+    Удаляет пользователя из его шарда. Обновляется конфиг только этого шарда
+    (при hot=True — через API Xray без перезапуска); опустевший шард удаляется
+    целиком вместе с портом. Возвращает False, если пользователь не найден ни в одном шарде.
+    """
+    with locked_state(SHARDS_FILE) as state:
+        shard_id = state.get("users", {}).get(username)
+        if shard_id is None:
+            return False
+        shard = state["shards"][shard_id]
+        del shard["clients"][username]
+        del state["users"][username]
+
+        if shard["clients"]:
+            if not (hot and _hot_update_shard(shard_id, shard, {}, [username])):
+                _apply_shard_config(shard_id, shard, is_new=False, api=hot)
+        else:
+            DOCKER.service_rm(_shard_service_name(shard_id))
+            DOCKER.config_rm(shard["config"])
+            release_port(shard["port"])
+            del state["shards"][shard_id]
+    STORE.delete_user(username)
+    return True
+
+
+def sync_shards() -> list[str]:
+    """
+    Публикует в Docker config все шарды, изменённые вживую (pending).
+    Это перезапускает их контейнеры, поэтому выполняется отдельной командой,
+    например в окно обслуживания. Возвращает список синхронизированных шардов.
+    """
+    synced = []
+    with locked_state(SHARDS_FILE) as state:
+        for shard_id, shard in state.get("shards", {}).items():
+            if not shard.get("pending"):
+                continue
+            try:
+                _apply_shard_config(shard_id, shard, is_new=False)
+            except Exception as e:
+                print(f"⚠️ Шард «{shard_id}» не синхронизирован: {e}", file=sys.stderr)
+                continue
+            synced.append(shard_id)
+    return synced
+
+
+# -------------------------------------------------------------------
+#  Общий контейнер с отложенной перезагрузкой (режим vless_manager.sh)
+# -------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def single_address() -> str:
+    """
+    Адрес сервера в ссылках общего контейнера: SINGLE_ADDRESS, BASE_DOMAIN
+    или (SINGLE_ADDRESS=ipv6) первый глобальный не-ULA IPv6-адрес хоста в [скобках].
+    """
+    if SINGLE_ADDRESS.lower() != "ipv6":
+        return SINGLE_ADDRESS or BASE_DOMAIN
+    out = subprocess.run(["ip", "-6", "addr", "show", "scope", "global"], capture_output=True, text=True).stdout
+    for address in re.findall(r"inet6 ([0-9a-f:]+)/", out):
+        if not address.startswith("fd"):
+            return f"[{address}]"
+    raise RuntimeError("Не найден глобальный IPv6-адрес (VLESS_SINGLE_ADDRESS=ipv6).")
+
+
+def _init_single_state(state: dict) -> None:
+    """
+    Заполняет пустое состояние общего контейнера. Ключи и short_id берутся из
+    config.json, а клиенты — из users.json shell-версии, если они есть, чтобы
+    существующие ссылки продолжили работать; иначе генерируются новые.
+    """
+    if "private_key" in state:
+        return
+    try:
+        config = json.loads(SINGLE_CONFIG_FILE.read_text(encoding="utf-8"))
+        reality = config["inbounds"][0]["streamSettings"]["realitySettings"]
+        private_key, short_id = reality["privateKey"], reality["shortIds"][0]
+        clients = json.loads(SINGLE_USERS_FILE.read_text(encoding="utf-8")) if SINGLE_USERS_FILE.exists() else {}
+    except (FileNotFoundError, ValueError, KeyError, IndexError):
+        private_key, _ = KEY_POOL.get()
+        short_id = "".join(random.choice("0123456789abcdef") for _ in range(8))
+        clients = {}
+    state.update({
+        "private_key": private_key,
+        "public_key": x25519_public_key(private_key),
+        "short_id": short_id,
+        "clients": clients,
+        "pending": 0,
+        "last_change": 0,
+        "reloads": [],
+    })
+    STORE.upsert_users([_single_record(state, username, uuid_str) for username, uuid_str in clients.items()])
+
+
+def _single_record(state: dict, username: str, uuid_str: str) -> dict:
+    return {"username": username, "uuid": uuid_str, "private_key": state["private_key"],
+            "public_key": state["public_key"], "short_id": state["short_id"], "port": SINGLE_PORT,
+            "node": None, "mode": "single"}
+
+
+def add_single_users(usernames: list[str]) -> list[dict]:
+    """
+    Добавляет пользователей в общий контейнер. Меняется только состояние
+    single.json: изменение помечается как ожидающее, а конфиг и контейнер
+    обновляет reload_single. Возвращает записи с VLESS-ссылками (или с error).
+    """
+    records = []
+    with locked_state(SINGLE_STATE_FILE) as state:
+        _init_single_state(state)
+        clients = state["clients"]
+        added = []
+        for username in usernames:
+            if username.startswith(SHARD_PREFIX):
+                records.append({"username": username, "error": RESERVED_NAME_ERROR})
+                continue
+            if username in clients:
+                records.append({"username": username, "error": "уже есть в общем контейнере"})
+                continue
+            clients[username] = str(uuid.uuid4())
+            added.append(_single_record(state, username, clients[username]))
+        if added:
+            state["pending"] += len(added)
+            state["last_change"] = time.time()
+        STORE.upsert_users(added)
+    for record in added:
+        records.append({"username": record["username"], "port": SINGLE_PORT, "uuid": record["uuid"],
+                        "link": build_vless_link(record["username"], record["uuid"], SINGLE_PORT,
+                                                 record["public_key"], record["short_id"], single_address())})
+    return records
+
+
+def remove_single_user(username: str) -> bool:
+    """
+    Убирает пользователя из общего контейнера (изменение ждёт reload_single).
+    Возвращает False, если такого пользователя там нет.
+    """
+    if not SINGLE_STATE_FILE.exists():
+        return False
+    with locked_state(SINGLE_STATE_FILE) as state:
+        if username not in state.get("clients", {}):
+            return False
+        del state["clients"][username]
+        state["pending"] += 1
+        state["last_change"] = time.time()
+    STORE.delete_user(username)
+    return True
+
+
+def _write_single_config(state: dict) -> None:
+    """
+    Пишет config.json поверх существующего файла (тот же inode): он смонтирован
+    в контейнер как файл, и после rename контейнер продолжил бы видеть старую
+    версию. Контейнер читает конфиг только при перезапуске, который идёт после записи.
+    """
+    config = create_shared_config_object(state["clients"], state["private_key"], state["short_id"])
+    if SINGLE_ADDRESS.lower() == "ipv6":
+        config["inbounds"][0]["listen"] = "::"
+    with TRACER.span("file", "write config.json") as span:
+        text = json.dumps(config, ensure_ascii=False, indent=2)
+        with open(SINGLE_CONFIG_FILE, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        span.set(out_bytes=len(text))
+
+
+def _restart_single_container() -> None:
+    """Перезапускает общий контейнер, а если его нет — создаёт (как `docker run` в shell-версии)."""
+    if DOCKER.container_restart(SINGLE_CONTAINER):
+        return
+    ipv6 = SINGLE_ADDRESS.lower() == "ipv6"
+    try:
+        DOCKER.container_run(SINGLE_CONTAINER, {str(SINGLE_CONFIG_FILE): XRAY_CONFIG_TARGET},
+                             ports=[] if ipv6 else [SINGLE_PORT], host_network=ipv6)
+    except RuntimeError as e:
+        raise RuntimeError(f"Не удалось запустить контейнер «{SINGLE_CONTAINER}»: {e}")
+
+
+def _wait_quiet(debounce: float, max_delay: float) -> None:
+    """Ждёт, пока изменений не будет debounce секунд подряд, но не дольше max_delay."""
+    deadline = time.time() + max_delay
+    while True:
+        state = json.loads(SINGLE_STATE_FILE.read_text(encoding="utf-8"))
+        left = min(state.get("last_change", 0) + debounce, deadline) - time.time()
+        if left <= 0:
+            return
+        time.sleep(left)
+
+
+def reload_single(debounce: float = RELOAD_DEBOUNCE, max_delay: float = RELOAD_MAX_DELAY) -> list[dict]:
+    """
+    Применяет накопленные изменения общего контейнера: после debounce секунд
+    без новых изменений конфиг пишется один раз и контейнер перезапускается
+    один раз, сколько бы add/remove ни пришло за это время. Перезагрузкой
+    занимается один процесс (flock на <single.json>.reload); остальные сразу
+    возвращают [], а их изменения подхватывает он. Изменения, пришедшие во
+    время перезапуска, применяются следующей перезагрузкой того же процесса.
+    Возвращает выполненные перезагрузки: [{"at", "ops", "seconds"}].
+    """
+    if not SINGLE_STATE_FILE.exists():
+        return []
+    lock_fd = os.open(f"{SINGLE_STATE_FILE}.reload", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(lock_fd)
+        return []
+
+    reloads = []
+    try:
+        while True:
+            _wait_quiet(debounce, max_delay)
+            with locked_state(SINGLE_STATE_FILE) as state:
+                ops = state.get("pending", 0)
+                if not ops:
+                    # Отпускаем перезагрузку, пока держим состояние: add после этой
+                    # проверки сам станет следующим перезагружающим процессом
+                    os.close(lock_fd)
+                    lock_fd = None
+                    break
+                _write_single_config(state)
+                state["pending"] = 0
+            started = time.monotonic()
+            try:
+                _restart_single_container()
+            except Exception:
+                with locked_state(SINGLE_STATE_FILE) as state:
+                    state["pending"] += ops
+                raise
+            record = {"at": round(time.time(), 3), "ops": ops, "seconds": round(time.monotonic() - started, 3)}
+            with locked_state(SINGLE_STATE_FILE) as state:
+                state["reloads"] = (state.get("reloads", []) + [record])[-20:]
+            reloads.append(record)
+    finally:
+        if lock_fd is not None:
+            os.close(lock_fd)
+    return reloads
+
+
+def report_reloads(reloads: list[dict]) -> None:
+    if not reloads:
+        print("⏳ Изменение применит перезагрузка, которую уже ждёт другой процесс.", file=sys.stderr)
+    for reload in reloads:
+        print(f"🔄 Контейнер {SINGLE_CONTAINER} перезапущен за {reload['seconds']:.1f} с: "
+              f"применено изменений — {reload['ops']}", file=sys.stderr)
+
+
+def discard_user(username: str, hot: bool = HOT_RELOAD) -> str | None:
+    """
+    Удаляет пользователя без вывода сообщений:
+      1) Если пользователь в общем сервисе — убирает его из шарда
+      2) Иначе останавливает и удаляет сервис vless-<username>
+      3) Удаляет его Docker configs (vless-config-<username>-<хэш>)
+      4) Освобождает порт (если удалось его узнать)
+    Пользователь общего контейнера (режим single) только убирается из его
+    конфига — перезагрузку выполняет reload_single.
+    Возвращает "single", "shared", "service" или None, если сервиса уже не было.
+    Имя общего сервиса (shard-*) не принимается: шард удаляется сам, когда
+    из него уходит последний клиент, вместе с записями в shards.json и хранилище.
+    """
+    if username.startswith(SHARD_PREFIX):
+        raise RuntimeError(f"«{username}» — общий сервис, а не пользователь. "
+                           f"Удалите его клиентов (remove <username>), опустевший шард удалится сам.")
+    if remove_single_user(username):
+        return "single"
+    if remove_shared_user(username, hot):
+        return "shared"
+
+    service_name = f"vless-{username}"
+    spec = DOCKER.service_spec(service_name) or {}
+    task = spec.get("TaskTemplate") or {}
+    configs = [c.get("ConfigName") for c in (task.get("ContainerSpec") or {}).get("Configs") or []]
+
+    # Порт берём из локального хранилища, а если пользователя там нет —
+    # из метки vless-port сервиса (если сервис ещё существует)
+    user = STORE.get_user(username)
+    port_to_release = user["port"] if user else None
+    label = str((spec.get("Labels") or {}).get("vless-port", ""))
+    if port_to_release is None and label.isdigit():
+        port_to_release = int(label)
+
+    removed = DOCKER.service_rm(service_name)
+    for config_name in configs:
+        DOCKER.config_rm(config_name)
+    if port_to_release:
+        release_port(port_to_release)
+    STORE.delete_user(username)
+    return "service" if removed else None
+
+
+def remove_user(username: str, hot: bool = HOT_RELOAD) -> None:
+    """
+    Удаляет пользователя (см. discard_user) и печатает результат.
+    """
+    report_removed(username, discard_user(username, hot))
+
+
+def report_removed(username: str, kind: str | None) -> None:
+    if kind == "single":
+        print(f"✅ Пользователь «{username}» удалён из общего контейнера {SINGLE_CONTAINER}.")
+        return
+    if kind == "shared":
+        print(f"✅ Пользователь «{username}» удалён из общего сервиса.")
+        return
+    if kind is None:
+        print(f"⚠️ Сервис «vless-{username}» не найден или уже удалён.")
+    print(f"✅ Пользователь «{username}» удалён.")
+
+
+def migrate_user(username: str, target_node: str) -> None:
+    """
+    Переносит сервис vless-<username> на другую ноду, обновляя constraint
+    (все node.hostname==* из его спецификации заменяются на node.hostname==<target_node>).
+    Горячие изменения переносимого шарда (pending) публикуются тем же обновлением.
+    При ошибке бросает RuntimeError.
+    """
+    service_name = f"vless-{username}"
+
+    user = STORE.get_user(username)
+    if user or not username.startswith(SHARD_PREFIX):
+        _move_service(service_name, target_node)
+        if user:
+            STORE.update_user(username, node=target_node)
+        return
+
+    # Переносится шард целиком — обновляем ноду у шарда и всех его клиентов
+    with locked_state(SHARDS_FILE) as state:
+        shard = state.get("shards", {}).get(username)
+        if not (shard and shard.get("pending")):
+            _move_service(service_name, target_node)
+        else:
+            # Перенос и так перезапускает задачу — тем же обновлением публикуем горячие изменения шарда
+            new_config, created = create_docker_config(username, _write_shard_config_file(username, shard))
+            try:
+                _move_service(service_name, target_node, config_rm=shard.get("config"), config_add=new_config)
+            except Exception:
+                if created:
+                    DOCKER.config_rm(new_config)
+                raise
+            _commit_shard_config(shard, new_config)
+        if shard:
+            shard["node"] = target_node
+            for member in shard["clients"]:
+                STORE.update_user(member, node=target_node)
+
+
+def _move_service(service_name: str, target_node: str,
+                  config_rm: str | None = None, config_add: str | None = None) -> None:
+    """
+    Заменяет все node.hostname==* сервиса привязкой к target_node (и, если заданы, его config).
+    Текущие constraints берутся из спецификации сервиса, а не из хранилища: запись
+    о ноде в хранилище могла разойтись со Swarm, и лишняя привязка сделала бы задачу
+    неразмещаемой.
+    """
+    if config_rm == config_add:
+        config_rm = config_add = None
+    try:
+        DOCKER.service_update(service_name, node=target_node, config_rm=config_rm, config_add=config_add)
+    except RuntimeError as e:
+        raise RuntimeError(f"Не удалось перенести сервис «{service_name}» на ноду «{target_node}»: {e}")
+
+
+# -------------------------------------------------------------------
+#  Размещение по нодам и ребалансировка
+# -------------------------------------------------------------------
+def collect_node_stats(services: dict[str, dict] | None = None) -> dict[str, dict]:
+    """
+    Снимает статистику активных нод Swarm: {hostname: {"cpus", "memory",
+    "services", "reserved_cpus", "reserved_memory"}}. Сервис относится к ноде
+    из его constraint, а непривязанный — к ноде, где запущена его задача.
+    """
+    services = list_vless_services() if services is None else services
+    try:
+        nodes = DOCKER.node_list()
+        tasks = DOCKER.running_tasks() if any(info["node"] is None for info in services.values()) else {}
+    except RuntimeError as e:
+        raise RuntimeError(f"Не удалось получить список нод: {e}")
+
+    stats = {}
+    for node in nodes:
+        if (node.get("Spec") or {}).get("Availability") != "active" \
+                or (node.get("Status") or {}).get("State") != "ready":
+            continue
+        resources = (node.get("Description") or {}).get("Resources") or {}
+        stats[node["Description"]["Hostname"]] = {
+            "cpus": resources.get("NanoCPUs", 0) / 1e9 or 1.0,
+            "memory": resources.get("MemoryBytes", 0),
+            "services": 0,
+            "reserved_cpus": 0.0,
+            "reserved_memory": 0,
+        }
+    for name, info in services.items():
+        host = info["node"] or tasks.get(name)
+        if host in stats:
+            stats[host]["services"] += 1
+            stats[host]["reserved_cpus"] += info["reserved_cpus"]
+            stats[host]["reserved_memory"] += info["reserved_memory"]
+    return stats
+
+
+def node_load(stat: dict) -> tuple[float, float]:
+    """
+    Нагрузка ноды для сравнения: сервисов на CPU, затем доля зарезервированных
+    CPU/памяти (чем меньше, тем свободнее нода).
+    """
+    reserved = stat["reserved_cpus"] / stat["cpus"]
+    if stat["memory"]:
+        reserved = max(reserved, stat["reserved_memory"] / stat["memory"])
+    return stat["services"] / stat["cpus"], reserved
+
+
+def _cached_node_stats(cache: dict, max_age: int = NODE_STATS_TTL) -> dict[str, dict]:
+    if time.time() - cache.get("collected_at", 0) > max_age:
+        cache["nodes"] = collect_node_stats()
+        cache["collected_at"] = time.time()
+    return cache["nodes"]
+
+
+def place_users(count: int) -> list[str | None]:
     """
-    Читает USED_PORTS_FILE (./used_ports.txt), ищет первый свободный порт >= start,
-    дописывает его в файл и возвращает.
+    Выбирает ноды для count новых сервисов: каждый следующий — на наименее
+    загруженную с учётом уже выбранных. Статистика берётся из кэша
+    node_stats.json (не старше NODE_STATS_TTL) и сразу в нём обновляется,
+    поэтому параллельные add не выбирают одну и ту же ноду. Если статистику
+    получить нельзя или PLACEMENT=swarm — возвращает None, ноду выбирает Swarm.
     """
-    if not USED_PORTS_FILE.exists():
-        USED_PORTS_FILE.write_text(f"{start}\n")
-        return start
-
-    with open(USED_PORTS_FILE, "r", encoding="utf-8") as f:
-        used_ports = sorted({int(line.strip()) for line in f if line.strip().isdigit()})
+    if PLACEMENT != "auto" or count <= 0:
+        return [None] * count
+    try:
+        with locked_state(NODE_STATS_FILE) as cache:
+            nodes = _cached_node_stats(cache)
+            if not nodes:
+                return [None] * count
+            chosen = []
+            for _ in range(count):
+                host = min(nodes, key=lambda h: (node_load(nodes[h]), h))
+                nodes[host]["services"] += 1
+                chosen.append(host)
+            return chosen
+    except RuntimeError as e:
+        print(f"⚠️ Автоматическое размещение недоступно ({e}), ноду выберет Swarm.", file=sys.stderr)
+        return [None] * count
 
-    port = start
-    while port in used_ports:
-        port += 1
 
-    with open(USED_PORTS_FILE, "a", encoding="utf-8") as f:
-        f.write(f"{port}\n")
-    return port
+def invalidate_node_stats() -> None:
+    with locked_state(NODE_STATS_FILE) as cache:
+        cache["collected_at"] = 0
 
 
-def release_port(port: int) -> None:
+def plan_rebalance(nodes: dict[str, dict], placements: dict[str, str],
+                   max_moves: int | None = None) -> list[dict]:
     """
-    Убирает конкретный порт из used_ports.txt (при удалении пользователя).
+    Жадный план переносов: пока перенос одного сервиса с самой загруженной ноды
+    на самую свободную снижает максимум нагрузки, переносим с неё пользователя.
+    placements — {username: нода} отдельных сервисов; шарды не переносятся.
+    Возвращает [{"username", "from", "to"}].
     """
-    if not USED_PORTS_FILE.exists():
-        return
-    with open(USED_PORTS_FILE, "r", encoding="utf-8") as f:
-        lines = [line.strip() for line in f if line.strip().isdigit()]
-    updated = [l for l in lines if int(l) != port]
-    with open(USED_PORTS_FILE, "w", encoding="utf-8") as f:
-        if updated:
-            f.write("\n".join(updated) + "\n")
-        else:
-            f.write("")
+    nodes = {host: dict(stat) for host, stat in nodes.items()}
+    movable: dict[str, list[str]] = {host: [] for host in nodes}
+    for username, host in sorted(placements.items()):
+        if host in movable:
+            movable[host].append(username)
 
+    def load(host: str, delta: int = 0) -> float:
+        return (nodes[host]["services"] + delta) / nodes[host]["cpus"]
 
-def generate_x25519_keys() -> tuple[str, str]:
+    plan = []
+    while max_moves is None or len(plan) < max_moves:
+        sources = [host for host in nodes if movable[host]]
+        if not sources:
+            break
+        src = max(sources, key=lambda h: (load(h), h))
+        dst = min(nodes, key=lambda h: (load(h), h))
+        if src == dst or max(load(src, -1), load(dst, +1)) >= load(src):
+            break
+        username = movable[src].pop()
+        nodes[src]["services"] -= 1
+        nodes[dst]["services"] += 1
+        plan.append({"username": username, "from": src, "to": dst})
+    return plan
+
+
+def rebalance(max_moves: int | None = None, workers: int = REBALANCE_WORKERS,
+              dry_run: bool = False, fmt: str = "table") -> int:
     """
-    Генерирует x25519-ключи через Docker-контейнер teddysun/xray.
-    Возвращает (private_key, public_key).
+    Строит план по свежей статистике нод и выполняет переносы в пуле из
+    workers потоков (dry_run — только печатает план). Возвращает число ошибок.
     """
-    proc = subprocess.run(
-        ["docker", "run", "--rm", "teddysun/xray", "xray", "x25519"],
-        capture_output=True,
-        text=True
-    )
-    if proc.returncode != 0:
-        print("❌ Ошибка при запуске контейнера teddysun/xray для генерации ключей.")
-        print(proc.stderr)
-        sys.exit(1)
+    services = list_vless_services()
+    nodes = collect_node_stats(services)
+    tasks = DOCKER.running_tasks() if any(info["node"] is None for info in services.values()) else {}
+    placements = {}
+    for user in STORE.iter_users():
+        info = services.get(f"vless-{user['username']}")
+        if user["mode"] == "service" and info:
+            placements[user["username"]] = info["node"] or tasks.get(f"vless-{user['username']}")
+    plan = plan_rebalance(nodes, placements, max_moves)
 
-    out = proc.stdout.splitlines()
-    priv = ""
-    pub = ""
-    for line in out:
-        if line.startswith("Private key:"):
-            priv = line.split(":", 1)[1].strip()
-        elif line.startswith("Public key:"):
-            pub = line.split(":", 1)[1].strip()
-    if not priv or not pub:
-        raise RuntimeError("Не удалось сгенерировать x25519-ключи.")
-    return priv, pub
+    if dry_run or not plan:
+        write_rows(plan, REBALANCE_COLUMNS, fmt)
+        return 0
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(migrate_user, move["username"], move["to"]): move for move in plan}
+        for future in as_completed(futures):
+            record = dict(futures[future])
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                record["error"] = str(e)
+            print(json.dumps(record, ensure_ascii=False), flush=True)
+    invalidate_node_stats()
+    return failures
+
+
+# -------------------------------------------------------------------
+#  Декларативное применение (apply)
+# -------------------------------------------------------------------
+def _desired_entry(item, node: str | None, where: str) -> tuple[str, dict]:
+    if isinstance(item, str):
+        item = {"name": item}
+    if not isinstance(item, dict) or not isinstance(item.get("name"), str) or not item["name"].strip():
+        raise RuntimeError(f"{where}: ожидается имя пользователя или {{name: ..., mode: ..., node: ...}}, получено {item!r}")
+    mode = item.get("mode", "service")
+    if mode not in ("service", "shared"):
+        raise RuntimeError(f"{where}: неизвестный режим «{mode}» у «{item['name']}» (service|shared)")
+    return item["name"].strip(), {"mode": mode, "node": item.get("node", node)}
 
 
-def create_docker_config(username: str, config_json: dict) -> None:
+def load_desired_state(source: str) -> dict[str, dict]:
     """
-    Создаёт Docker config c именем vless-config-<username> со своим JSON-содержимым.
-    Если config с таким именем уже есть — удаляет старый и создаёт заново.
+    Читает файл желаемого состояния (YAML или JSON; "-" — stdin):
+
+        nodes:                        # пользователи, закреплённые за нодами
+          node-1: [alice, {name: bob, mode: shared}]
+        users:                        # нода не важна (новым выбирается по нагрузке)
+          - carol
+          - {name: dave, mode: shared}
+
+    Возвращает {username: {"mode": service|shared, "node": имя_ноды|None}}.
     """
-    config_name = f"{CONFIG_NAME_PREFIX}-{username}"
+    text = sys.stdin.read() if source == "-" else Path(source).read_text(encoding="utf-8")
+    try:
+        data = json.loads(text)
+    except ValueError:
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError("Для YAML-файла нужен PyYAML (pip install pyyaml); JSON читается без него.")
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise RuntimeError(f"Не удалось разобрать {source}: {e}")
+    data = data or {}
+    if not isinstance(data, dict):
+        raise RuntimeError(f"{source}: ожидаются разделы nodes и/или users")
 
-    # Если конфиг с таким именем уже есть, удалим
-    subprocess.run(
-        ["docker", "config", "rm", config_name],
-        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-    )
+    entries = []
+    for node, items in (data.get("nodes") or {}).items():
+        entries += [_desired_entry(item, str(node), f"nodes.{node}") for item in items or []]
+    entries += [_desired_entry(item, None, "users") for item in data.get("users") or []]
 
-    # Сериализуем JSON и передаём в stdin для `docker config create`
-    json_bytes = json.dumps(config_json, ensure_ascii=False, indent=2).encode("utf-8")
-    proc = subprocess.run(
-        ["docker", "config", "create", config_name, "-"],
-        input=json_bytes,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    if proc.returncode != 0:
-        print(f"❌ Не удалось создать Docker config «{config_name}»")
-        print(proc.stderr.decode("utf-8"))
-        sys.exit(1)
+    desired = {}
+    for username, entry in entries:
+        if username in desired:
+            raise RuntimeError(f"Пользователь «{username}» указан в файле дважды.")
+        if username.startswith(SHARD_PREFIX):
+            raise RuntimeError(RESERVED_NAME_ERROR)
+        desired[username] = entry
+    return desired
 
 
-def create_config_object(username: str, uuid_str: str, private_key: str, short_id: str) -> dict:
+def actual_user_state(services: dict[str, dict] | None = None) -> dict[str, dict]:
     """
-    Формирует Python-словарь (dict) с JSON-конфигом для Xray/VLESS.
-    Возвращает этот словарь.
+    Фактическое состояние пользователей: сервисы vless-<username> из Swarm
+    (одним пакетным запросом) и клиенты шардов из shards.json.
+    Возвращает {username: {"mode", "node"}}.
     """
-    return {
-        "log": {"loglevel": "warning"},
-        "inbounds": [
-            {
-                "port": 443,
-                "protocol": "vless",
-                "settings": {
-                    "clients": [
-                        {"id": uuid_str, "flow": "xtls-rprx-vision"}
-                    ],
-                    "decryption": "none"
-                },
-                "streamSettings": {
-                    "network": "tcp",
-                    "security": "reality",
-                    "realitySettings": {
-                        "show": False,
-                        "dest": "www.google.com:443",
-                        "xver": 0,
-                        "serverNames": ["www.google.com"],
-                        "privateKey": private_key,
-                        "shortIds": [short_id]
-                    }
-                }
-            }
-        ],
-        "outbounds": [{"protocol": "freedom"}]
+    services = list_vless_services() if services is None else services
+    actual = {
+        name[len("vless-"):]: {"mode": "service", "node": info["node"]}
+        for name, info in services.items()
+        if not info["shard"] and name.startswith("vless-")
     }
+    shard_state = json.loads(SHARDS_FILE.read_text(encoding="utf-8")) if SHARDS_FILE.exists() else {}
+    for username, shard_id in shard_state.get("users", {}).items():
+        actual[username] = {"mode": "shared", "node": shard_state["shards"][shard_id].get("node")}
+    return actual
 
 
-def create_service(username: str, port: int, target_node: str | None = None) -> None:
+def plan_apply(desired: dict[str, dict], actual: dict[str, dict]) -> list[dict]:
     """
-    В Docker Swarm создаёт сервис vless-<username>:
-      • пробрасывает порт <port>:443/tcp с mode=host
-      • монтирует ранее созданный Docker config (vless-config-<username>) в /etc/xray/config.json
-      • (опционально) привязывает сервис к конкретной ноде через --constraint node.hostname==<target_node>
+    Минимальный план: create — нет в Swarm, update — отдельный сервис не на
+    той ноде (нода в файле не указана — не переносим), delete — нет в файле.
+    Смена режима или ноды у клиента шарда не выполняется: план с такими
+    расхождениями отклоняется целиком. Возвращает [{"action", "username", "mode", "node", "from"}].
     """
-    service_name = f"vless-{username}"
-    config_name = f"{CONFIG_NAME_PREFIX}-{username}"
+    plan, conflicts = [], []
+    for username, want in sorted(desired.items()):
+        have = actual.get(username)
+        if have is None:
+            plan.append({"action": "create", "username": username, **want, "from": None})
+        elif have["mode"] != want["mode"]:
+            conflicts.append(f"«{username}»: режим {have['mode']} → {want['mode']} (удалите и добавьте заново)")
+        elif want["node"] and want["node"] != have["node"]:
+            if want["mode"] == "shared":
+                conflicts.append(f"«{username}»: клиент шарда на ноде {have['node'] or '-'}, "
+                                 f"в файле {want['node']} (переносите шард целиком)")
+            else:
+                plan.append({"action": "update", "username": username, **want, "from": have["node"]})
+    for username, have in sorted(actual.items()):
+        if username not in desired:
+            plan.append({"action": "delete", "username": username, **have, "from": have["node"]})
+    if conflicts:
+        raise RuntimeError("План не применён:\n  " + "\n  ".join(conflicts))
+    return plan
 
-    # Удаляем старый сервис, если он уже есть (чтобы не было конфликтов)
-    subprocess.run(
-        ["docker", "service", "rm", service_name],
-        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-    )
 
-    cmd = [
-        "docker", "service", "create",
-        "--name", service_name,
-        "--replicas", "1",
-        "--publish", f"mode=host,target=443,published={port},protocol=tcp",
-        "--restart-condition", "any",
-        "--config", f"source={config_name},target=/etc/xray/config.json",
-        "--label", f"vless-port={port}",
-        "teddysun/xray"
-    ]
-    if target_node:
-        cmd.insert(5, "--constraint")
-        cmd.insert(6, f"node.hostname=={target_node}")
-
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if proc.returncode != 0:
-        print(f"❌ Не удалось создать сервис «{service_name}»")
-        print(proc.stderr.decode("utf-8"))
-        sys.exit(1)
+def _undo_apply_op(op: dict, hot: bool) -> None:
+    if op["action"] == "create":
+        discard_user(op["username"], hot)
+    elif op["from"]:
+        migrate_user(op["username"], op["from"])
+    else:
+        DOCKER.service_update(f"vless-{op['username']}", constraints_rm=[f"node.hostname=={op['node']}"])
+        STORE.update_user(op["username"], node=None)
 
 
-def remove_user(username: str) -> None:
+def apply_desired_state(source: str, workers: int = APPLY_WORKERS, dry_run: bool = False,
+                        fmt: str = "table", shard_size: int = SHARD_SIZE, hot: bool = HOT_RELOAD) -> int:
     """
-    Удаляет пользователя:
-      1) Останавливает и удаляет сервис vless-<username>
-      2) Удаляет Docker config vless-config-<username>
-      3) Освобождает порт (если удалось его узнать)
+    Приводит Swarm к файлу желаемого состояния. Фактическое состояние читается
+    одним пакетным запросом; если план пуст, Docker больше не вызывается.
+    Создания и переносы выполняются параллельно в пуле из workers потоков; если
+    хоть одна операция не удалась, успешные откатываются, а удаления (их откатить
+    нельзя — ключи теряются) не выполняются. Удаления идут последними.
+    Результаты печатаются как JSONL. Возвращает число ошибок.
     """
-    service_name = f"vless-{username}"
-    config_name = f"{CONFIG_NAME_PREFIX}-{username}"
+    desired = load_desired_state(source)
+    plan = plan_apply(desired, actual_user_state())
+    if not plan and fmt == "table":
+        print("✅ Изменений нет: Swarm соответствует файлу.")
+        return 0
+    if dry_run or not plan:
+        write_rows(plan, APPLY_COLUMNS, fmt)
+        return 0
+
+    creates = [op for op in plan if op["action"] == "create" and op["mode"] == "service"]
+    shared = [op for op in plan if op["action"] == "create" and op["mode"] == "shared"]
+    updates = [op for op in plan if op["action"] == "update"]
+    deletes = [op for op in plan if op["action"] == "delete"]
+
+    # Ноды для новых отдельных сервисов без явной ноды — одним проходом по нагрузке
+    auto_nodes = iter(place_users(sum(1 for op in creates if op["node"] is None)))
+    for op in creates:
+        op["node"] = op["node"] if op["node"] is not None else next(auto_nodes)
+    ports = allocate_ports(len(creates))
+    keys = KEY_POOL.start().take(len(creates)) if creates else []
+
+    results: list[tuple[dict, dict | None, Exception | None]] = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(provision_user, op["username"], port, key, op["node"]): (op, port)
+                   for op, port, key in zip(creates, ports, keys)}
+        futures.update({pool.submit(migrate_user, op["username"], op["node"]): (op, None) for op in updates})
+        if shared:
+            # add_shared_users сам группирует клиентов по шардам — одна задача на всех
+            futures[pool.submit(add_shared_users, [(op["username"], op["node"]) for op in shared],
+                                shard_size, hot)] = (None, None)
+        failed_ports = []
+        for future in as_completed(futures):
+            op, port = futures[future]
+            try:
+                value = future.result()
+            except Exception as e:
+                if op is None:
+                    results += [(op, None, e) for op in shared]
+                else:
+                    results.append((op, None, e))
+                    if port is not None:
+                        failed_ports.append(port)
+                continue
+            if op is None:
+                by_name = {record["username"]: record for record in value}
+                for op in shared:
+                    record = by_name.get(op["username"], {})
+                    error = RuntimeError(record["error"]) if "error" in record else None
+                    results.append((op, None if error else record, error))
+            else:
+                results.append((op, value, None))
+    release_ports(failed_ports)
+
+    failures = sum(1 for _, _, error in results if error)
+    if failures:
+        # Откат: возвращаем всё, что успело примениться, удаления не выполняем
+        done = [op for op, _, error in results if error is None]
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            undo = {pool.submit(_undo_apply_op, op, hot): op for op in done}
+            rollback_errors = {}
+            for future in as_completed(undo):
+                try:
+                    future.result()
+                except Exception as e:
+                    rollback_errors[undo[future]["username"]] = str(e)
+        for op, _, error in results:
+            record = {"action": op["action"], "username": op["username"], "node": op["node"]}
+            if error:
+                record["error"] = str(error)
+            elif op["username"] in rollback_errors:
+                record["error"] = f"откат не удался: {rollback_errors[op['username']]}"
+            else:
+                record["rolled_back"] = True
+            print(json.dumps(record, ensure_ascii=False), flush=True)
+        for op in deletes:
+            print(json.dumps({"action": "delete", "username": op["username"], "skipped": True},
+                             ensure_ascii=False), flush=True)
+        invalidate_node_stats()
+        return failures
+
+    for op, record, _ in results:
+        out = {"action": op["action"], "username": op["username"], "node": op["node"]}
+        if record and "link" in record:
+            out["link"] = record["link"]
+        print(json.dumps(out, ensure_ascii=False), flush=True)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(discard_user, op["username"], hot): op for op in deletes}
+        for future in as_completed(futures):
+            op = futures[future]
+            out = {"action": "delete", "username": op["username"], "node": op["node"]}
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                out["error"] = str(e)
+            print(json.dumps(out, ensure_ascii=False), flush=True)
+    invalidate_node_stats()
+    if deletes:
+        schedule_cleanup()
+    return failures
+
+
+# -------------------------------------------------------------------
+#  Метрики трафика и онлайна (StatsService Xray)
+# -------------------------------------------------------------------
+def _prom_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsCollector:
+    """
+    Счётчики трафика и онлайна пользователей всех сервисов vless на этой ноде.
+    collect() параллельно опрашивает контейнеры (statsquery с reset) и
+    прибавляет приращения к счётчикам в памяти, поэтому перезапуск контейнера
+    не сбрасывает итог. После каждого прохода текст для Prometheus рендерится
+    заранее: scrape отдаёт готовые байты и не обращается ни к Docker, ни к Xray.
+    """
+
+    def __init__(self, api: XrayApi = None, workers: int = METRICS_WORKERS):
+        self.api = api or XRAY_API
+        self.workers = workers
+        self.traffic: dict[tuple[str, str, str], int] = {}   # (username, сервис, uplink|downlink) -> байт
+        self.online: set[tuple[str, str]] = set()           # (username, сервис)
+        self.errors = 0
+        self.duration = 0.0
+        self.collected_at = 0.0
+        self.lock = threading.Lock()
+        self.text = self.render().encode("utf-8")
+
+    def _scrape(self, container: str) -> tuple[dict, list[str] | None]:
+        traffic = self.api.user_traffic(container)
+        try:
+            online = self.api.online_users(container)
+        except (RuntimeError, ValueError, subprocess.TimeoutExpired):
+            online = None   # старый Xray без statsgetallonlineusers
+        return traffic, online
 
-    # 1) Получаем порт из меток сервиса (если сервис ещё существует)
-    port_to_release = None
+    def collect(self) -> None:
+        started = time.monotonic()
+        containers = DOCKER.local_containers(MANAGED_LABEL)
+        results, errors = [], 0
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(containers) or 1))) as pool:
+            futures = {pool.submit(self._scrape, cid): service for cid, service in containers.items()}
+            for future in as_completed(futures):
+                try:
+                    results.append((futures[future], *future.result()))
+                except (RuntimeError, ValueError, OSError, subprocess.TimeoutExpired) as e:
+                    errors += 1
+                    print(f"⚠️ Метрики сервиса «{futures[future]}»: {e}", file=sys.stderr)
+
+        with self.lock:
+            online = set()
+            for service, traffic, online_users in results:
+                for (username, direction), value in traffic.items():
+                    key = (username, service, direction)
+                    self.traffic[key] = self.traffic.get(key, 0) + value
+                online.update((username, service) for username in online_users or [])
+            self.online = online
+            self.errors += errors
+            self.duration = time.monotonic() - started
+            self.collected_at = time.time()
+            self.text = self.render().encode("utf-8")
+
+    def render(self) -> str:
+        lines = []
+
+        def family(name: str, kind: str, help_text: str, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{_prom_label(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        for direction in ("uplink", "downlink"):
+            family(f"vless_user_{direction}_bytes_total", "counter",
+                   f"Bytes of {direction} traffic per user.",
+                   [({"user": user, "service": service}, value)
+                    for (user, service, d), value in sorted(self.traffic.items()) if d == direction])
+        family("vless_user_online", "gauge", "1 if the user has active connections.",
+               [({"user": user, "service": service}, 1) for user, service in sorted(self.online)])
+        family("vless_users_online", "gauge", "Users online on this node.",
+               [({}, len({user for user, _ in self.online}))])
+        family("vless_metrics_scrape_errors_total", "counter", "Failed Xray stats queries.", [({}, self.errors)])
+        family("vless_metrics_collect_duration_seconds", "gauge", "Duration of the last collection pass.",
+               [({}, f"{self.duration:.6f}")])
+        family("vless_metrics_last_collect_timestamp_seconds", "gauge", "Unix time of the last collection pass.",
+               [({}, f"{self.collected_at:.3f}")])
+        return "\n".join(lines) + "\n"
+
+    def run(self, interval: float, stop: threading.Event) -> None:
+        while not stop.is_set():
+            try:
+                self.collect()
+            except RuntimeError as e:
+                print(f"⚠️ Не удалось собрать метрики: {e}", file=sys.stderr)
+            stop.wait(interval)
+
+
+def serve_metrics(collector: MetricsCollector, listen: str = METRICS_LISTEN,
+                  interval: float = METRICS_INTERVAL) -> None:
+    """Запускает сбор в фоне и отдаёт GET /metrics из памяти коллектора."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = collector.text
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    host, port = listen.rsplit(":", 1)
+    server = http.server.ThreadingHTTPServer((host, int(port)), Handler)
+    stop = threading.Event()
+    threading.Thread(target=collector.run, args=(interval, stop), name="metrics", daemon=True).start()
+    print(f"📈 Метрики: http://{listen}/metrics (опрос каждые {interval:g} с)", file=sys.stderr)
     try:
-        inspect = subprocess.run(
-            ["docker", "service", "inspect", service_name,
-             "--format", "{{json .Spec.Labels}}"],
-            capture_output=True, text=True, check=False
-        )
-        if inspect.returncode == 0 and inspect.stdout.strip():
-            labels = json.loads(inspect.stdout)
-            if labels and "vless-port" in labels:
-                port_to_release = int(labels["vless-port"])
-    except Exception:
+        server.serve_forever()
+    except KeyboardInterrupt:
         pass
+    finally:
+        stop.set()
+        server.server_close()
 
-    # 2) Удаляем сервис
-    result = subprocess.run(["docker", "service", "rm", service_name], capture_output=True)
-    if result.returncode != 0:
-        print(f"⚠️ Сервис «{service_name}» не найден или уже удалён.")
 
-    # 3) Удаляем Docker config
-    subprocess.run(["docker", "config", "rm", config_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+# -------------------------------------------------------------------
+#  Операции над пользователем (общие для CLI и демона serve)
+# -------------------------------------------------------------------
+def add_user(username: str, node: str | None = None, shared: bool = False,
+             shard_size: int = SHARD_SIZE, hot: bool = HOT_RELOAD, single: bool = False) -> dict:
+    """
+    Создаёт пользователя: отдельный сервис (нода по нагрузке, если не задана),
+    клиента общего сервиса или (single) клиента общего контейнера — тогда в
+    записи есть reloads, см. reload_single. Повторный add активного пользователя сохраняет
+    его порт и ссылку и ничего не меняет в Swarm, если конфиг тот же.
+    Возвращает запись с VLESS-ссылкой; при ошибке освобождает порт и бросает RuntimeError.
+    """
+    if username.startswith(SHARD_PREFIX):
+        raise RuntimeError(RESERVED_NAME_ERROR)
+    if single:
+        [record] = add_single_users([username])
+        if "error" in record:
+            raise RuntimeError(f"Пользователь «{username}» {record['error']}.")
+        return {**record, "reloads": reload_single()}
+    if shared:
+        try:
+            [record] = add_shared_users([(username, node)], shard_size, hot)
+        except Exception as e:
+            raise RuntimeError(f"Ошибка при обновлении общего сервиса: {e}")
+        if "error" in record:
+            raise RuntimeError(f"Ошибка при обновлении общего сервиса: {record['error']}")
+        return record
 
-    # 4) Освобождаем порт
-    if port_to_release:
-        release_port(port_to_release)
+    existing = STORE.get_user(username)
+    if existing and existing["mode"] == "service" and existing["status"] == "active":
+        # Повторный add: те же порт, ключи и uuid — сервис меняется, только если изменился конфиг
+        try:
+            return provision_user(username, existing["port"], (existing["private_key"], existing["public_key"]),
+                                  node or existing["node"], existing)
+        except Exception as e:
+            raise RuntimeError(f"Ошибка при обновлении сервиса: {e}")
 
-    print(f"✅ Пользователь «{username}» удалён.")
+    if node is None:
+        [node] = place_users(1)
+    port = get_next_port()
+    try:
+        return provision_user(username, port, KEY_POOL.get(), node)
+    except Exception as e:
+        release_port(port)
+        raise RuntimeError(f"Ошибка при создании сервиса: {e}")
 
 
-def migrate_user(username: str, target_node: str) -> None:
+def drop_user(username: str, hot: bool = HOT_RELOAD) -> dict:
     """
-    Переносит сервис vless-<username> на другую ноду, обновляя constraint:
-      • docker service update --constraint-rm ... --constraint-add node.hostname==<target_node> ...
+    Удаляет пользователя (см. discard_user) и назначает отложенную очистку;
+    пользователя общего контейнера — с перезагрузкой (reloads, см. reload_single).
     """
-    service_name = f"vless-{username}"
+    kind = discard_user(username, hot)
+    if kind == "single":
+        return {"username": username, "removed": kind, "reloads": reload_single()}
+    schedule_cleanup()
+    return {"username": username, "removed": kind}
 
-    # Проверим, существует ли сервис
-    result = subprocess.run(
-        ["docker", "service", "ls", "--filter", f"name={service_name}", "--format", "{{.Name}}"],
-        capture_output=True, text=True
-    )
-    if service_name not in result.stdout.splitlines():
-        print(f"❌ Сервис «{service_name}» не найден.")
-        sys.exit(1)
 
-    # Получаем текущее Placement (список constraints)
-    inspect = subprocess.run(
-        ["docker", "service", "inspect", service_name, "--format", "{{json .Spec.TaskTemplate.Placement}}"],
-        capture_output=True, text=True
-    )
-    placement = json.loads(inspect.stdout) if inspect.stdout.strip() else {}
-    current_constraints = placement.get("Constraints", []) if placement else []
+def move_user(username: str, to_node: str) -> dict:
+    """Переносит отдельный сервис пользователя (или шард целиком) на ноду to_node."""
+    shard_id = find_shard(username)
+    if shard_id:
+        raise RuntimeError(f"Пользователь «{username}» живёт в общем сервисе. "
+                           f"Перенесите шард целиком: migrate {shard_id} --to-node {to_node}")
+    migrate_user(username, to_node)
+    invalidate_node_stats()
+    schedule_cleanup()
+    return {"username": username, "node": to_node}
 
-    # Убираем все node.hostname==* и добавляем новую привязку
-    args = ["docker", "service", "update"]
-    for c in current_constraints:
-        if c.startswith("node.hostname=="):
-            args += ["--constraint-rm", c]
-    args += ["--constraint-add", f"node.hostname=={target_node}", service_name]
 
-    proc = subprocess.run(args, capture_output=True)
-    if proc.returncode != 0:
-        print(f"❌ Не удалось перенести сервис «{service_name}» на ноду «{target_node}»")
-        print(proc.stderr.decode("utf-8"))
-        sys.exit(1)
+def get_user_link(username: str) -> dict:
+    user = STORE.get_user(username)
+    if user is None:
+        raise RuntimeError(f"Пользователь «{username}» не найден в хранилище (выполните reconcile).")
+    return {"username": username, "link": user_link(user)}
+
+
+# Операции, которые CLI передаёт демону: имя -> функция(username, **параметры)
+USER_OPS = {"add": add_user, "remove": drop_user, "migrate": move_user, "link": get_user_link}
+
+
+# -------------------------------------------------------------------
+#  Демон serve: очередь заданий и HTTP API
+# -------------------------------------------------------------------
+class ManagerDaemon:
+    """
+    Долгоживущий процесс: порт-аллокатор, хранилище, пул ключей и соединения
+    с Docker остаются тёплыми между запросами, а Swarm опрашивается один раз
+    при старте (reconcile). Запросы POST /<операция> с JSON-телом
+    {"username": ..., параметры} ставятся в asyncio-очередь; workers
+    обработчиков выполняют их в пуле потоков, причём операции одного
+    пользователя идут строго по очереди поступления. GET /status — счётчики.
+    С токеном (VLESS_DAEMON_TOKEN) запрос без «Authorization: Bearer <токен>»
+    получает 401; без токена TCP-адрес допускается только loopback.
+    """
+
+    def __init__(self, workers: int = DAEMON_WORKERS, hot: bool = HOT_RELOAD, token: str = DAEMON_TOKEN):
+        self.workers = max(workers, 1)
+        self.hot = hot
+        self.token = token
+        self.queue: asyncio.Queue | None = None
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        # Пользователи с заданием в работе -> их следующие задания (ещё не в очереди)
+        self.waiting: dict[str, list[dict]] = {}
+        self.counters = {"accepted": 0, "running": 0, "done": 0, "failed": 0}
+        self.started = time.time()
+
+    def submit(self, op: str, username: str, params: dict) -> asyncio.Future:
+        self.counters["accepted"] += 1
+        job = {"id": self.counters["accepted"], "op": op, "username": username, "params": params,
+               "future": asyncio.get_running_loop().create_future()}
+        if username in self.waiting:
+            self.waiting[username].append(job)
+        else:
+            self.waiting[username] = []
+            self.queue.put_nowait(job)
+        return job["future"]
+
+    def _run(self, job: dict) -> dict:
+        params = dict(job["params"])
+        if job["op"] in ("add", "remove"):
+            params["hot"] = bool(params.get("hot")) or self.hot
+        return USER_OPS[job["op"]](job["username"], **params)
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            self.counters["running"] += 1
+            try:
+                result = await loop.run_in_executor(self.executor, self._run, job)
+                self.counters["done"] += 1
+                job["future"].set_result((200, {"job": job["id"], "result": result}))
+            except (RuntimeError, TypeError, ValueError) as e:
+                self.counters["failed"] += 1
+                job["future"].set_result((400, {"job": job["id"], "error": str(e)}))
+            except Exception as e:
+                self.counters["failed"] += 1
+                job["future"].set_result((500, {"job": job["id"], "error": f"{type(e).__name__}: {e}"}))
+            finally:
+                self.counters["running"] -= 1
+                # Следующее задание этого пользователя встаёт в очередь только теперь
+                pending = self.waiting[job["username"]]
+                if pending:
+                    self.queue.put_nowait(pending.pop(0))
+                else:
+                    del self.waiting[job["username"]]
+                self.queue.task_done()
+
+    def status(self) -> dict:
+        return {
+            **self.counters,
+            "queued": self.queue.qsize() + sum(len(jobs) for jobs in self.waiting.values()),
+            "workers": self.workers,
+            "uptime_s": round(time.time() - self.started, 1),
+        }
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> tuple[int, dict]:
+        route = path.split("?", 1)[0].strip("/")
+        if route == "status":
+            return (200, self.status()) if method == "GET" else (405, {"error": "ожидается GET"})
+        if route not in USER_OPS:
+            return 404, {"error": f"неизвестная операция «{route}»"}
+        if method != "POST":
+            return 405, {"error": "ожидается POST"}
+        try:
+            params = json.loads(body or b"{}")
+        except ValueError as e:
+            return 400, {"error": f"тело запроса — не JSON: {e}"}
+        if not isinstance(params, dict):
+            return 400, {"error": "тело запроса должно быть JSON-объектом"}
+        username = str(params.pop("username", "")).strip()
+        if not username:
+            return 400, {"error": "не указан username"}
+        return await self.submit(route, username, params)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            if self.token and not hmac.compare_digest(headers.get("authorization", "").encode(),
+                                                      f"Bearer {self.token}".encode()):
+                status, payload = 401, {"error": "нужен токен VLESS_DAEMON_TOKEN"}
+            else:
+                status, payload = await self.dispatch(method, path, body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {"error": f"некорректный запрос: {e}"}
+        except Exception as e:
+            # Клиент всегда получает ответ, а не оборванное соединение
+            status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+        data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        try:
+            writer.write(f"HTTP/1.1 {status} {http.client.responses.get(status, '')}\r\n"
+                         f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") + data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def warm_up(self) -> None:
+        """
+        Запускает пул ключей и один раз сверяет порты и хранилище со Swarm.
+        Карта портов перестраивается, только если её ещё нет; иначе к ней лишь
+        добавляются порты сервисов — выделенное параллельным --local не теряется.
+        """
+        KEY_POOL.start()
+        try:
+            services = list_vless_services()
+        except RuntimeError as e:
+            print(f"⚠️ Swarm недоступен при старте ({e}), работаем по локальному хранилищу.", file=sys.stderr)
+            return
+        ports = reconcile_ports(services, merge=PORTS.path.exists())
+        counts = reconcile_store(services)
+        print(f"✅ Состояние загружено: сервисов {len(services)}, занято портов {ports}, "
+              f"импортировано {counts['imported']}, отсутствуют в Swarm {counts['missing']}.", file=sys.stderr)
+
+    async def serve(self, address: str = DAEMON_ADDRESS) -> None:
+        if "/" not in address and not self.token and not _is_loopback(address.rsplit(":", 1)[0]):
+            raise RuntimeError(f"{address} доступен не только с этой машины, а запросы меняют Swarm: "
+                               f"задайте VLESS_DAEMON_TOKEN или слушайте 127.0.0.1.")
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        await loop.run_in_executor(self.executor, self.warm_up)
+
+        if "/" in address:
+            Path(address).unlink(missing_ok=True)
+            server = await asyncio.start_unix_server(self.handle, address)
+            os.chmod(address, 0o600)
+        else:
+            host, port = address.rsplit(":", 1)
+            server = await asyncio.start_server(self.handle, host, int(port))
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"🛰️ Демон слушает {address} (одновременно до {self.workers} операций)", file=sys.stderr)
+
+        async with server:
+            await stop.wait()
+        # Новые запросы больше не принимаются; принятые задания доделываем
+        await self.queue.join()
+        for task in workers:
+            task.cancel()
+        self.executor.shutdown()
+        if "/" in address:
+            Path(address).unlink(missing_ok=True)
+        print(f"🛑 Демон остановлен: выполнено {self.counters['done']}, ошибок {self.counters['failed']}.",
+              file=sys.stderr)
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+
+def daemon_call(op: str, username: str, params: dict, address: str = DAEMON_ADDRESS,
+                local_options: list[str] = ()) -> dict | None:
+    """
+    Отправляет операцию демону serve и возвращает его ответ ({"result"} или {"error"}).
+    Возвращает None, если демон не запущен, — тогда операция выполняется локально.
+    Если демон запущен, а у команды есть local_options (см. DAEMON_LOCAL_OPTIONS),
+    операция не отправляется: бросает RuntimeError, а не выполняет её без этих опций.
+    """
+    if "/" in address:
+        if not os.path.exists(address):
+            return None
+        conn = _UnixHTTPConnection(address, timeout=DAEMON_TIMEOUT)
+    else:
+        host, port = address.rsplit(":", 1)
+        conn = http.client.HTTPConnection(host, int(port), timeout=DAEMON_TIMEOUT)
+    try:
+        conn.connect()
+    except (ConnectionRefusedError, FileNotFoundError):
+        conn.close()
+        return None
+    if local_options:
+        conn.close()
+        raise RuntimeError(f"Запущен демон serve ({address}), а {', '.join(local_options)} действуют только "
+                           f"в этом процессе. Добавьте --local или перезапустите демон с этими опциями.")
+    try:
+        with TRACER.span("daemon", lambda: f"POST /{op}") as span:
+            headers = {"Content-Type": "application/json"}
+            if DAEMON_TOKEN:
+                headers["Authorization"] = f"Bearer {DAEMON_TOKEN}"
+            conn.request("POST", f"/{op}", body=json.dumps({"username": username, **params}).encode("utf-8"),
+                         headers=headers)
+            resp = conn.getresponse()
+            raw = resp.read()
+            span.set(status=resp.status, out_bytes=len(raw))
+        return json.loads(raw)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        raise RuntimeError(f"Демон {address} не ответил: {e}")
+    finally:
+        conn.close()
 
-    print(f"✅ Сервис «{service_name}» перенесён на ноду «{target_node}».")
+
+def run_user_op(op: str, username: str, **params) -> dict:
+    """Выполняет операцию через демон serve, если он запущен, иначе в этом процессе."""
+    if DAEMON_ENABLED and "--local" not in sys.argv:
+        reply = daemon_call(op, username, params,
+                            local_options=[option for option in DAEMON_LOCAL_OPTIONS if option in sys.argv])
+        if reply is not None:
+            if "error" in reply:
+                raise RuntimeError(reply["error"])
+            return reply["result"]
+    return USER_OPS[op](username, **params)
 
 
 def print_usage_and_exit() -> None:
-    print("Использование:")
-    print("  python3 vless_manager.py add <username> [--node <имя_ноды>]")
-    print("  python3 vless_manager.py remove <username>")
+    print("Использование (общие опции: --docker-backend cli|api, --trace [--trace-file <путь>]):")
+    print("  python3 vless_manager.py add <username> [--node <имя_ноды>] [--shared [--shard-size <K>] [--hot]]")
+    print("  python3 vless_manager.py add-many <файл|-> [--workers <N>] [--shared [--shard-size <K>] [--hot]]")
+    print("  python3 vless_manager.py add <username> --single   (add-many <файл|-> --single)")
+    print("  (--single — общий контейнер xray-server на 443; изменения за VLESS_RELOAD_DEBOUNCE с применяются одним перезапуском)")
+    print("  python3 vless_manager.py remove <username> [--hot]")
     print("  python3 vless_manager.py migrate <username> --to-node <имя_ноды>")
+    print("  python3 vless_manager.py apply <users.yaml|-> [--dry-run] [--workers <N>] [--format table|json|jsonl] [--hot]")
+    print("  python3 vless_manager.py rebalance [--dry-run] [--max-moves <N>] [--workers <N>] [--format table|json|jsonl]")
+    print("  python3 vless_manager.py link <username>")
+    print("  python3 vless_manager.py list [--live] [--format table|json|jsonl]")
+    print("  python3 vless_manager.py links [--live] [--format table|json|jsonl]")
+    print("  python3 vless_manager.py reconcile")
+    print("  python3 vless_manager.py sync-shards   (опубликовать горячие изменения шардов; перезапускает их)")
+    print("  python3 vless_manager.py reload   (применить ожидающие изменения общего контейнера сейчас)")
+    print("  python3 vless_manager.py cleanup [--force]   (например, из cron)")
+    print("  python3 vless_manager.py metrics [--listen <host:port>] [--interval <сек>] [--once]")
+    print("  (--metrics у add/add-many или VLESS_METRICS=1 включает статистику Xray в новых конфигах)")
+    print("  python3 vless_manager.py serve [--listen <сокет|host:port>] [--workers <N>] [--hot]")
+    print("  (если serve запущен, add/remove/migrate/link выполняются через него; --local — без демона;")
+    print("   --metrics, --docker-backend и --trace демону не передаются — с ними нужен --local)")
     sys.exit(1)
 
 
-def cleanup_docker_system(auto_confirm: bool = True) -> None:
+def cleanup_due(min_interval: int = CLEANUP_MIN_INTERVAL) -> bool:
+    """
+    Проверяет, прошло ли min_interval секунд с последней очистки.
+    """
+    try:
+        return time.time() - CLEANUP_STAMP_FILE.stat().st_mtime >= min_interval
+    except FileNotFoundError:
+        return True
+
+
+def cleanup_managed_resources(force: bool = False) -> dict[str, int] | None:
+    """
+    Очищает только ресурсы Docker с меткой MANAGED_LABEL:
+      • остановленные контейнеры задач наших сервисов;
+      • Docker configs, на которые не ссылается ни один сервис (старые ревизии и т. п.),
+        если они старше CLEANUP_CONFIG_GRACE секунд: только что созданный config
+        параллельного add ещё может быть не подключён к сервису.
+    Образы не удаляются вовсе, поэтому кэш teddysun/xray сохраняется.
+    Не чаще раза в CLEANUP_MIN_INTERVAL секунд (если не force) и не более одной
+    очистки одновременно. Возвращает счётчики или None, если очистка пропущена.
+    """
+    lock_fd = os.open(f"{CLEANUP_STAMP_FILE}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None   # очистка уже идёт в другом процессе
+        if not force and not cleanup_due():
+            return None
+
+        DOCKER.container_prune(f"{MANAGED_LABEL}=1")
+
+        referenced = {
+            ref.get("ConfigName")
+            for spec in DOCKER.service_specs(MANAGED_LABEL)
+            for ref in ((spec.get("TaskTemplate") or {}).get("ContainerSpec") or {}).get("Configs") or []
+        }
+        removed = 0
+        cutoff = time.time() - CLEANUP_CONFIG_GRACE
+        for name, created in DOCKER.config_created(f"{MANAGED_LABEL}=1").items():
+            if name in referenced or created is None or created > cutoff:
+                continue
+            if DOCKER.config_rm(name):
+                removed += 1
+
+        CLEANUP_STAMP_FILE.touch()
+        return {"configs_removed": removed}
+    finally:
+        os.close(lock_fd)
+
+
+def schedule_cleanup() -> bool:
+    """
+    Откладывает очистку: если она назрела, запускает `vless_manager.py cleanup`
+    отдельным фоновым процессом (вывод — в CLEANUP_LOG_FILE) и сразу возвращается.
+    Возвращает True, если процесс очистки запущен.
+    """
+    if not cleanup_due():
+        return False
+    with open(CLEANUP_LOG_FILE, "a", encoding="utf-8") as log, TRACER.span("subprocess", "spawn cleanup"):
+        subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "cleanup", "--docker-backend", DOCKER.name],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            start_new_session=True, close_fds=True,
+        )
+    return True
+
+
+def get_cli_option(flag: str, usage: str) -> str | None:
     """
-    Выполняет безопасную очистку Docker: удаляет остановленные контейнеры, неиспользуемые образы и кэш.
+    Возвращает значение опции вида `<flag> <значение>` из sys.argv (или None, если опции нет).
+    При отсутствии значения печатает подсказку usage и завершает работу.
     """
-    print("🧹 Выполняется очистка системы от неиспользуемых ресурсов Docker...")
-    args = ["docker", "system", "prune", "-f"] if auto_confirm else ["docker", "system", "prune"]
+    if flag not in sys.argv:
+        return None
+    try:
+        return sys.argv[sys.argv.index(flag) + 1]
+    except IndexError:
+        print(f"❌ Некорректно указано {flag}. Используйте: {usage}")
+        sys.exit(1)
+
+
+def get_shard_size() -> int:
+    value = get_cli_option("--shard-size", "--shared --shard-size <K>")
+    if value is None:
+        return SHARD_SIZE
+    if not value.isdigit() or int(value) < 1:
+        print("❌ --shard-size должен быть положительным числом.")
+        sys.exit(1)
+    return int(value)
+
+
+def get_metrics_interval() -> float:
+    value = get_cli_option("--interval", "metrics --interval <сек>")
+    if value is None:
+        return METRICS_INTERVAL
     try:
-        subprocess.run(args, check=True)
-        print("✅ Очистка завершена.")
-    except subprocess.CalledProcessError as e:
-        print("⚠️ Не удалось выполнить очистку:", e)
+        interval = float(value)
+    except ValueError:
+        interval = 0.0
+    # float() принимает и «nan»/«inf»: с ними фоновый сбор не работает, поэтому только конечное число
+    if not 0 < interval < float("inf"):
+        print("❌ --interval должен быть положительным числом секунд. Используйте: metrics --interval <сек>")
+        sys.exit(1)
+    return interval
+
+
+# Команды, которым не нужен аргумент <username>
+NO_ARG_ACTIONS = {"reconcile", "sync-shards", "list", "links", "cleanup", "rebalance", "metrics", "serve", "reload"}
+
+# Колонки вывода list / links
+LIST_COLUMNS = ["username", "mode", "shard", "port", "node", "status"]
+LINKS_COLUMNS = ["username", "link"]
+REBALANCE_COLUMNS = ["username", "from", "to"]
+APPLY_COLUMNS = ["action", "username", "mode", "node", "from"]
+OUTPUT_FORMATS = ("table", "json", "jsonl")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
+    if len(sys.argv) < 2:
         print_usage_and_exit()
 
     action = sys.argv[1].lower()
-    username = sys.argv[2].strip()
+    if action not in NO_ARG_ACTIONS and len(sys.argv) < 3:
+        print_usage_and_exit()
+    username = sys.argv[2].strip() if len(sys.argv) > 2 else ""
+    backend = get_cli_option("--docker-backend", "--docker-backend cli|api")
+    if backend:
+        DOCKER = make_docker_backend(backend.lower())
+    hot = HOT_RELOAD or "--hot" in sys.argv
+    trace_file = get_cli_option("--trace-file", "--trace-file <путь>")
+    if trace_file or "--trace" in sys.argv or TRACE_ENV not in ("", "0"):
+        if not trace_file and TRACE_ENV not in ("", "0", "1"):
+            trace_file = TRACE_ENV
+        TRACER.enable(Path(trace_file) if trace_file else TRACE_FILE, action)
+    if "--metrics" in sys.argv:
+        METRICS = True
 
     if action == "add":
         # Разбор опции --node (если нужно привязать к конкретной ноде)
@@ -305,52 +3294,81 @@ if __name__ == "__main__":
                 print("❌ Некорректно указана нода. Используйте: add <username> --node <имя_ноды>")
                 sys.exit(1)
 
-        # 1) Генерация случайных параметров
-        port = get_next_port()
-        uuid_str = str(uuid.uuid4())
-        private_key, public_key = generate_x25519_keys()
-        short_id = "".join(random.choice("0123456789abcdef") for _ in range(8))
-
-        # 2) Составляем JSON-конфиг в виде Python-словаря
-        config_dict = create_config_object(username, uuid_str, private_key, short_id)
-
-        # 3) Создаём Docker config (внутри Swarm) с этим JSON
-        create_docker_config(username, config_dict)
-
-        # 4) Создаём сервис
+        # --shared: пользователь добавляется клиентом в один из шардов.
+        # Без --node нода выбирается по нагрузке (VLESS_PLACEMENT=swarm — решает Swarm)
+        # --single: клиент общего контейнера xray-server (режим vless_manager.sh)
+        shared = "--shared" in sys.argv
+        single = "--single" in sys.argv
         try:
-            create_service(username, port, node)
-        except Exception as e:
-            print(f"❌ Ошибка при создании сервиса: {e}")
-            # Если сервис не создался, удалим созданный config и освободим порт
-            subprocess.run(["docker", "config", "rm", f"{CONFIG_NAME_PREFIX}-{username}"], 
-                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            release_port(port)
+            record = run_user_op("add", username, node=node, shared=shared,
+                                 shard_size=get_shard_size() if shared else SHARD_SIZE, hot=hot, single=single)
+        except RuntimeError as e:
+            print(f"❌ {e}")
             sys.exit(1)
 
-        # 5) Используем чистый базовый домен для VLESS-ссылки
-        domain = BASE_DOMAIN
+        if single:
+            print(f"✅ Пользователь успешно добавлен в общий контейнер {SINGLE_CONTAINER}.")
+            print("VLESS-ссылка для клиента:")
+            print(record["link"])
+            report_reloads(record["reloads"])
+            sys.exit(0)
 
-        # 6) Собираем VLESS-ссылку для клиента, используя чистый домен вместо поддомена
-        # Порт остаётся тем, который мы выделили из used_ports.txt
-        vless_link = (
-            f"vless://{uuid_str}@{domain}:{port}"
-            f"?security=reality&encryption=none&alpn=h2,http/1.1&headerType=none"
-            f"&fp=chrome&type=tcp&flow=xtls-rprx-vision&sni=www.google.com"
-            f"&pbk={public_key}&sid={short_id}#{username}"
-        )
+        if shared:
+            print(f"✅ Пользователь успешно добавлен в общий сервис {_shard_service_name(record['shard'])}.")
+            print("VLESS-ссылка для клиента:")
+            print(record["link"])
+            sys.exit(0)
 
         print("✅ Пользователь успешно добавлен.")
-        if node:
-            print(f"🎯 Сервис развёрнут на ноде: {node}")
+        if record["node"]:
+            print(f"🎯 Сервис развёрнут на ноде: {record['node']}")
         print("VLESS-ссылка для клиента:")
-        print(vless_link)
+        print(record["link"])
         print()
-        print(f"💡 Убедитесь, что DNS-запись для {domain} указывает на IP вашего сервера (или балансировщика).")
+        print(f"💡 Убедитесь, что DNS-запись для {BASE_DOMAIN} указывает на IP вашего сервера (или балансировщика).")
+
+    elif action == "add-many":
+        # username здесь — путь к файлу со списком пользователей (или "-" для stdin)
+        workers = ADD_MANY_WORKERS
+        if "--workers" in sys.argv:
+            try:
+                workers = int(sys.argv[sys.argv.index("--workers") + 1])
+            except (ValueError, IndexError):
+                print("❌ Некорректно указано --workers. Используйте: add-many <файл|-> --workers <N>")
+                sys.exit(1)
+
+        try:
+            entries = read_batch(username)
+        except (RuntimeError, OSError) as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        if "--single" in sys.argv:
+            # Все пользователи пакета применяются одной перезагрузкой общего контейнера
+            records = add_single_users([name for name, _ in entries])
+            for record in records:
+                print(json.dumps(record, ensure_ascii=False), flush=True)
+            failed = sum(1 for record in records if "error" in record)
+            report_reloads(reload_single())
+        elif "--shared" in sys.argv:
+            records = add_shared_users(entries, get_shard_size(), hot)
+            for record in records:
+                print(json.dumps(record, ensure_ascii=False), flush=True)
+            failed = sum(1 for record in records if "error" in record)
+        else:
+            failed = add_many(entries, workers)
+        print(f"✅ Создано пользователей: {len(entries) - failed}, ошибок: {failed}", file=sys.stderr)
+        if failed:
+            sys.exit(1)
 
     elif action == "remove":
-        remove_user(username)
-        cleanup_docker_system()
+        try:
+            record = run_user_op("remove", username, hot=hot)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        report_removed(username, record["removed"])
+        if record["removed"] == "single":
+            report_reloads(record["reloads"])
 
     elif action == "migrate":
         if "--to-node" not in sys.argv:
@@ -363,9 +3381,140 @@ if __name__ == "__main__":
             print("❌ Некорректно указана нода. Используйте: migrate <username> --to-node <имя_ноды>")
             sys.exit(1)
 
-        migrate_user(username, target)
-        cleanup_docker_system()
+        try:
+            run_user_op("migrate", username, to_node=target)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        print(f"✅ Сервис «vless-{username}» перенесён на ноду «{target}».")
         print(f"💡 После миграции убедитесь, что DNS-запись для {BASE_DOMAIN} по-прежнему указывает на доступный узел.")
 
+    elif action == "reconcile":
+        try:
+            services = list_vless_services()
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        count = reconcile_ports(services)
+        counts = reconcile_store(services)
+        print(f"✅ Карта портов перестроена по меткам vless-port: занято {count} портов.")
+        print(f"✅ Хранилище синхронизировано: импортировано {counts['imported']}, "
+              f"обновлено {counts['updated']}, отсутствуют в Swarm {counts['missing']}.")
+
+    elif action == "link":
+        try:
+            print(run_user_op("link", username)["link"])
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+
+    elif action in ("list", "links"):
+        fmt = get_cli_option("--format", f"{action} --format table|json|jsonl") or "table"
+        if fmt not in OUTPUT_FORMATS:
+            print(f"❌ Неизвестный формат «{fmt}». Доступно: {', '.join(OUTPUT_FORMATS)}")
+            sys.exit(1)
+        try:
+            rows = iter_user_rows(live="--live" in sys.argv, with_links=action == "links")
+            write_rows(rows, LINKS_COLUMNS if action == "links" else LIST_COLUMNS, fmt)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+
+    elif action == "cleanup":
+        try:
+            result = cleanup_managed_resources(force="--force" in sys.argv)
+        except RuntimeError as e:
+            print(f"⚠️ Не удалось выполнить очистку: {e}")
+            sys.exit(1)
+        if result is None:
+            print(f"⏭️ Очистка пропущена: уже выполняется или была менее {CLEANUP_MIN_INTERVAL} с назад.")
+        else:
+            print(f"✅ Очистка завершена: удалено неиспользуемых configs — {result['configs_removed']}.")
+
+    elif action == "rebalance":
+        fmt = get_cli_option("--format", "rebalance --format table|json|jsonl") or "table"
+        if fmt not in OUTPUT_FORMATS:
+            print(f"❌ Неизвестный формат «{fmt}». Доступно: {', '.join(OUTPUT_FORMATS)}")
+            sys.exit(1)
+        max_moves = get_cli_option("--max-moves", "rebalance --max-moves <N>")
+        workers = get_cli_option("--workers", "rebalance --workers <N>")
+        if any(value is not None and not value.isdigit() for value in (max_moves, workers)):
+            print("❌ --max-moves и --workers должны быть числами.")
+            sys.exit(1)
+        try:
+            failed = rebalance(int(max_moves) if max_moves else None,
+                               int(workers) if workers else REBALANCE_WORKERS,
+                               dry_run="--dry-run" in sys.argv, fmt=fmt)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        if failed:
+            print(f"⚠️ Не удалось перенести сервисов: {failed}", file=sys.stderr)
+            sys.exit(1)
+        schedule_cleanup()
+
+    elif action == "apply":
+        # username здесь — путь к файлу желаемого состояния (или "-" для stdin)
+        fmt = get_cli_option("--format", "apply --format table|json|jsonl") or "table"
+        if fmt not in OUTPUT_FORMATS:
+            print(f"❌ Неизвестный формат «{fmt}». Доступно: {', '.join(OUTPUT_FORMATS)}")
+            sys.exit(1)
+        workers = get_cli_option("--workers", "apply --workers <N>")
+        if workers is not None and not workers.isdigit():
+            print("❌ --workers должен быть числом.")
+            sys.exit(1)
+        try:
+            failed = apply_desired_state(username, int(workers) if workers else APPLY_WORKERS,
+                                         dry_run="--dry-run" in sys.argv, fmt=fmt,
+                                         shard_size=get_shard_size(), hot=hot)
+        except (RuntimeError, OSError) as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        if failed:
+            print(f"⚠️ Ошибок при применении: {failed}", file=sys.stderr)
+            sys.exit(1)
+
+    elif action == "metrics":
+        collector = MetricsCollector()
+        if "--once" in sys.argv:
+            try:
+                collector.collect()
+            except RuntimeError as e:
+                print(f"❌ {e}")
+                sys.exit(1)
+            sys.stdout.write(collector.text.decode("utf-8"))
+        else:
+            interval = get_metrics_interval()
+            serve_metrics(collector, get_cli_option("--listen", "metrics --listen <host:port>") or METRICS_LISTEN,
+                          interval)
+
+    elif action == "serve":
+        workers = get_cli_option("--workers", "serve --workers <N>")
+        if workers is not None and not workers.isdigit():
+            print("❌ --workers должен быть числом.")
+            sys.exit(1)
+        daemon = ManagerDaemon(int(workers) if workers else DAEMON_WORKERS, hot)
+        try:
+            asyncio.run(daemon.serve(get_cli_option("--listen", "serve --listen <сокет|host:port>") or DAEMON_ADDRESS))
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+
+    elif action == "reload":
+        # Применить ожидающие изменения общего контейнера сейчас, без ожидания тишины
+        try:
+            reloads = reload_single(debounce=0)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        if reloads:
+            report_reloads(reloads)
+        else:
+            print(f"✅ Ожидающих изменений в {SINGLE_CONTAINER} нет (или их применяет другой процесс).")
+
+    elif action == "sync-shards":
+        synced = sync_shards()
+        print(f"✅ Синхронизировано шардов: {len(synced)}" + (f" ({', '.join(synced)})" if synced else ""))
+
     else:
         print_usage_and_exit()